@@ -0,0 +1,3 @@
+'''
+    Benchmarks for puppetctl.  See bench_statefile.py.
+'''
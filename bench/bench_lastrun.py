@@ -0,0 +1,176 @@
+'''
+    Benchmark reading puppet's last_run_summary.yaml the ways 'puppetctl
+    status' can: with puppetctl's own parser ('native'), with puppet's ruby
+    ('ruby'), and from the lastrun cache while the file is unchanged
+    ('cached').  Only needs the standard library, and ruby for 'ruby':
+
+        python -B -m bench.bench_lastrun
+        python -B -m bench.bench_lastrun --file /opt/puppetlabs/puppet/public/last_run_summary.yaml
+
+    Both wall-clock and CPU time are measured, the CPU time including any
+    child processes, since spawning ruby is most of what the ruby parser
+    costs.  If there's no ruby in --puppet-bin-path, its results are left
+    out and 'ruby_available' is false.  Results are JSON.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import tempfile
+from puppetctl import PuppetctlExecution
+
+PARSERS = ['native', 'ruby', 'cached']
+DEFAULT_REPEAT = 20
+# A summary like those puppet writes, for when no --file is given.
+SAMPLE_SUMMARY = '''---
+version:
+  config: a294ac4f4fcd5264e5246df0787757a74fc3d966
+  puppet: 7.14.0
+resources:
+  changed: 2
+  corrective_change: 0
+  failed: 0
+  failed_to_restart: 0
+  out_of_sync: 2
+  restarted: 0
+  scheduled: 0
+  skipped: 0
+  total: 366
+time:
+  augeas: 2.7187098290000007
+  catalog_application: 10.458131338004023
+  config_retrieval: 13.613585681654513
+  exec: 0.32642884899999997
+  fact_generation: 2.3347227880731225
+  file: 3.2064250629999993
+  package: 1.6999540419999992
+  service: 0.31906947300000005
+  total: 29.360705031
+  transaction_evaluation: 10.340445864014328
+  last_run: 1586995296
+changes:
+  total: 2
+events:
+  failure: 0
+  success: 2
+  total: 2
+'''
+
+
+def _cpu_seconds():
+    ''' CPU time used so far, by us and by our finished children '''
+    return sum(resource.getrusage(who).ru_utime + resource.getrusage(who).ru_stime
+               for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN])
+
+
+def _stats(timings):
+    ''' The summary of a list of timings '''
+    return {'min': min(timings), 'median': statistics.median(timings),
+            'mean': statistics.mean(timings)}
+
+
+def ruby_available(puppet_bin_path):
+    ''' True if there's a ruby in puppet_bin_path that can load YAML '''
+    try:
+        with open(os.devnull, 'w', encoding='utf-8') as devnull:
+            return subprocess.call(['ruby', '-ryaml', '-e', ''], env={'PATH': puppet_bin_path},
+                                   stdout=devnull, stderr=devnull) == 0
+    except OSError:
+        return False
+
+
+def run_benchmarks(lastrunfile=None, repeat=DEFAULT_REPEAT, puppet_bin_path=None):
+    '''
+        Time _parse_puppet_lastrunfile with each of PARSERS on lastrunfile
+        (SAMPLE_SUMMARY if None), repeat times apiece.  'native' and 'ruby'
+        parse every time; 'cached' is the native parser with a warm cache.
+        Returns the results structure that main() prints.
+    '''
+    workdir = tempfile.mkdtemp(prefix='puppetctl-bench.')
+    summary_name = lastrunfile or 'sample'
+    if lastrunfile is None:
+        lastrunfile = os.path.join(workdir, 'last_run_summary.yaml')
+        with open(lastrunfile, 'w', encoding='utf-8') as summary_w:
+            summary_w.write(SAMPLE_SUMMARY)
+    runners = {parser: PuppetctlExecution(state_file=os.path.join(workdir, 'puppetctl.status'),
+                                          puppet_bin_path=puppet_bin_path,
+                                          lastrun_parser=parser,
+                                          lastrun_cache='')
+               for parser in ['native', 'ruby']}
+    runners['cached'] = PuppetctlExecution(state_file=os.path.join(workdir, 'puppetctl.status'),
+                                           lastrun_cache=os.path.join(workdir, 'lastrun.cache'))
+    has_ruby = ruby_available(runners['ruby'].puppet_bin_path)
+    results = []
+    answers = {}
+    try:
+        for parser in PARSERS:
+            if parser == 'ruby' and not has_ruby:
+                continue
+            if parser == 'cached':
+                # Warm it up, so only hits are timed.
+                runners[parser]._parse_puppet_lastrunfile(lastrunfile)
+            wall = []
+            cpu = []
+            for _num in range(repeat):
+                # Each time as a fresh 'puppetctl status' would, with nothing in memory.
+                runners[parser]._lastrun_memo = None
+                cpu_start = _cpu_seconds()
+                start = time.perf_counter()
+                answers[parser] = runners[parser]._parse_puppet_lastrunfile(lastrunfile)
+                wall.append(time.perf_counter() - start)
+                cpu.append(_cpu_seconds() - cpu_start)
+            results.append({'parser': parser, 'repeat': repeat,
+                            'seconds': _stats(wall), 'cpu_seconds': _stats(cpu)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    medians = {x['parser']: x['seconds']['median'] for x in results}
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': int(time.time()),
+            'lastrunfile': summary_name,
+            'ruby_available': has_ruby,
+        },
+        'results': results,
+        # How many times faster native is than ruby, by median wall-clock time.
+        'speedup': (medians['ruby'] / medians['native']
+                    if has_ruby and medians['native'] else None),
+        'cached_speedup': (medians['native'] / medians['cached']
+                           if medians['cached'] else None),
+        # The ages differ by however long the runs took, so don't compare those.
+        'parsers_agree': (len({(x['errors'], x['config']) for x in answers.values()}) == 1
+                          if has_ruby else None),
+    }
+
+
+def main(argv=None):
+    ''' Run the benchmarks and print the results as JSON '''
+    parser = argparse.ArgumentParser(description='Benchmark the lastrunfile parsers')
+    parser.add_argument('--file', default=None,
+                        help='the last_run_summary.yaml to read (default: a sample)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='times to run each parser')
+    parser.add_argument('--puppet-bin-path', default=None,
+                        help="where to find puppet's ruby")
+    parser.add_argument('--output', default=None, help='write the JSON here, not to stdout')
+    args = parser.parse_args(argv)
+    results = run_benchmarks(args.file, args.repeat, args.puppet_bin_path)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as outfile:
+            outfile.write(output + '\n')
+    else:
+        print(output)
+    # Exit 1 if the parsers disagree.
+    return 1 if results['parsers_agree'] is False else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
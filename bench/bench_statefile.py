@@ -0,0 +1,203 @@
+'''
+    Benchmarks for the statefile hot paths, across lock counts and how many
+    of those locks have expired.  Only needs the standard library:
+
+        python -B -m bench.bench_statefile > new.json
+        python -B -m bench.bench_statefile --compare old.json
+
+    Reads only hide expired locks; writes purge them.  So for
+    purge_expired_locks, and the adds and removes that purge as they write,
+    the expired fraction is locks to purge; for reads, only locks to skip.  Each
+    measurement starts from a freshly written state file, so a purge done by
+    one repetition doesn't make the next one cheaper.  Results are JSON, so
+    two branches' runs can be compared with --compare.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import shutil
+import statistics
+import tempfile
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+
+DEFAULT_LOCK_COUNTS = [0, 1, 10, 100, 1000]
+DEFAULT_EXPIRED_FRACTIONS = [0.0, 0.5, 0.9]
+DEFAULT_REPEAT = 20
+# --compare fails a result whose median is more than this many times the baseline's.
+DEFAULT_THRESHOLD = 1.25
+OPERATIONS = ['add_lock', 'remove_lock', 'purge_expired_locks', '_get_lock_ids',
+              'read_state_file', '_status_of_puppetctl']
+# A live lock every seeded state has, for remove_lock to remove.
+VICTIM_LOCKID = 'benchvictim'
+
+
+class BenchStatefile(PuppetctlStatefile):
+    ''' A statefile we may write as anyone, so expiry purges happen as they would for root '''
+
+    @staticmethod
+    def _allowed_to_write_statefile():
+        ''' Always allowed '''
+        return True
+
+
+def seed_state(lock_count, expired_fraction, now):
+    '''
+        A state structure of lock_count locks, expired_fraction of them expired.
+        Every user has one lock, alternating types.  The last lock is always
+        live, and is VICTIM_LOCKID.
+    '''
+    expired_count = min(int(round(lock_count * expired_fraction)), lock_count - 1)
+    statefiledata = {}
+    for num in range(lock_count):
+        expiry = now - 60 if num < expired_count else now + 3600 + num
+        lockid = VICTIM_LOCKID if num == lock_count - 1 else f'{num:08x}'
+        statefiledata[lockid] = {
+            'user': f'benchuser{num}',
+            'locktype': 'disable' if num % 2 else 'nooperate',
+            'message': f'benchmark lock {num}',
+            'time_begin': expiry - 3600,
+            'time_expiry': expiry,
+        }
+    return statefiledata
+
+
+def _timed(setup, operation, repeat):
+    ''' Run setup then time operation, repeat times.  Returns the timings. '''
+    timings = []
+    for _num in range(repeat):
+        setup()
+        start = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_benchmarks(lock_counts=None, expired_fractions=None, repeat=DEFAULT_REPEAT,
+                   **statefile_options):
+    '''
+        Time each of OPERATIONS at each lock count and expired fraction
+        (except remove_lock with no locks).
+        statefile_options are passed to the statefile (backend, state_format, ...).
+        Returns the results structure that main() prints.
+    '''
+    if lock_counts is None:
+        lock_counts = DEFAULT_LOCK_COUNTS
+    if expired_fractions is None:
+        expired_fractions = DEFAULT_EXPIRED_FRACTIONS
+    workdir = tempfile.mkdtemp(prefix='puppetctl-bench.')
+    statefile_options = dict({'state_file': os.path.join(workdir, 'puppetctl.status'),
+                              'state_dir': os.path.join(workdir, 'puppetctl.d'),
+                              'state_db': os.path.join(workdir, 'puppetctl.sqlite')},
+                             **statefile_options)
+    statefile = BenchStatefile(**statefile_options)
+    runner = PuppetctlExecution(**statefile_options)
+    runner.statefile_object = statefile
+    results = []
+    try:
+        for lock_count in lock_counts:
+            for expired_fraction in expired_fractions:
+                seed = seed_state(lock_count, expired_fraction, int(time.time()))
+
+                def _reset(seed=seed):
+                    statefile.write_state_file(seed)
+                operations = {
+                    'add_lock': lambda: statefile.add_lock('benchnewuser', 'disable',
+                                                           int(time.time()) + 3600),
+                    'remove_lock': lambda: statefile.remove_lock(VICTIM_LOCKID),
+                    'purge_expired_locks': statefile.purge_expired_locks,
+                    '_get_lock_ids': lambda: statefile._get_lock_ids('disable'),
+                    'read_state_file': statefile.read_state_file,
+                    '_status_of_puppetctl': runner._status_of_puppetctl,
+                }
+                for name in OPERATIONS:
+                    if name == 'remove_lock' and not seed:
+                        # Nothing to remove.
+                        continue
+                    timings = _timed(_reset, operations[name], repeat)
+                    results.append({
+                        'operation': name,
+                        'locks': lock_count,
+                        'expired_fraction': expired_fraction,
+                        'repeat': repeat,
+                        'seconds': {'min': min(timings),
+                                    'median': statistics.median(timings),
+                                    'mean': statistics.mean(timings)},
+                    })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': int(time.time()),
+            'backend': statefile.backend,
+            'state_format': statefile.state_format,
+            'durability': statefile.durability,
+        },
+        'results': results,
+    }
+
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    '''
+        The results in current whose median is more than threshold times the
+        same measurement's in baseline, as (result, baseline median) pairs.
+        Measurements that only one of them has are ignored.
+    '''
+    def _key(result):
+        return (result['operation'], result['locks'], result['expired_fraction'])
+    baseline_medians = {_key(x): x['seconds']['median'] for x in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = baseline_medians.get(_key(result))
+        if before and result['seconds']['median'] > before * threshold:
+            regressions.append((result, before))
+    return regressions
+
+
+def main(argv=None):
+    ''' Run the benchmarks and print the results as JSON '''
+    parser = argparse.ArgumentParser(description='Benchmark the puppetctl statefile hot paths')
+    parser.add_argument('--locks', type=int, nargs='+', default=DEFAULT_LOCK_COUNTS,
+                        help='lock counts to measure')
+    parser.add_argument('--expired', type=float, nargs='+', default=DEFAULT_EXPIRED_FRACTIONS,
+                        help='fractions (0-1) of those locks that have expired')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='times to run each measurement')
+    parser.add_argument('--backend', default=None, help='statefile backend')
+    parser.add_argument('--state-format', default=None, help="state format, for 'file'")
+    parser.add_argument('--durability', default=None, help='statefile durability')
+    parser.add_argument('--output', default=None, help='write the JSON here, not to stdout')
+    parser.add_argument('--compare', default=None, metavar='BASELINE',
+                        help='exit 1 if any median is slower than in this earlier output')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='how many times slower counts as a regression')
+    args = parser.parse_args(argv)
+    statefile_options = {key: value for (key, value) in [('backend', args.backend),
+                                                         ('state_format', args.state_format),
+                                                         ('durability', args.durability)]
+                         if value is not None}
+    results = run_benchmarks(args.locks, args.expired, args.repeat, **statefile_options)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as outfile:
+            outfile.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as infile:
+            baseline = json.load(infile)
+        regressions = compare_results(baseline, results, args.threshold)
+        for (result, before) in regressions:
+            sys.stderr.write(f"{result['operation']} locks={result['locks']} "
+                             f"expired={result['expired_fraction']}: "
+                             f"{before:.6f}s -> {result['seconds']['median']:.6f}s\n")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,220 @@
+'''
+    A stress harness for concurrent lock changes: many processes, each its
+    own user, doing random disable / enable / nooperate / operate /
+    is-enabled through PuppetctlExecution against one statefile.
+
+        python -B -m bench.stress_locks --processes 16 --ops 200
+
+    It reports throughput and latency, and these correctness violations:
+      lost_locks       a lock a process had seen after its own change was gone
+                       the next time it looked, though only it touches its locks
+      duplicate_locks  more than one lock of a type for a user, in any look
+      bogus_resets     processes that found the state unreadable, and so
+                       reset it (each has its own bogus_state_file to tell)
+      crashed_workers  processes that died on an exception (its traceback is
+                       on stderr)
+    and exits 1 if there were any.
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import multiprocessing
+import queue as queue_module
+import shutil
+import statistics
+import tempfile
+from puppetctl import PuppetctlExecution
+from .bench_statefile import BenchStatefile
+
+OPERATIONS = ['disable', 'enable', 'nooperate', 'operate', 'is-enabled']
+DEFAULT_PROCESSES = 8
+DEFAULT_OPS = 100
+# Long enough that no lock expires during a run.
+LOCK_LIFETIME = 3600
+# How long everyone waits at the start for the slowest process to be ready.
+BARRIER_TIMEOUT = 60
+
+
+class StressExecution(PuppetctlExecution):
+    ''' An execution that may make changes as anyone, and keeps quiet about it '''
+
+    @staticmethod
+    def _allowed_to_run_command():
+        ''' Always allowed '''
+        return True
+
+    def log(self, message):
+        ''' No syslog '''
+
+    @staticmethod
+    def color_print(message, color=None):
+        ''' No output '''
+
+    def _puppet_processes_running(self, agent_catalog_run_lockfile=None):
+        ''' No puppet to look for '''
+        return {}
+
+
+def _observe(statefile, user, seen, violations):
+    '''
+        Look at user's locks.  Count any lock in 'seen' that has gone as lost,
+        and any second lock of a type as a duplicate.  Returns the lockids.
+    '''
+    locks = statefile.get_locks(user=user)
+    lockids = {x.lockid for x in locks}
+    violations['lost_locks'] += len(seen - lockids)
+    for locktype in statefile.statefile_locktypes:
+        violations['duplicate_locks'] += max(0, len([x for x in locks
+                                                     if x.locktype == locktype]) - 1)
+    return lockids
+
+
+def _worker(worker_num, options, barrier, queue):
+    ''' One process's share of the run.  Puts its latencies and findings on the queue. '''
+    user = f'stressuser{worker_num}'
+    os.environ['SUDO_USER'] = user
+    rng = random.Random(options['seed'] + worker_num)
+    runner = StressExecution(**options['statefile_options'])
+    statefile = BenchStatefile(**options['statefile_options'])
+    statefile.bogus_state_file = os.path.join(options['workdir'], f'bogus.{worker_num}')
+    runner.statefile_object = statefile
+    latencies = {x: [] for x in OPERATIONS}
+    violations = {'lost_locks': 0, 'duplicate_locks': 0}
+    exits = 0
+    seen = set()
+    sys.stdout = open(os.devnull, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+    barrier.wait()
+    for _num in range(options['ops']):
+        operation = rng.choice(OPERATIONS)
+        if operation != 'is-enabled':
+            # Nobody else changes our locks, so they should be as we last saw them.
+            _observe(statefile, user, seen, violations)
+            # Our own change may replace them, so what we see next is the new baseline.
+            seen = set()
+        expiry = int(time.time()) + LOCK_LIFETIME
+        start = time.perf_counter()
+        try:
+            if operation == 'disable':
+                runner.disable(force=False, expiry=expiry, message='stress')
+            elif operation == 'nooperate':
+                runner.nooperate(force=False, expiry=expiry, message='stress')
+            elif operation == 'enable':
+                runner.enable()
+            elif operation == 'operate':
+                runner.operate()
+            else:
+                runner.is_enabled()
+        except SystemExit as err:
+            # Refusals ("already disabled") and failures alike.
+            if err.code:
+                exits += 1
+        latencies[operation].append(time.perf_counter() - start)
+        seen = _observe(statefile, user, seen, violations)
+    _observe(statefile, user, seen, violations)
+    queue.put({'latencies': latencies, 'violations': violations, 'exits': exits,
+               'bogus_reset': os.path.exists(statefile.bogus_state_file)})
+
+
+def _percentile(values, fraction):
+    ''' The value at a fraction (0-1) of the way through the sorted values '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_stress(processes=DEFAULT_PROCESSES, ops=DEFAULT_OPS, seed=0, **statefile_options):
+    '''
+        Run the harness.  statefile_options are passed to the statefile
+        (backend, state_format, ...).  Returns the report that main() prints.
+    '''
+    if statefile_options.get('backend') == 'memory':
+        raise ValueError("the 'memory' backend can't be shared between processes")
+    workdir = tempfile.mkdtemp(prefix='puppetctl-stress.')
+    statefile_options = dict({'state_file': os.path.join(workdir, 'puppetctl.status'),
+                              'state_dir': os.path.join(workdir, 'puppetctl.d'),
+                              'state_db': os.path.join(workdir, 'puppetctl.sqlite')},
+                             **statefile_options)
+    options = {'statefile_options': statefile_options, 'workdir': workdir,
+               'ops': ops, 'seed': seed}
+    barrier = multiprocessing.Barrier(processes + 1, timeout=BARRIER_TIMEOUT)
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_worker, args=(num, options, barrier, queue))
+               for num in range(processes)]
+    try:
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time.perf_counter()
+        reports = []
+        crashed = 0
+        while len(reports) + crashed < processes:
+            try:
+                reports.append(queue.get(timeout=0.5))
+            except queue_module.Empty:
+                # A worker that died on an exception never reports; don't wait on it.
+                crashed = len([x for x in workers if x.exitcode])
+        elapsed = time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+        final = BenchStatefile(**statefile_options)
+        final_locks = final.get_locks()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    violations = {'lost_locks': sum(x['violations']['lost_locks'] for x in reports),
+                  'duplicate_locks': sum(x['violations']['duplicate_locks'] for x in reports),
+                  'bogus_resets': len([x for x in reports if x['bogus_reset']]),
+                  'crashed_workers': crashed}
+    pairs = [(x.user, x.locktype) for x in final_locks]
+    violations['duplicate_locks'] += len(pairs) - len(set(pairs))
+    latency = {}
+    all_latencies = []
+    for operation in OPERATIONS:
+        values = [y for x in reports for y in x['latencies'][operation]]
+        all_latencies.extend(values)
+        latency[operation] = {'count': len(values), 'p50': _percentile(values, 0.5),
+                              'p99': _percentile(values, 0.99)}
+    latency['all'] = {'count': len(all_latencies), 'p50': _percentile(all_latencies, 0.5),
+                      'p99': _percentile(all_latencies, 0.99),
+                      'mean': statistics.mean(all_latencies) if all_latencies else None}
+    return {
+        'meta': {'processes': processes, 'ops': ops, 'seed': seed,
+                 'backend': final.backend, 'state_format': final.state_format,
+                 'durability': final.durability},
+        'seconds': elapsed,
+        'ops_per_second': len(all_latencies) / elapsed if elapsed else None,
+        'refused_or_failed': sum(x['exits'] for x in reports),
+        'latency': latency,
+        'violations': violations,
+    }
+
+
+def main(argv=None):
+    ''' Run the harness and print the report as JSON '''
+    parser = argparse.ArgumentParser(description='Stress puppetctl lock changes from many '
+                                                 'processes at once')
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES,
+                        help='processes (users) to run at once')
+    parser.add_argument('--ops', type=int, default=DEFAULT_OPS,
+                        help='operations each process does')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--backend', default=None, help='statefile backend')
+    parser.add_argument('--state-format', default=None, help="state format, for 'file'")
+    parser.add_argument('--durability', default=None, help='statefile durability')
+    parser.add_argument('--lock-timeout', default=None, help='statefile lock timeout')
+    args = parser.parse_args(argv)
+    statefile_options = {key: value for (key, value) in [('backend', args.backend),
+                                                         ('state_format', args.state_format),
+                                                         ('durability', args.durability),
+                                                         ('lock_timeout', args.lock_timeout)]
+                         if value is not None}
+    report = run_stress(args.processes, args.ops, args.seed, **statefile_options)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 1 if any(report['violations'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
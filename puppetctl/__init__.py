@@ -6,8 +6,30 @@
     Those classes are listed here:
 '''
 
-from .statefile import PuppetctlStatefile
+import importlib
+from .statefile import PuppetctlStatefile, PuppetctlStatefileSession
+from .locktable import PuppetctlLock, PuppetctlLockTable
+from .backends import PuppetctlBackend, PuppetctlMemoryBackend
 from .execution import PuppetctlExecution
 from .clihandler import PuppetctlCLIHandler
 
-__all__ = ['PuppetctlStatefile', 'PuppetctlExecution', 'PuppetctlCLIHandler']
+# Only imported when asked for, since every puppetctl command imports this
+# package and few need them.
+_LAZY = {
+    'PuppetctlFleetSummary': 'fleet',
+    'PuppetctlFleetRuns': 'fleet',
+    'PuppetctlServer': 'server',
+}
+
+
+def __getattr__(name):
+    ''' The classes in _LAZY, imported on first use '''
+    if name not in _LAZY:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(importlib.import_module(f'.{_LAZY[name]}', __name__), name)
+
+
+__all__ = ['PuppetctlStatefile', 'PuppetctlStatefileSession', 'PuppetctlLock',
+           'PuppetctlLockTable', 'PuppetctlBackend', 'PuppetctlMemoryBackend',
+           'PuppetctlFleetSummary', 'PuppetctlFleetRuns', 'PuppetctlServer',
+           'PuppetctlExecution', 'PuppetctlCLIHandler']
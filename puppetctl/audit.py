@@ -0,0 +1,177 @@
+'''
+    The lock audit log: a line of JSON for each lock added, extended,
+    removed, expired or broken, appended by PuppetctlStatefile after each
+    successful write, and rotated by size.  'puppetctl lock-history' reads it.
+'''
+import os
+import json
+import fcntl
+import time
+from .statefile import DEFAULT_AUDIT_MAX_BYTES
+
+# Rotated logs kept (audit_log.1 is the newest) besides the live one.
+AUDIT_LOG_GENERATIONS = 4
+# Events that end a lock, and so give us its duration.
+ENDING_EVENTS = ['remove', 'expire', 'break']
+
+
+class PuppetctlAuditLog(object):
+    '''
+        An append-only log of lock events, one JSON object per line:
+
+            {"time": ..., "event": "add", "lockid": ..., "user": ..., "locktype": ...,
+             "message": ..., "time_begin": ..., "time_expiry": ...}
+
+        Appends hold an flock on the log, so writers that don't share the state
+        file lock (the directory and sqlite backends) neither interleave lines
+        nor rotate the log out from under each other.
+    '''
+
+    def __init__(self, audit_log, max_bytes=DEFAULT_AUDIT_MAX_BYTES):
+        ''' Init variables for PuppetctlAuditLog '''
+        self.audit_log = audit_log
+        self.max_bytes = int(max_bytes)
+        if self.max_bytes < 0:
+            raise ValueError('audit_max_bytes must be zero or more')
+
+    def generations(self):
+        ''' The log's files, oldest first.  Some may not exist. '''
+        return ([f'{self.audit_log}.{num}' for num in range(AUDIT_LOG_GENERATIONS, 0, -1)] +
+                [self.audit_log])
+
+    def _rotate(self):
+        ''' Private function.  Shift the rotated logs down one, and the live log to .1 '''
+        files = self.generations()
+        for (older, newer) in zip(files, files[1:]):
+            try:
+                os.rename(newer, older)
+            except FileNotFoundError:
+                pass
+
+    def _open_locked(self):
+        '''
+            Private function.  An fd on the live log, opened to append and
+            flocked.  Whoever held the lock before us may have rotated the file
+            we opened away; then we open the new one.
+        '''
+        while True:
+            audit_fd = os.open(self.audit_log, os.O_WRONLY | os.O_APPEND | os.O_CREAT |
+                               os.O_CLOEXEC, 0o644)
+            try:
+                fcntl.flock(audit_fd, fcntl.LOCK_EX)
+                if os.fstat(audit_fd).st_ino == os.stat(self.audit_log).st_ino:
+                    return audit_fd
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(audit_fd)
+                raise
+            os.close(audit_fd)
+
+    def append(self, records):
+        '''
+            Append records (dicts) to the log, rotating it first if they'd take
+            it past max_bytes.  Raises OSError if the log can't be written.
+        '''
+        if not records:
+            return
+        data = ''.join(json.dumps(x, sort_keys=True) + '\n' for x in records).encode('utf-8')
+        audit_fd = self._open_locked()
+        try:
+            size = os.fstat(audit_fd).st_size
+            if self.max_bytes and size and size + len(data) > self.max_bytes:
+                self._rotate()
+                os.close(audit_fd)
+                audit_fd = self._open_locked()
+            os.write(audit_fd, data)
+        finally:
+            os.close(audit_fd)
+
+    def read(self, since=None):
+        '''
+            Generate the records, oldest first, a line at a time across the
+            rotated logs.  Records from before 'since' are skipped, as are
+            lines a crash left half-written.
+        '''
+        for filename in self.generations():
+            try:
+                with open(filename, 'r', encoding='utf-8') as logfile:
+                    yield from self._records(logfile, since)
+            except FileNotFoundError:
+                continue
+
+    @staticmethod
+    def _records(logfile, since):
+        ''' Private function.  The records in one log file, as read() describes. '''
+        for line in logfile:
+            try:
+                record = json.loads(line)
+                if since is not None and record['time'] < since:
+                    continue
+            except (ValueError, KeyError, TypeError):
+                continue
+            yield record
+
+
+def audit_record(event, lockid, lockitem, now=None):
+    ''' The audit log record of an event about a lock (a state file lock dict) '''
+    record = {'time': int(time.time() if now is None else now), 'event': event,
+              'lockid': lockid}
+    for field in ['user', 'locktype', 'message', 'time_begin', 'time_expiry']:
+        record[field] = lockitem.get(field)
+    return record
+
+
+def _percentile(ordered, fraction):
+    ''' Nearest-rank percentile of sorted values; None if there are none '''
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def lock_history(records, since, until):
+    '''
+        Summarize the locks that ended between since and until, from a stream
+        of audit records, keeping only their durations in memory:
+
+            {'since': ..., 'until': ..., 'locks': how many ended,
+             'seconds': {locktype: time spent under locks of that type},
+             'expired': how many were left to expire rather than removed,
+             'expired_seconds': {locktype: time spent under those},
+             'duration_p50': ..., 'duration_p95': ...,
+             'users': {user: {'locks': ..., 'expired': ..., 'seconds': ...}}}
+
+        A lock ends when it is removed or broken, or at its expiry.  Time
+        before 'since' isn't counted.
+    '''
+    durations = []
+    summary = {'since': int(since), 'until': int(until), 'locks': 0, 'seconds': {},
+               'expired': 0, 'expired_seconds': {}, 'users': {}}
+    for record in records:
+        if record.get('event') not in ENDING_EVENTS:
+            continue
+        try:
+            end = record['time_expiry'] if record['event'] == 'expire' else record['time']
+            begin = record['time_begin']
+            (user, locktype) = (record['user'], record['locktype'])
+            if not since <= end <= until:
+                continue
+            seconds = max(0, end - max(begin, since))
+        except (KeyError, TypeError):
+            continue
+        durations.append(end - begin)
+        summary['locks'] += 1
+        summary['seconds'][locktype] = summary['seconds'].get(locktype, 0) + seconds
+        usersummary = summary['users'].setdefault(user, {'locks': 0, 'expired': 0,
+                                                         'seconds': 0})
+        usersummary['locks'] += 1
+        usersummary['seconds'] += seconds
+        if record['event'] == 'expire':
+            summary['expired'] += 1
+            usersummary['expired'] += 1
+            summary['expired_seconds'][locktype] = (summary['expired_seconds'].get(locktype, 0) +
+                                                    seconds)
+    durations.sort()
+    summary['duration_p50'] = _percentile(durations, 0.5)
+    summary['duration_p95'] = _percentile(durations, 0.95)
+    return summary
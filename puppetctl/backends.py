@@ -0,0 +1,806 @@
+'''
+    Where puppetctl keeps its locks.  PuppetctlStatefile talks to one backend;
+    the default, the state file itself, is PuppetctlFileBackend in statefile.py.
+'''
+import os
+import errno
+import json
+import tempfile
+import time
+# sqlite3, threading and inotify (ctypes) are imported by the backends and
+# watches that use them, so that a status check of the state file pays for
+# none of them.
+
+DEFAULT_STATE_DIR = '/var/lib/puppetctl.d'
+DEFAULT_STATE_DB = '/var/lib/puppetctl.sqlite'
+
+
+class PuppetctlBackend(object):
+    '''
+        The storage interface behind PuppetctlStatefile.  Backends store the
+        state structure (a dict of lock dicts, as the JSON state file has it)
+        and know nothing of sessions, expiry rules or who may write; the
+        statefile handles those.
+
+            load()                       the locks; may leave out expired ones.
+                                         None if there's no state to be had yet
+                                         (the statefile then resets it), and
+                                         ValueError if it's damaged.
+            commit(statefiledata, changes)
+                                         store statefiledata.  changes is how it
+                                         differs from what was loaded, as
+                                         (op, lockid, lock) tuples, or None to
+                                         replace everything.  True on success.
+            reset()                      remove all the locks.
+            summary()                    {locktype: whether there are unexpired
+                                         locks of it}, if that's cheaper than a
+                                         load; None if it isn't.
+            version()                    a token that changes when the locks do.
+            last_purged                  {lockid: lock} of expired locks the last
+                                         commit removed that load() had left
+                                         out, so the caller never saw them.
+            watch_paths()                (directory, names) whose entries change
+                                         when the locks do, for inotify; None
+                                         if there's nothing to watch.
+            watch(timeout)               wait for the locks to change.
+    '''
+    name = None
+    # Whether sessions serialize on the statefile's lock file.  Backends that
+    # settle races themselves don't need to.
+    uses_lock_file = False
+    # Whether only root may write (the backend lives in files root owns).
+    root_only = True
+
+    def __init__(self):
+        ''' Init variables for PuppetctlBackend '''
+        # Size of the last write, for backends that can tell.
+        self.last_write_bytes = 0
+        # Expired locks the last write removed on its own, for those that do.
+        self.last_purged = {}
+
+    def load(self):
+        ''' Read the locks into the state structure '''
+        raise NotImplementedError
+
+    def commit(self, statefiledata, changes=None):
+        ''' Store the locks.  Return True upon success. '''
+        raise NotImplementedError
+
+    def reset(self):
+        ''' Remove all the locks '''
+        return self.commit({}, None)
+
+    def summary(self):
+        ''' {locktype: whether there are unexpired locks of that type}, or None '''
+        return None
+
+    def version(self):
+        ''' A token that is different whenever the locks are '''
+        raise NotImplementedError
+
+    def watch_paths(self):
+        '''
+            (directory, names): the entries of directory (any, if names is
+            None) that change when the locks do.  None to poll instead.
+        '''
+        return None
+
+    def _inotify(self):
+        ''' Private function.  An inotify watch on watch_paths(), or None if we must poll. '''
+        paths = self.watch_paths()
+        if paths is None:
+            return None
+        from .inotify import PuppetctlInotify  # pylint: disable=import-outside-toplevel
+        try:
+            return PuppetctlInotify(*paths)
+        except OSError:
+            # Not Linux, out of watches, or nothing there to watch yet.
+            return None
+
+    def watch(self, timeout=None, interval=0.5, since=None):
+        '''
+            Wait until the locks may have changed from version since (from now,
+            if None).  Sleeps on inotify where it can, and otherwise polls
+            version() every interval seconds.  Returns True if they changed,
+            False if timeout seconds passed first.
+        '''
+        # Watch before taking the version, so that no change falls between them.
+        watcher = self._inotify()
+        try:
+            start_version = self.version() if since is None else since
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self.version() == start_version:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                if watcher is not None:
+                    watcher.wait(remaining)
+                else:
+                    time.sleep(interval if remaining is None else min(interval, remaining))
+            return True
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+
+class PuppetctlMemoryBackend(PuppetctlBackend):
+    '''
+        Keep the locks in memory, for embedding puppetctl and for tests.
+        Nothing touches the filesystem, anyone may write, and the locks last as
+        long as the object does.  Share one between PuppetctlStatefile objects
+        (pass it as their backend) and they see each other's changes; commits
+        are applied under a lock, so a change clashes rather than overwrites.
+    '''
+    name = 'memory'
+    root_only = False
+
+    def __init__(self, statefiledata=None):
+        ''' Init variables for PuppetctlMemoryBackend '''
+        super().__init__()
+        self.locks = {}
+        self._version = 0
+        import threading  # pylint: disable=import-outside-toplevel
+        self._changed = threading.Condition()
+        if statefiledata:
+            self.commit(statefiledata)
+
+    @staticmethod
+    def _copy(statefiledata):
+        ''' Private function.  A copy that shares no lock dicts. '''
+        return {lockid: dict(lockitem) for (lockid, lockitem) in statefiledata.items()}
+
+    def load(self):
+        ''' Read the locks into the state structure '''
+        with self._changed:
+            return self._copy(self.locks)
+
+    def commit(self, statefiledata, changes=None):
+        '''
+            Store the locks.  Given changes, apply just those, all or nothing:
+            False if an add clashes with someone else's lock.
+        '''
+        with self._changed:
+            if changes is None:
+                locks = self._copy(statefiledata)
+            else:
+                locks = dict(self.locks)
+                now = time.time()
+                for (operation, lockid, lockitem) in changes:
+                    if operation != 'add':
+                        locks.pop(lockid, None)
+                        continue
+                    if any(x['locktype'] == lockitem['locktype'] and
+                           x['user'] == lockitem['user'] and x['time_expiry'] >= now
+                           for x in locks.values()):
+                        return False
+                    locks[lockid] = dict(lockitem)
+            self.locks = locks
+            self._version += 1
+            self._changed.notify_all()
+        return True
+
+    def summary(self):
+        ''' {locktype: whether there are unexpired locks of that type} '''
+        now = time.time()
+        live = {}
+        with self._changed:
+            for lockitem in self.locks.values():
+                live[lockitem['locktype']] = (live.get(lockitem['locktype'], False) or
+                                              lockitem['time_expiry'] >= now)
+        return live
+
+    def version(self):
+        ''' A count of the commits '''
+        return self._version
+
+    def watch(self, timeout=None, interval=None, since=None):
+        '''
+            Wait for a commit after version since (after now, if None).  True if
+            there was one, False if timeout seconds passed first.
+        '''
+        with self._changed:
+            start_version = self._version if since is None else since
+            return self._changed.wait_for(lambda: self._version != start_version, timeout)
+
+
+class PuppetctlDirectoryBackend(PuppetctlBackend):
+    '''
+        Keep each lock as its own small file in a directory, with no global lock.
+        Everything a status check needs is in the filenames:
+
+            lock.<locktype>.<user>.<time_begin>.<time_expiry>.<lockid>
+                the lock itself, a JSON dict (which adds the message)
+            claim.<locktype>.<user>
+                a symlink to that user's lock of that type
+
+        A lock file is written under a temp name and link()ed into place, so it
+        appears whole or not at all.  The claim is made first with symlink(),
+        which fails if it exists: that is what keeps it to one lock of a type
+        per user when two writers race, since nothing else serializes them.
+        Removing a lock unlinks the lock file, then its claim.  A claim whose
+        lock is gone or expired is stale, and the next add of that type by
+        that user clears it.
+
+        A commit writes its new lock files before it unlinks any old ones, so
+        the locks never pass through none on the way: an extend, or a lock
+        its user replaces, writes the new file and moves the claim over to
+        it, and only then removes the old file.
+
+        Changes to different locks don't wait on each other, but a batch of
+        changes is applied one at a time rather than all-or-nothing.
+    '''
+    name = 'directory'
+
+    def __init__(self, state_dir=None, durability='directory'):
+        ''' Init variables for PuppetctlDirectoryBackend '''
+        super().__init__()
+        if state_dir is None:
+            state_dir = DEFAULT_STATE_DIR
+        self.state_dir = state_dir
+        self.durability = durability
+
+    @staticmethod
+    def _lock_name(lockid, lockitem):
+        ''' Private function.  The filename of a lock. '''
+        return '.'.join(['lock', lockitem['locktype'], lockitem['user'],
+                         str(int(lockitem['time_begin'])), str(int(lockitem['time_expiry'])),
+                         lockid])
+
+    @staticmethod
+    def _claim_name(locktype, user):
+        ''' Private function.  The filename of a claim. '''
+        return f'claim.{locktype}.{user}'
+
+    @staticmethod
+    def _parse_lock_name(filename):
+        '''
+            Private function.  (lockid, locktype, user, time_begin, time_expiry)
+            from a lock filename, or None if it isn't one.
+        '''
+        parts = filename.split('.')
+        if len(parts) != 6 or parts[0] != 'lock':
+            return None
+        try:
+            return (parts[5], parts[1], parts[2], int(parts[3]), int(parts[4]))
+        except ValueError:
+            return None
+
+    def _scan(self, leftovers=None):
+        '''
+            Private function.  {lockid: (filename, parsed name)} of the lock
+            files.  Two files of one lock are a writer that died between
+            writing the new file and removing the old: the one its claim
+            points at is the lock, and the other is added to leftovers.
+        '''
+        found = {}
+        try:
+            with os.scandir(self.state_dir) as entries:
+                for entry in entries:
+                    parsed = self._parse_lock_name(entry.name)
+                    if parsed is None:
+                        continue
+                    if parsed[0] in found:
+                        (keep, drop) = self._current_file(found[parsed[0]], (entry.name, parsed))
+                        found[parsed[0]] = keep
+                        if leftovers is not None:
+                            leftovers.append(drop)
+                    else:
+                        found[parsed[0]] = (entry.name, parsed)
+        except FileNotFoundError:
+            pass
+        return found
+
+    def _current_file(self, first, second):
+        ''' Private function.  (current, leftover) of two files of one lock. '''
+        (_lockid, locktype, user, _begin, _expiry) = first[1]
+        try:
+            target = os.readlink(os.path.join(self.state_dir, self._claim_name(locktype, user)))
+        except OSError:
+            target = None
+        return (second, first) if target == second[0] else (first, second)
+
+    def summary(self):
+        '''
+            {locktype: whether there are unexpired locks of that type}, from
+            the filenames alone.
+        '''
+        now = time.time()
+        live = {}
+        for (_filename, (_lockid, locktype, _user, _begin, expiry)) in self._scan().values():
+            live[locktype] = live.get(locktype, False) or expiry >= now
+        return live
+
+    def load(self):
+        ''' Read all the locks into the state structure (a dict of lock dicts) '''
+        statefiledata = {}
+        for (lockid, (filename, (_lockid, locktype, user, begin, expiry))) in self._scan().items():
+            try:
+                with open(os.path.join(self.state_dir, filename), 'r',
+                          encoding='utf-8') as lockfile:
+                    message = json.load(lockfile).get('message', '')
+            except (OSError, ValueError, AttributeError):
+                # Removed since the scan, or damaged.  The name is all we need,
+                # apart from the message.
+                if not os.path.exists(os.path.join(self.state_dir, filename)):
+                    continue
+                message = ''
+            statefiledata[lockid] = {'user': user, 'locktype': locktype, 'message': message,
+                                     'time_begin': begin, 'time_expiry': expiry}
+        return statefiledata
+
+    def version(self):
+        ''' The directory's mtime, which moves with every file made or removed '''
+        try:
+            statinfo = os.stat(self.state_dir)
+        except FileNotFoundError:
+            return None
+        return (statinfo.st_ino, statinfo.st_mtime_ns)
+
+    def watch_paths(self):
+        ''' The lock directory, or where it will be made if there's none yet '''
+        if os.path.isdir(self.state_dir):
+            return (self.state_dir, None)
+        (parent, name) = os.path.split(os.path.abspath(self.state_dir))
+        return (parent, [name])
+
+    def commit(self, statefiledata, changes=None):
+        '''
+            Apply (op, lockid, lock) changes, as sessions record them, or make
+            the directory hold exactly statefiledata if there are none.  Returns
+            True if they all took; False if an add lost a race for its claim.
+            Raises OSError if the directory can't be written.
+        '''
+        os.makedirs(self.state_dir, mode=0o755, exist_ok=True)
+        leftovers = []
+        existing = self._scan(leftovers)
+        # What each lock ends up as: its lock dict, or None if it goes.
+        if changes is None:
+            final = dict.fromkeys(existing)
+            final.update(statefiledata)
+        else:
+            final = {}
+            for (operation, lockid, lockitem) in changes:
+                final[lockid] = lockitem if operation == 'add' else None
+        # The old lock files to unlink, once their replacements are in place.
+        going = {lockid: existing[lockid] for (lockid, lockitem) in final.items()
+                 if lockid in existing and
+                 (lockitem is None or self._lock_name(lockid, lockitem) != existing[lockid][0])}
+        # Claims held by those, which a new lock of the same type and user takes over.
+        released = {(locktype, user)
+                    for (_filename, (_lockid, locktype, user, _begin, _expiry)) in going.values()}
+        result = True
+        # Adds first, then removes, so that a reader never sees the locks pass
+        # through none: not while a lock is extended, nor while one is
+        # replaced by another of its user's.
+        for (lockid, lockitem) in final.items():
+            if lockitem is None or (lockid in existing and lockid not in going):
+                continue
+            if lockid in going or (lockitem['locktype'], lockitem['user']) in released:
+                self._write_lock(lockid, lockitem, claim=False)
+            else:
+                result = self._write_lock(lockid, lockitem, claim=True) and result
+        for found in going.values():
+            # Leaves the claim alone if a new lock has taken it over.
+            self._remove(found)
+        for found in leftovers:
+            self._remove(found, keep_claim=True)
+        self._sync_dir()
+        return result if changes is not None else True
+
+    def _write_lock(self, lockid, lockitem, claim):
+        ''' Private function.  Claim (if asked) and publish one lock file. '''
+        lock_name = self._lock_name(lockid, lockitem)
+        claim_path = os.path.join(self.state_dir,
+                                  self._claim_name(lockitem['locktype'], lockitem['user']))
+        if claim and not self._make_claim(claim_path, lock_name):
+            return False
+        contents = dict(lockitem, lockid=lockid)
+        (tmp_fd, tmp_name) = tempfile.mkstemp(dir=self.state_dir, prefix='.tmp.')
+        try:
+            with os.fdopen(tmp_fd, 'w', encoding='utf-8') as lockfile:
+                json.dump(contents, lockfile, sort_keys=True)
+                lockfile.flush()
+                if self.durability != 'none':
+                    os.fsync(lockfile.fileno())
+                os.fchmod(lockfile.fileno(), 0o644)
+            os.link(tmp_name, os.path.join(self.state_dir, lock_name))
+        finally:
+            os.unlink(tmp_name)
+        if not claim:
+            # Point the claim here only once there's a lock file to point at.
+            self._replace_claim(claim_path, lock_name)
+        return True
+
+    def _make_claim(self, claim_path, lock_name):
+        ''' Private function.  Take a claim, clearing it first if stale.  False if we can't. '''
+        for _attempt in range(2):
+            try:
+                os.symlink(lock_name, claim_path)
+                return True
+            except FileExistsError:
+                pass
+            try:
+                target = os.readlink(claim_path)
+            except FileNotFoundError:
+                # It went away under us; try again.
+                continue
+            if not self._claim_is_stale(target):
+                return False
+            # Move it aside before deleting, so we delete only the stale claim
+            # we looked at, and not one somebody else just made.
+            aside = f'{claim_path}.stale.{os.getpid()}'
+            try:
+                os.rename(claim_path, aside)
+            except FileNotFoundError:
+                continue
+            if os.readlink(aside) != target:
+                try:
+                    os.link(aside, claim_path, follow_symlinks=False)
+                except FileExistsError:
+                    pass
+                os.unlink(aside)
+                return False
+            os.unlink(aside)
+        return False
+
+    def _claim_is_stale(self, target):
+        ''' Private function.  Whether a claim points at nothing live. '''
+        parsed = self._parse_lock_name(target)
+        if parsed is None or parsed[4] < time.time():
+            return True
+        return not os.path.exists(os.path.join(self.state_dir, target))
+
+    def _replace_claim(self, claim_path, lock_name):
+        ''' Private function.  Point an existing claim at a new lock file. '''
+        tmp_path = f'{claim_path}.new.{os.getpid()}'
+        os.symlink(lock_name, tmp_path)
+        os.rename(tmp_path, claim_path)
+
+    def _remove(self, found, keep_claim=False):
+        ''' Private function.  Unlink a lock file and (unless asked not to) its claim. '''
+        (filename, (_lockid, locktype, user, _begin, _expiry)) = found
+        try:
+            os.unlink(os.path.join(self.state_dir, filename))
+        except FileNotFoundError:
+            pass
+        if keep_claim:
+            return
+        claim_path = os.path.join(self.state_dir, self._claim_name(locktype, user))
+        try:
+            if os.readlink(claim_path) == filename:
+                os.unlink(claim_path)
+        except OSError as err:
+            if err.errno not in (errno.ENOENT, errno.EINVAL):  # pragma: no cover
+                raise
+
+    def _sync_dir(self):
+        ''' Private function.  fsync the directory, if the durability setting asks for it. '''
+        if self.durability == 'directory':
+            dir_fd = os.open(self.state_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+
+class PuppetctlSqliteBackend(PuppetctlBackend):
+    '''
+        Keep the locks in an SQLite database, one row per lock.  The database
+        runs in WAL mode, so readers never block the writer or each other, and
+        every change to it is one transaction.  The unique (locktype, user)
+        index is what keeps it to one lock of a type per user, even between
+        writers that don't otherwise wait on each other; the time_expiry index
+        lets status checks and loads skip expired locks in the query.
+        Expired rows are deleted by the next write, which leaves them in
+        last_purged, so that their expiry is audited like any other.
+
+        Only writers open the database read-write, and set it up.  Reads go
+        through a read-only connection, which non-root status checks can
+        open too.
+    '''
+    name = 'sqlite'
+    _SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS locks (
+               lockid TEXT PRIMARY KEY,
+               user TEXT NOT NULL,
+               locktype TEXT NOT NULL,
+               message TEXT NOT NULL,
+               time_begin INTEGER NOT NULL,
+               time_expiry INTEGER NOT NULL)''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS locks_by_type_user ON locks (locktype, user)',
+        'CREATE INDEX IF NOT EXISTS locks_by_expiry ON locks (time_expiry)',
+    ]
+    _COLUMNS = 'lockid, user, locktype, message, time_begin, time_expiry'
+    # How hard each commit is pushed to disk, by our durability levels.
+    _SYNCHRONOUS = {'none': 'OFF', 'file': 'NORMAL', 'directory': 'FULL'}
+    # How many times a reader who can't use the write-ahead log tries to read
+    # the database file while writers keep changing it.
+    READ_ATTEMPTS = 3
+
+    def __init__(self, state_db=None, durability='directory', lock_timeout=10.0):
+        ''' Init variables for PuppetctlSqliteBackend '''
+        super().__init__()
+        if state_db is None:
+            state_db = DEFAULT_STATE_DB
+        self.state_db = state_db
+        self.durability = durability
+        # How long sqlite waits on another writer before giving up.
+        self.lock_timeout = lock_timeout
+        self._connection = None
+        self._reader = None
+        self._schema_ready = False
+
+    def _connect(self):
+        '''
+            Private function.  The connection we write through, opened (and
+            the database made, if need be) on first use.  Only a writer opens
+            one, since setting it up writes to the database.
+        '''
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        if self._connection is None:
+            self._create()
+            # We run our own transactions, hence isolation_level=None.
+            self._connection = sqlite3.connect(self.state_db, timeout=self.lock_timeout,
+                                               isolation_level=None)
+            self._connection.execute(
+                f'PRAGMA synchronous={self._SYNCHRONOUS[self.durability]}')
+        if not self._schema_ready:
+            # A reader may have found the database before its schema, so
+            # this is checked on every first write, not only when we make it.
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self._SCHEMA:
+                self._connection.execute(statement)
+            self._schema_ready = True
+        return self._connection
+
+    def _create(self):
+        '''
+            Private function.  Make the database file, if there isn't one, so
+            that non-root users can read it for status checks.  One that's
+            already there keeps whatever mode it was given.
+        '''
+        try:
+            db_fd = os.open(self.state_db, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC,
+                            0o644)
+        except FileExistsError:
+            return
+        try:
+            # Whatever our umask.
+            os.fchmod(db_fd, 0o644)
+        finally:
+            os.close(db_fd)
+
+    def _begin(self, connection):
+        '''
+            Private function.  Start a write transaction.  IMMEDIATE takes the
+            write lock up front, rather than failing partway through if
+            another writer got in first.  Raises TimeoutError, as a wait on
+            the state file lock does, if another writer keeps it past
+            lock_timeout.
+        '''
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as err:
+            if 'locked' not in str(err) and 'busy' not in str(err):
+                raise
+            raise TimeoutError(f'Timed out after {self.lock_timeout:.1f}s waiting for '
+                               f'the database lock {self.state_db}') from err
+
+    def _read_connection(self, immutable=False):
+        '''
+            Private function.  A read-only connection, which those who can't
+            write the database can open too.  immutable ones are opened
+            afresh, the others kept.
+        '''
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        # The characters that mean something in a URI's path.
+        path = self.state_db.replace('%', '%25').replace('?', '%3f').replace('#', '%23')
+        if immutable:
+            return sqlite3.connect(f'file:{path}?mode=ro&immutable=1', uri=True,
+                                   isolation_level=None)
+        if self._reader is None:
+            self._reader = sqlite3.connect(f'file:{path}?mode=ro', uri=True,
+                                           timeout=self.lock_timeout, isolation_level=None)
+        return self._reader
+
+    def _select(self, query, parameters):
+        '''
+            Private function.  The rows of a read-only query, or none if there's
+            no database yet, or its first writer hasn't made the table yet.
+            Raises OSError if the database can't be read.
+        '''
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        if self._connection is not None:
+            # A writer reads through the connection it writes through.
+            return self._query(self._connection, query, parameters)
+        if not os.path.exists(self.state_db):
+            return []
+        for _attempt in range(self.READ_ATTEMPTS):
+            try:
+                return self._query(self._read_connection(), query, parameters)
+            except sqlite3.OperationalError as err:
+                self._close_reader()
+                if os.path.exists(f'{self.state_db}-wal'):
+                    # sqlite reads a write-ahead log even without write access
+                    # to its index, so this is something worse.
+                    raise OSError(errno.EACCES, f'cannot read the database: {err}',
+                                  self.state_db) from err
+            # Without a log, sqlite still wants to make the log's index to
+            # read the database, and those who can't write beside it can't.
+            # But everything is in the database file then, so read that as it
+            # stands, and believe it if no writer changed it while we did.
+            before = self.version()
+            try:
+                connection = self._read_connection(immutable=True)
+                try:
+                    rows = self._query(connection, query, parameters)
+                finally:
+                    connection.close()
+            except sqlite3.OperationalError as err:
+                raise OSError(errno.EACCES, f'cannot read the database: {err}',
+                              self.state_db) from err
+            if self.version() == before:
+                return rows
+        raise OSError(errno.EAGAIN, 'the database kept changing while we read it',
+                      self.state_db)
+
+    def _query(self, connection, query, parameters):
+        '''
+            Private function.  The rows of a query, or none if the table
+            hasn't been made yet.
+        '''
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        try:
+            return connection.execute(query, parameters).fetchall()
+        except sqlite3.OperationalError:
+            if self._schema_ready or self._has_table(connection):
+                raise
+            return []
+
+    @staticmethod
+    def _has_table(connection):
+        ''' Private function.  Whether the locks table exists yet. '''
+        return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                  "AND name = 'locks'").fetchone() is not None
+
+    def _close_reader(self):
+        ''' Private function.  Close the read-only connection, if there is one. '''
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def close(self):
+        ''' Close the database connections, if there are any '''
+        self._close_reader()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+            self._schema_ready = False
+
+    def summary(self):
+        '''
+            {locktype: whether there are unexpired locks of that type}, from an
+            index lookup.
+        '''
+        rows = self._select('SELECT DISTINCT locktype FROM locks WHERE time_expiry >= ?',
+                            (time.time(),))
+        return {locktype: True for (locktype,) in rows}
+
+    def load(self):
+        ''' Read the unexpired locks into the state structure (a dict of lock dicts) '''
+        return self._locks(self._select(f'SELECT {self._COLUMNS} FROM locks '
+                                        'WHERE time_expiry >= ?', (time.time(),)))
+
+    @staticmethod
+    def _locks(rows):
+        ''' Private function.  The state structure of rows of _COLUMNS. '''
+        return {lockid: {'user': user, 'locktype': locktype, 'message': message,
+                         'time_begin': begin, 'time_expiry': expiry}
+                for (lockid, user, locktype, message, begin, expiry) in rows}
+
+    def commit(self, statefiledata, changes=None):
+        '''
+            Apply (op, lockid, lock) changes, as sessions record them, in one
+            transaction, or make the database hold exactly statefiledata if
+            there are none.  Returns True if they took; False, having changed
+            nothing, if an add clashed with a lock someone else just added.
+        '''
+        if changes is None:
+            return self._transaction([('add', lockid, lockitem)
+                                      for (lockid, lockitem) in statefiledata.items()],
+                                     replace=True)
+        return self._transaction(changes, replace=False)
+
+    def version(self):
+        '''
+            The database and its write-ahead log's sizes and mtimes.  Commits
+            land in the log first, and checkpoints move them to the database.
+        '''
+        version = []
+        for filename in [self.state_db, f'{self.state_db}-wal']:
+            try:
+                statinfo = os.stat(filename)
+                version.append((statinfo.st_ino, statinfo.st_mtime_ns, statinfo.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def watch_paths(self):
+        ''' The database and its write-ahead log '''
+        (parent, name) = os.path.split(os.path.abspath(self.state_db))
+        return (parent, [name, f'{name}-wal'])
+
+    def import_state(self, statefiledata):
+        '''
+            Add the unexpired locks from a state structure (as a state file
+            holds) alongside what's here, skipping any that clash with a lock
+            we already have.  Returns how many were added.
+        '''
+        connection = self._connect()
+        now = time.time()
+        self.last_purged = {}
+        self._begin(connection)
+        try:
+            purged = self._purge(connection, now)
+            before = connection.total_changes
+            connection.executemany(
+                '''INSERT OR IGNORE INTO locks
+                       (lockid, user, locktype, message, time_begin, time_expiry)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                [self._row(lockid, lockitem) for (lockid, lockitem) in statefiledata.items()
+                 if lockitem['time_expiry'] >= now])
+            imported = connection.total_changes - before
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self.last_purged = purged
+        return imported
+
+    @staticmethod
+    def _row(lockid, lockitem):
+        ''' Private function.  The row values of a lock. '''
+        return (lockid, lockitem['user'], lockitem['locktype'], lockitem.get('message', ''),
+                int(lockitem['time_begin']), int(lockitem['time_expiry']))
+
+    def _purge(self, connection, now):
+        '''
+            Private function.  Delete expired rows, within a transaction.
+            Returns them, as the state structure, to be audited once it commits.
+        '''
+        purged = self._locks(connection.execute(
+            f'SELECT {self._COLUMNS} FROM locks WHERE time_expiry < ?', (now,)).fetchall())
+        connection.execute('DELETE FROM locks WHERE time_expiry < ?', (now,))
+        return purged
+
+    def _transaction(self, changes, replace):
+        ''' Private function.  Apply changes (after emptying the table, if asked) together. '''
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        connection = self._connect()
+        self.last_purged = {}
+        self._begin(connection)
+        try:
+            # The expired rows go either way.
+            purged = self._purge(connection, time.time())
+            if replace:
+                connection.execute('DELETE FROM locks')
+            for (operation, lockid, lockitem) in changes:
+                if operation == 'add':
+                    connection.execute(
+                        '''INSERT INTO locks
+                               (lockid, user, locktype, message, time_begin, time_expiry)
+                           VALUES (?, ?, ?, ?, ?, ?)''', self._row(lockid, lockitem))
+                else:
+                    connection.execute('DELETE FROM locks WHERE lockid = ?', (lockid,))
+            connection.execute('COMMIT')
+        except sqlite3.IntegrityError:
+            connection.execute('ROLLBACK')
+            return False
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self.last_purged = purged
+        return True
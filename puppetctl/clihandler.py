@@ -7,7 +7,10 @@ import time
 import argparse
 import configparser
 import textwrap
+import json
 from .execution import PuppetctlExecution
+from .statefile import DEFAULT_STATE_FILE
+from .stateformats import STATE_FORMATS
 
 
 class PuppetctlCLIHandler(object):
@@ -31,8 +34,11 @@ class PuppetctlCLIHandler(object):
     def _ingest_config_file(cfilename):
         ''' Given a config file pointer, read out the parameters we care about. '''
         acceptable_options = {
-            'puppet': ['puppet_bin_path', 'lastrunfile', 'agent_catalog_run_lockfile'],
-            'puppetctl': ['state_file'],
+            'puppet': ['puppet_bin_path', 'lastrunfile', 'agent_catalog_run_lockfile',
+                       'lastrun_parser', 'lastrun_cache'],
+            'puppetctl': ['state_file', 'durability', 'lock_timeout', 'state_format',
+                          'journal_max_bytes', 'backend', 'state_dir', 'state_db',
+                          'audit_log', 'audit_max_bytes', 'state_backups', 'serve_socket'],
         }
         returndict = {}
         if cfilename:
@@ -64,6 +70,12 @@ class PuppetctlCLIHandler(object):
                status           Status of the latest puppet run, and puppetctl
                lock-status      Status of puppetctl
                motd-status      Status of puppetctl (quiet if there are no locks)
+               export-state     Dump the puppetctl locks as readable JSON, or in a state_format
+               watch            Print lock changes as they happen
+               lock-history     Summarize past locks from the audit log
+               serve            Answer status queries from memory, over a Unix socket
+               fleet-locks      Summarize the locks in state files collected from many hosts
+               fleet-runs       Summarize puppet runs from summaries collected from many hosts
             Routine commands, requires root:
                enable           Enable puppet runs
                disable          Disable future puppet runs
@@ -71,6 +83,9 @@ class PuppetctlCLIHandler(object):
                nooperate        Have puppet operate in noop mode
                run              Puppet agent run
                cron-run         Puppet agent run, with no output
+               apply-locks      Apply a batch of lock changes (JSON on stdin) at once
+               import-state     Copy the locks from a state file into the sqlite backend
+               gc               Purge expired locks from the state file
             Emergency commands, requires root:
                break-all-locks  Removes all locks, even ones that do not belong to you
                panic-stop       Kills any active puppet run, disables puppet for {disable_time}''')
@@ -94,7 +109,10 @@ class PuppetctlCLIHandler(object):
         parser.add_argument('command', help='puppetctl command to run',
                             choices=['help', 'is-enabled', 'is-operating', 'enable', 'disable',
                                      'operate', 'nooperate', 'run', 'cron-run', 'lock-status',
-                                     'status', 'motd-status', 'break-all-locks', 'panic-stop'])
+                                     'status', 'motd-status', 'export-state', 'watch',
+                                     'lock-history', 'serve', 'fleet-locks', 'fleet-runs',
+                                     'apply-locks', 'import-state', 'gc',
+                                     'break-all-locks', 'panic-stop'])
         # If we got nothing but argv[0] then bail out:
         if len(argv) < 2:
             parser.print_help()
@@ -289,6 +307,52 @@ class PuppetctlCLIHandler(object):
             sys.exit(1)
         self.runner.nooperate(force=args.force, expiry=expiry, message=args.message)
 
+    def subcommand_apply_locks(self, ctlcmd, subcmd, argv):
+        ''' Apply a batch of lock changes, read as JSON from stdin, all at once '''
+        description = textwrap.dedent('''\
+            Apply a batch of lock changes all at once: either every change is
+            written, or none are.  Reads a JSON list of operations on stdin:
+
+              [{"op": "remove", "locktype": "nooperate"},
+               {"op": "add", "locktype": "disable", "expiry": 1700000000,
+                "message": "deploying"},
+               {"op": "extend", "lockid": "868f437e", "expiry": 1700003600},
+               {"op": "add", "user": "svcdeploy", "locktype": "disable",
+                "expiry": 1700000000}]
+
+            expiry is in epoch seconds.  remove and extend take a lockid, or a
+            locktype for that user's lock; user defaults to you.  Prints the
+            lockids of the added locks as JSON.''')
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         formatter_class=argparse.RawDescriptionHelpFormatter,
+                                         description=description)
+        parser.parse_args(argv)
+        try:
+            operations = json.load(sys.stdin)
+        except ValueError as err:
+            parser.error(f'stdin is not valid JSON: {err}')
+        self.runner.apply_locks(operations)
+
+    def subcommand_import_state(self, ctlcmd, subcmd, argv):
+        ''' Copy the locks from a state file into the sqlite backend '''
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         description=('Copy the unexpired locks from a state '
+                                                      "file into the 'sqlite' backend, keeping "
+                                                      'any locks it already has'))
+        parser.add_argument('source', nargs='?', default=DEFAULT_STATE_FILE,
+                            help=f'state file to copy from (default {DEFAULT_STATE_FILE})')
+        args = parser.parse_args(argv)
+        self.runner.import_state(args.source)
+
+    def subcommand_gc(self, ctlcmd, subcmd, argv):
+        ''' Purge expired locks '''
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         description=('Purge expired locks from the state file.  '
+                                                      'Other commands only hide them, unless '
+                                                      'they change the locks anyway'))
+        parser.parse_args(argv)
+        self.runner.gc()
+
     def subcommand_run(self, _ctlcmd, _subcmd, argv):
         ''' Tell puppet to run.  Pass along all arguments as params to puppet agent. '''
         self.runner.run(argv)
@@ -315,6 +379,123 @@ class PuppetctlCLIHandler(object):
         ''' Provide a motd-ready form of the puppetctl lock state '''
         self.runner.motd_status()
 
+    def subcommand_export_state(self, ctlcmd, subcmd, argv):
+        ''' Dump the puppetctl lock state in a readable form '''
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         description=('Print the puppetctl locks, whichever '
+                                                      'format the state file is kept in'))
+        parser.add_argument('--format', choices=STATE_FORMATS, default='json',
+                            help=('print the locks in this state_format (default: json); '
+                                  'binary is printed as raw bytes, for another state file'))
+        parser.add_argument('--json', action='store_const', dest='format', const='json',
+                            help='print the locks as readable JSON; the same as --format json')
+        args = parser.parse_args(argv)
+        self.runner.export_state(state_format=args.format)
+
+    def subcommand_watch(self, ctlcmd, subcmd, argv):
+        ''' Print lock changes as they happen '''
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         description=('Print puppetctl locks as they are added, '
+                                                      'removed or expire, until interrupted'))
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='print each change as a line of JSON')
+        parser.add_argument('--timeout', type=float, default=None,
+                            help='stop after this many seconds')
+        args = parser.parse_args(argv)
+        self.runner.watch(as_json=args.json, timeout=args.timeout)
+
+    def subcommand_serve(self, ctlcmd, subcmd, argv):
+        ''' Answer status queries over a Unix socket '''
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         description=('Keep the locks and the last run summary '
+                                                      'in memory, and answer is-enabled, '
+                                                      'is-operating, lock-status and status '
+                                                      'over a Unix socket, until interrupted.  '
+                                                      'Those commands ask it first, when it is '
+                                                      'running'))
+        parser.add_argument('--socket', default=None,
+                            help='the socket to listen on (default: serve_socket from the '
+                                 'config file, or /run/puppetctl.sock)')
+        parser.add_argument('--timeout', type=float, default=None,
+                            help='stop after this many seconds')
+        args = parser.parse_args(argv)
+        self.runner.serve(socket_path=args.socket, timeout=args.timeout)
+
+    def subcommand_lock_history(self, ctlcmd, subcmd, argv):
+        ''' Summarize past locks from the audit log '''
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         description=('Summarize the locks that ended recently, '
+                                                      'from the audit log: how many, for how '
+                                                      'long, and how many were left to expire'))
+        parser.add_argument('--days', type=int, default=30,
+                            help='how many days back to look (default 30)')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='print the summary as JSON')
+        args = parser.parse_args(argv)
+        if args.days < 1:
+            parser.error('--days must be 1 or more')
+        self.runner.lock_history(days=args.days, as_json=args.json)
+
+    def subcommand_fleet_locks(self, ctlcmd, subcmd, argv):
+        ''' Summarize the locks in state files collected from many hosts '''
+        # pylint: disable=import-outside-toplevel
+        from .fleet import DEFAULT_FLEET_PATTERN, DEFAULT_SOON_SECONDS, DEFAULT_TOP
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         description=('Summarize the locks in a tree of state '
+                                                      'files collected from many hosts, one '
+                                                      'directory per host.  The files are only '
+                                                      'read, never reset'))
+        parser.add_argument('directory', help='the tree of state files')
+        parser.add_argument('--pattern', default=DEFAULT_FLEET_PATTERN,
+                            help=f'state file names to look for (default {DEFAULT_FLEET_PATTERN})')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='processes to read files with (default: one per CPU)')
+        parser.add_argument('--soon', type=float, default=DEFAULT_SOON_SECONDS/3600,
+                            help='hours within which a lock counts as expiring soon (default 24)')
+        parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+                            help=f'how many locks to list of each kind (default {DEFAULT_TOP})')
+        parser.add_argument('--hosts', action='store_true', default=False,
+                            help="also print each host's locks as it is read")
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='print as JSON')
+        args = parser.parse_args(argv)
+        if args.processes is not None and args.processes < 1:
+            parser.error('--processes must be 1 or more')
+        if args.top < 0:
+            parser.error('--top must be 0 or more')
+        self.runner.fleet_locks(args.directory, as_json=args.json, processes=args.processes,
+                                pattern=args.pattern, soon=int(args.soon*3600), top=args.top,
+                                hosts=args.hosts)
+
+    def subcommand_fleet_runs(self, ctlcmd, subcmd, argv):
+        ''' Summarize puppet runs from summaries collected from many hosts '''
+        # pylint: disable=import-outside-toplevel
+        from .fleet import DEFAULT_RUNS_PATTERN, DEFAULT_STALE_SECONDS, DEFAULT_TOP
+        parser = argparse.ArgumentParser(prog=f'{ctlcmd} {subcmd}',
+                                         description=('Summarize a tree of last_run_summary.yaml '
+                                                      'files collected from many hosts, one '
+                                                      'directory per host: run ages and times, '
+                                                      'stragglers, failures and config versions'))
+        parser.add_argument('directory', help='the tree of run summaries')
+        parser.add_argument('--pattern', default=DEFAULT_RUNS_PATTERN,
+                            help=f'summary file names to look for (default {DEFAULT_RUNS_PATTERN})')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='processes to read files with (default: one per CPU)')
+        parser.add_argument('--stale', type=float, default=DEFAULT_STALE_SECONDS/3600,
+                            help=('hours since its last run after which a host is a straggler '
+                                  f'(default {DEFAULT_STALE_SECONDS//3600})'))
+        parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+                            help=f'how many hosts to list of each kind (default {DEFAULT_TOP})')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='print as JSON')
+        args = parser.parse_args(argv)
+        if args.processes is not None and args.processes < 1:
+            parser.error('--processes must be 1 or more')
+        if args.top < 0:
+            parser.error('--top must be 0 or more')
+        self.runner.fleet_runs(args.directory, as_json=args.json, processes=args.processes,
+                               pattern=args.pattern, stale=int(args.stale*3600), top=args.top)
+
     def subcommand_break_all_locks(self, ctlcmd, subcmd, argv):
         ''' Forcibly remove all locks on a host '''
         description = textwrap.dedent('''\
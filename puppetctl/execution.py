@@ -5,16 +5,29 @@
 import sys
 import os
 import time
+import contextlib
 import subprocess
 import signal
 import syslog
+import json
 from .statefile import PuppetctlStatefile
+from .stateformats import humanize_lock, encode_state
+from .lastrun import (read_last_run_summary, last_run_record, summary_cache_key,
+                      read_cached_record, write_cached_record)
+# audit, server and fleet (and what they import: sockets, ctypes, process
+# pools) are only imported by the commands that use them, so that the status
+# commands, run on every login and by monitoring, don't pay to start them up.
 
 DEFAULT_PUPPET_BIN_PATH = '/opt/puppetlabs/puppet/bin'
 # puppet 7 moved the location of last_run_summary
 # https://puppet.com/docs/puppet/7/release_notes_puppet.html#new_features_puppet_7-0-0-pup-10627
 DEFAULT_LASTRUNFILE = '/opt/puppetlabs/puppet/public/last_run_summary.yaml'
 DEFAULT_AGENT_CATALOG_RUN_LOCKFILE = '/opt/puppetlabs/puppet/cache/state/agent_catalog_run.lock'
+# How we read the lastrunfile: 'native' parses it ourselves, 'ruby' asks puppet's ruby.
+LASTRUN_PARSERS = ['native', 'ruby']
+DEFAULT_LASTRUN_PARSER = 'native'
+# Where 'puppetctl serve' listens, and the status commands ask it first:
+DEFAULT_SERVE_SOCKET = '/run/puppetctl.sock'
 
 
 class PuppetctlExecution(object):
@@ -23,13 +36,22 @@ class PuppetctlExecution(object):
     def __init__(self, state_file=None,
                  puppet_bin_path=None,
                  lastrunfile=None,
-                 agent_catalog_run_lockfile=None):
-        ''' Set basic parameters for executing '''
+                 agent_catalog_run_lockfile=None,
+                 lastrun_parser=None,
+                 lastrun_cache=None,
+                 serve_socket=None,
+                 **statefile_options):
+        '''
+            Set basic parameters for executing.  Any other keyword arguments
+            (durability, and so on) are settings for the PuppetctlStatefile.
+        '''
         default_lastrunfile = DEFAULT_LASTRUNFILE
         self.defaults = {
             'puppet_bin_path': DEFAULT_PUPPET_BIN_PATH,
             'lastrunfile': default_lastrunfile,
             'agent_catalog_run_lockfile': DEFAULT_AGENT_CATALOG_RUN_LOCKFILE,
+            'lastrun_parser': DEFAULT_LASTRUN_PARSER,
+            'serve_socket': DEFAULT_SERVE_SOCKET,
         }
         # don't check state_file, it's not ours to manage.  pass it along.
         if puppet_bin_path is None:
@@ -38,6 +60,12 @@ class PuppetctlExecution(object):
             lastrunfile = self.defaults.get('lastrunfile')
         if agent_catalog_run_lockfile is None:
             agent_catalog_run_lockfile = self.defaults.get('agent_catalog_run_lockfile')
+        if serve_socket is None:
+            serve_socket = self.defaults.get('serve_socket')
+        if lastrun_parser is None:
+            lastrun_parser = self.defaults.get('lastrun_parser')
+        if lastrun_parser not in LASTRUN_PARSERS:
+            raise ValueError(f"lastrun_parser must be one of {', '.join(LASTRUN_PARSERS)}")
         pathitems = puppet_bin_path.split(':')
         for added_path in ['/bin', '/usr/bin']:
             if added_path not in pathitems:
@@ -45,6 +73,14 @@ class PuppetctlExecution(object):
         self.puppet_bin_path = ':'.join(pathitems)
         self.lastrunfile = lastrunfile
         self.agent_catalog_run_lockfile = agent_catalog_run_lockfile
+        self.lastrun_parser = lastrun_parser
+        # Where to ask a 'puppetctl serve' before reading the files ourselves.
+        # An empty string never asks.
+        self.serve_socket = serve_socket
+        # Set once there's no server to be had, so we only try once.
+        self._server_gone = False
+        # The last lastrunfile record we had, as (lastrunfile, cache key, record).
+        self._lastrun_memo = None
         sudo_user = os.getenv('SUDO_USER')
         user = os.getenv('USER')
         if sudo_user:
@@ -72,7 +108,13 @@ class PuppetctlExecution(object):
         else:
             self.invoking_user = 'UNKNOWN'
         self.logging_tag = f'puppetctl[{self.invoking_user}]'
-        self.statefile_object = PuppetctlStatefile(state_file)
+        self.statefile_object = PuppetctlStatefile(state_file, **statefile_options)
+        # What we made of the lastrunfile is cached beside the state file,
+        # like the audit log.  An empty string turns it off.
+        if lastrun_cache is None:
+            lastrun_cache = (f'{self.statefile_object.state_file}.lastrun'
+                             if self.statefile_object.backend_object.root_only else '')
+        self.lastrun_cache = lastrun_cache
 
     @staticmethod
     # This is a very simple function; we stomp it in mock testing, and since
@@ -108,19 +150,68 @@ class PuppetctlExecution(object):
         self.log_print(message, color)
         sys.exit(2)
 
+    @contextlib.contextmanager
+    def _statefile_session(self, write=False):
+        '''
+            Open a session on the state file.  If we had to wait for someone else's
+            lock, or to recover a damaged state file, say so in syslog; if we gave
+            up waiting, tell the user and exit.
+        '''
+        try:
+            with self.statefile_object.session(write=write) as session:
+                if session.depth == 1 and session.lock_wait:
+                    self.log(f'Waited {session.lock_wait:.3f}s for the state file lock.')
+                if session.depth == 1 and session.recovery:
+                    self.log(session.recovery)
+                yield session
+        except TimeoutError as err:
+            self.error_print(str(err), '1;31')
+
+    def _ask_server(self, request):
+        '''
+            The reply of a 'puppetctl serve' on serve_socket to request, or
+            None if there's none to ask, when we read the files ourselves.
+        '''
+        if not self.serve_socket or self._server_gone:
+            return None
+        if not os.path.exists(self.serve_socket):
+            # No socket, no server: don't start up a client to find that out.
+            self._server_gone = True
+            return None
+        from .server import query_server, state_identity  # pylint: disable=import-outside-toplevel
+        reply = query_server(self.serve_socket, request, state_identity(self))
+        self._server_gone = reply is None
+        return reply
+
     def is_enabled(self, user=None):
         '''
             If no user, return True/False on whether any disabler locks exist on the system.
             If user, return True/False on whether any disabler locks exist by/for that user.
         '''
-        return len(self.statefile_object.get_disable_lock_ids(user)) == 0
+        if user is None:
+            reply = self._ask_server('is-enabled')
+            if reply is not None:
+                return reply['enabled']
+            summary = self.statefile_object.quick_lock_summary()
+            if summary is not None:
+                return not summary[self.statefile_object.flag_state_disable]
+        with self._statefile_session() as session:
+            return not session.has_locks(self.statefile_object.flag_state_disable, user)
 
     def is_operating(self, user=None):
         '''
             If no user, return True/False on whether any noop locks exist on the system.
             If user, return True/False on whether any noop locks exist by/for that user.
         '''
-        return len(self.statefile_object.get_noop_lock_ids(user)) == 0
+        if user is None:
+            reply = self._ask_server('is-operating')
+            if reply is not None:
+                return reply['operating']
+            summary = self.statefile_object.quick_lock_summary()
+            if summary is not None:
+                return not summary[self.statefile_object.flag_state_noop]
+        with self._statefile_session() as session:
+            return not session.has_locks(self.statefile_object.flag_state_noop, user)
 
     def _perform_run(self, puppet_agent_args):
         ''' Make the exec call to run puppet agent '''
@@ -171,41 +262,42 @@ class PuppetctlExecution(object):
         '''
         if not self._allowed_to_run_command():
             self.error_print("Must be root to run 'enable'.")
-        my_disables = self.statefile_object.get_disable_lock_ids(self.invoking_user)
-        my_noops = self.statefile_object.get_noop_lock_ids(self.invoking_user)
-        if my_disables:
-            if not self.statefile_object.remove_lock(my_disables):
-                self.error_print(('Unable to remove prior disable lock '
-                                  'before adding new one.'), '1;31')
-            if self.statefile_object.get_disable_lock_ids():
-                self.color_print((f'Puppet has been enabled for {self.invoking_user}, '
-                                  'but other users have puppet disabled.'))
+        with self._statefile_session(write=True) as session:
+            my_disables = session.get_disable_lock_ids(self.invoking_user)
+            my_noops = session.get_noop_lock_ids(self.invoking_user)
+            if my_disables:
+                if not session.remove_lock(my_disables) or not session.commit():
+                    self.error_print(('Unable to remove prior disable lock '
+                                      'before adding new one.'), '1;31')
+                if session.get_disable_lock_ids():
+                    self.color_print((f'Puppet has been enabled for {self.invoking_user}, '
+                                      'but other users have puppet disabled.'))
+                else:
+                    self.log_print("Puppet has been enabled.")
+            elif my_noops:
+                self.color_print(('Puppet is enabled, but is in nooperate mode.  '
+                                  "(hint: 'puppetctl operate' to change this)"))
             else:
-                self.log_print("Puppet has been enabled.")
-        elif my_noops:
-            self.color_print(('Puppet is enabled, but is in nooperate mode.  '
-                              "(hint: 'puppetctl operate' to change this)"))
-        else:
-            others_disables = self.statefile_object.get_disable_lock_ids()
-            others_noops = self.statefile_object.get_noop_lock_ids()
-            if others_disables:
-                root_disables = self.statefile_object.get_disable_lock_ids('root')
-                if others_disables == root_disables:
+                others_disables = session.get_disable_lock_ids()
+                others_noops = session.get_noop_lock_ids()
+                if others_disables:
+                    root_disables = session.get_disable_lock_ids('root')
+                    if others_disables == root_disables:
+                        self.color_print((f'Puppet is already enabled for {self.invoking_user}, '
+                                          'but root has puppet disabled.'))
+                        self.color_print(('This is an odd state caused by someone disabling '
+                                          'puppet from a login root shell.'))
+                        self.color_print('If this is your lock, `sudo su -` and run an enable.')
+                    else:
+                        self.color_print((f'Puppet is already enabled for {self.invoking_user}, '
+                                          'but other users have puppet disabled.'))
+                    self.lock_status()
+                elif others_noops:
                     self.color_print((f'Puppet is already enabled for {self.invoking_user}, '
-                                      'but root has puppet disabled.'))
-                    self.color_print(('This is an odd state caused by someone disabling puppet '
-                                      'from a login root shell.'))
-                    self.color_print('If this is your lock, `sudo su -` and run an enable.')
+                                      'but other users have puppet in noop mode.'))
+                    self.lock_status()
                 else:
-                    self.color_print((f'Puppet is already enabled for {self.invoking_user}, '
-                                      'but other users have puppet disabled.'))
-                self.lock_status()
-            elif others_noops:
-                self.color_print((f'Puppet is already enabled for {self.invoking_user}, '
-                                  'but other users have puppet in noop mode.'))
-                self.lock_status()
-            else:
-                self.color_print("Puppet is already enabled.")
+                    self.color_print("Puppet is already enabled.")
 
     def disable(self, force, expiry, message):
         '''
@@ -215,43 +307,37 @@ class PuppetctlExecution(object):
         '''
         if not self._allowed_to_run_command():
             self.error_print("Must be root to run 'disable'.")
-        my_disables = self.statefile_object.get_disable_lock_ids(self.invoking_user)
-        my_noops = self.statefile_object.get_noop_lock_ids(self.invoking_user)
-        if my_disables:
-            if force:
-                if not self.statefile_object.remove_lock(my_disables):
-                    self.error_print(('Unable to remove prior disable lock '
+        with self._statefile_session(write=True) as session:
+            my_disables = session.get_disable_lock_ids(self.invoking_user)
+            my_noops = session.get_noop_lock_ids(self.invoking_user)
+            if my_disables:
+                if force:
+                    if not session.remove_lock(my_disables):
+                        self.error_print(('Unable to remove prior disable lock '
+                                          'before adding new one.'), '1;31')
+                    # fallthrough
+                else:
+                    self.color_print('Puppet is already disabled.  (Add -f to override)')
+                    self.lock_status()
+                    sys.exit(1)
+            if my_noops:
+                # If we were in NOOP mode, disable is more important
+                # abort out of noop mode and go into lockdown.
+                if not session.remove_lock(my_noops):
+                    self.error_print(('Unable to remove prior noop lock '
                                       'before adding new one.'), '1;31')
                 # fallthrough
+            # The removals above and this add are written out together by the commit.
+            add = session.add_lock(user=self.invoking_user,
+                                   locktype=self.statefile_object.flag_state_disable,
+                                   expiry=expiry, message=message)
+            if add and session.commit():
+                self.log_print(session.get_lock_info(add), '1;31')
             else:
-                self.color_print('Puppet is already disabled.  (Add -f to override)')
-                self.lock_status()
-                sys.exit(1)
-        if my_noops:
-            # If we were in NOOP mode, disable is more important
-            # abort out of noop mode and go into lockdown.
-            if not self.statefile_object.remove_lock(my_noops):
-                self.error_print(('Unable to remove prior noop lock '
-                                  'before adding new one.'), '1;31')
-            # fallthrough
-        add = self.statefile_object.add_lock(user=self.invoking_user,
-                                             locktype=self.statefile_object.flag_state_disable,
-                                             expiry=expiry, message=message)
-        if add:
-            self.log_print(self.statefile_object.get_lock_info(add), '1;31')
-            # We added a lock, but that's not the same as our previous behavior, where we
-            # would only disable a host if puppet wasn't running...
-            pidmap = self._puppet_processes_running()
-            if pidmap:
-                proc = "A 'puppet agent' process is" if (len(pidmap) == 1) \
-                    else "Multiple 'puppet agent' processes are"
-                self.color_print(f'{proc} running:', '0;36')
-                for (pidstr, cmd) in pidmap.items():
-                    self.color_print(f'  {pidstr}  {cmd}', '0;36')
-                self.color_print('If you need to stop an active puppet run from finishing:', '0;33')
-                self.color_print('   puppetctl panic-stop --force', '0;33')
-        else:
-            self.error_print('Unable to add lock.  Refusing to disable puppet.', '1;31')
+                self.error_print('Unable to add lock.  Refusing to disable puppet.', '1;31')
+        # We added a lock, but that's not the same as our previous behavior, where we
+        # would only disable a host if puppet wasn't running...
+        self._warn_puppet_processes_running()
 
     def operate(self):
         '''
@@ -261,38 +347,41 @@ class PuppetctlExecution(object):
         '''
         if not self._allowed_to_run_command():
             self.error_print("Must be root to run 'operate'.")
-        my_disables = self.statefile_object.get_disable_lock_ids(self.invoking_user)
-        my_noops = self.statefile_object.get_noop_lock_ids(self.invoking_user)
-        if my_disables:
-            self.color_print(('Puppet is disabled  '
-                              "(hint: 'puppetctl enable' to change this)"))
-        elif my_noops:
-            if not self.statefile_object.remove_lock(my_noops):
-                self.error_print(('Unable to remove prior noop lock '
-                                  'before adding new one.'), '1;31')
-            self.log_print("Puppet is back in 'operate' mode.")
-        else:
-            others_disables = self.statefile_object.get_disable_lock_ids()
-            others_noops = self.statefile_object.get_noop_lock_ids()
-            if others_disables:
-                self.color_print(("Puppet is already in 'operate' mode for "
-                                  f'{self.invoking_user}, but other users have puppet disabled.'))
-                self.lock_status()
-            elif others_noops:
-                root_noops = self.statefile_object.get_noop_lock_ids('root')
-                if others_noops == root_noops:
-                    self.color_print(("Puppet is already in 'operate' mode for "
-                                      f'{self.invoking_user}, but root has puppet in noop mode.'))
-                    self.color_print(("This is an odd state caused by someone noop'ing puppet "
-                                      'from a login root shell.'))
-                    self.color_print('If this is your lock, `sudo su -` and run an operate.')
-                else:
+        with self._statefile_session(write=True) as session:
+            my_disables = session.get_disable_lock_ids(self.invoking_user)
+            my_noops = session.get_noop_lock_ids(self.invoking_user)
+            if my_disables:
+                self.color_print(('Puppet is disabled  '
+                                  "(hint: 'puppetctl enable' to change this)"))
+            elif my_noops:
+                if not session.remove_lock(my_noops) or not session.commit():
+                    self.error_print(('Unable to remove prior noop lock '
+                                      'before adding new one.'), '1;31')
+                self.log_print("Puppet is back in 'operate' mode.")
+            else:
+                others_disables = session.get_disable_lock_ids()
+                others_noops = session.get_noop_lock_ids()
+                if others_disables:
                     self.color_print(("Puppet is already in 'operate' mode for "
                                       f'{self.invoking_user}, but other users have '
-                                      'puppet in noop mode.'))
-                self.lock_status()
-            else:
-                self.color_print("Puppet is already in 'operate' mode.")
+                                      'puppet disabled.'))
+                    self.lock_status()
+                elif others_noops:
+                    root_noops = session.get_noop_lock_ids('root')
+                    if others_noops == root_noops:
+                        self.color_print(("Puppet is already in 'operate' mode for "
+                                          f'{self.invoking_user}, but root has puppet '
+                                          'in noop mode.'))
+                        self.color_print(("This is an odd state caused by someone noop'ing "
+                                          'puppet from a login root shell.'))
+                        self.color_print('If this is your lock, `sudo su -` and run an operate.')
+                    else:
+                        self.color_print(("Puppet is already in 'operate' mode for "
+                                          f'{self.invoking_user}, but other users have '
+                                          'puppet in noop mode.'))
+                    self.lock_status()
+                else:
+                    self.color_print("Puppet is already in 'operate' mode.")
 
 
     def nooperate(self, force, expiry, message):
@@ -303,44 +392,101 @@ class PuppetctlExecution(object):
         '''
         if not self._allowed_to_run_command():
             self.error_print("Must be root to run 'nooperate'.")
-        my_disables = self.statefile_object.get_disable_lock_ids(self.invoking_user)
-        my_noops = self.statefile_object.get_noop_lock_ids(self.invoking_user)
+        with self._statefile_session(write=True) as session:
+            my_disables = session.get_disable_lock_ids(self.invoking_user)
+            my_noops = session.get_noop_lock_ids(self.invoking_user)
 
-        if my_disables:
-            # Do not accept going into noop mode from a disabled state.  Force them to decide
-            # to enable (since any enable can cause SOME changes to happen)
-            self.color_print('Puppet is disabled. (You must be enabled to enter nooperate mode)')
-            self.lock_status()
-            sys.exit(2)
+            if my_disables:
+                # Do not accept going into noop mode from a disabled state.  Force them to
+                # decide to enable (since any enable can cause SOME changes to happen)
+                self.color_print('Puppet is disabled. (You must be enabled to enter '
+                                 'nooperate mode)')
+                self.lock_status()
+                sys.exit(2)
 
-        if my_noops:
-            if force:
-                if not self.statefile_object.remove_lock(my_noops):
-                    self.error_print(('Unable to remove prior noop lock '
-                                      'before adding new one.'), '1;31')
-                # fallthrough
+            if my_noops:
+                if force:
+                    if not session.remove_lock(my_noops):
+                        self.error_print(('Unable to remove prior noop lock '
+                                          'before adding new one.'), '1;31')
+                    # fallthrough
+                else:
+                    self.color_print('Puppet is already in nooperate mode.  (Add -f to override)')
+                    self.lock_status()
+                    sys.exit(1)
+            add = session.add_lock(user=self.invoking_user,
+                                   locktype=self.statefile_object.flag_state_noop,
+                                   expiry=expiry, message=message)
+            if add and session.commit():
+                self.log_print(session.get_lock_info(add), '1;31')
             else:
-                self.color_print('Puppet is already in nooperate mode.  (Add -f to override)')
-                self.lock_status()
-                sys.exit(1)
-        add = self.statefile_object.add_lock(user=self.invoking_user,
-                                             locktype=self.statefile_object.flag_state_noop,
-                                             expiry=expiry, message=message)
-        if add:
-            self.log_print(self.statefile_object.get_lock_info(add), '1;31')
-            # We added a lock, but that's not the same as our previous behavior, where we
-            # would only disable a host if puppet wasn't running...
-            pidmap = self._puppet_processes_running()
-            if pidmap:
-                proc = "A 'puppet agent' process is" if (len(pidmap) == 1) \
-                    else "Multiple 'puppet agent' processes are"
-                self.color_print(f'{proc} running:', '0;36')
-                for (pidstr, cmd) in pidmap.items():
-                    self.color_print(f'  {pidstr}  {cmd}', '0;36')
-                self.color_print('If you need to stop an active puppet run from finishing:', '0;33')
-                self.color_print('   puppetctl panic-stop --force', '0;33')
+                self.error_print('Unable to add lock.  Refusing to noop puppet.', '1;31')
+        # We added a lock, but that's not the same as our previous behavior, where we
+        # would only disable a host if puppet wasn't running...
+        self._warn_puppet_processes_running()
+
+    def apply_locks(self, operations):
+        '''
+            Apply a batch of lock operations (see PuppetctlStatefile.apply_changes)
+            all together in one write, or not at all.  Operations that don't name
+            a user are about the invoking user's locks.  Prints the lockids of
+            any added locks as JSON.
+        '''
+        if not self._allowed_to_run_command():
+            self.error_print("Must be root to run 'apply-locks'.")
+        if isinstance(operations, list):
+            operations = [dict({'user': self.invoking_user}, **x)
+                          if isinstance(x, dict) and 'lockid' not in x else x
+                          for x in operations]
+        with self._statefile_session(write=True) as session:
+            try:
+                added = session.apply_changes(operations)
+            except ValueError as err:
+                self.error_print(f'Unable to apply lock changes: {err}', '1;31')
+            if not session.commit():
+                self.error_print('Unable to write lock changes.  Nothing was applied.', '1;31')
+            for lockid in added:
+                self.log(session.get_lock_info(lockid))
+            disabling = session.get_lock_ids(self.statefile_object.flag_state_disable)
+        self.log(f'Applied {len(operations)} lock changes, adding {len(added)} locks.')
+        print(json.dumps({'added': added}))
+        if set(added) & set(disabling):
+            self._warn_puppet_processes_running()
+
+    def import_state(self, source_file):
+        ''' Copy the locks from a state file into the 'sqlite' backend '''
+        if not self._allowed_to_run_command():
+            self.error_print("Must be root to run 'import-state'.")
+        try:
+            imported = self.statefile_object.import_state_file(source_file)
+        except (OSError, ValueError) as err:
+            self.error_print(f'Unable to import {source_file}: {err}', '1;31')
+        self.log_print(f'Imported {imported} locks from {source_file}.')
+
+    def gc(self):
+        '''
+            Purge expired locks from the state file.  Reads only hide them, so
+            this (or any other change to the locks) is what clears them out.
+        '''
+        if not self._allowed_to_run_command():
+            self.error_print("Must be root to run 'gc'.")
+        purged = self.statefile_object.purge_expired_locks()
+        if purged:
+            self.log_print(f'Purged {purged} expired locks.')
         else:
-            self.error_print('Unable to add lock.  Refusing to noop puppet.', '1;31')
+            self.color_print('There are no expired locks to purge.')
+
+    def _warn_puppet_processes_running(self):
+        ''' Tell the user about any puppet run that a new lock won't stop '''
+        pidmap = self._puppet_processes_running()
+        if pidmap:
+            proc = "A 'puppet agent' process is" if (len(pidmap) == 1) \
+                else "Multiple 'puppet agent' processes are"
+            self.color_print(f'{proc} running:', '0;36')
+            for (pidstr, cmd) in pidmap.items():
+                self.color_print(f'  {pidstr}  {cmd}', '0;36')
+            self.color_print('If you need to stop an active puppet run from finishing:', '0;33')
+            self.color_print('   puppetctl panic-stop --force', '0;33')
 
     def break_all_locks(self, force):
         '''
@@ -510,39 +656,77 @@ class PuppetctlExecution(object):
 
     def _parse_puppet_lastrunfile(self, lastrunfile):
         '''
-            This function is weird.  It uses ruby to parse the puppet yaml
-            file.  This saves us from adding python's weird yaml module as a site-wide dependency.
+            Read the puppet lastrunfile into {'age', 'errors', 'config'}.
+            Raises OSError or ValueError if the file can't be read.
         '''
+        record = self._lastrun_record(lastrunfile)
+        # The age is worked out now, never cached.
+        now = int(time.time())
+        # A run that failed before applying a catalog has no resources to
+        # count, but it certainly didn't go cleanly.
+        errors = 1 if record['failed'] is None else record['failed']
+        config = '' if record['config'] is None else record['config']
+        return {'age': now-record['last_run'], 'errors': errors, 'config': config}
 
-        rubyscript_base = "output = File.open('" + lastrunfile + "'){ |data| YAML::load(data) }; "
+    def _lastrun_record(self, lastrunfile):
+        '''
+            The last_run_record of the lastrunfile, from memory or the
+            lastrun_cache while the file is unchanged, so that repeated status
+            checks only stat() it.  Otherwise it is parsed with whichever
+            parser we're set to use, and cached.
+        '''
+        # We stat before we read.  If puppet replaces the file in between, the
+        # new summary is cached under the old key, and the next call reads
+        # it again, rather than the old summary being cached under the new key.
+        key = [self.lastrun_parser] + summary_cache_key(os.stat(lastrunfile))
+        if self._lastrun_memo is not None and self._lastrun_memo[:2] == (lastrunfile, key):
+            # Long-lived callers, like the server, keep it in memory too.
+            return self._lastrun_memo[2]
+        record = None
+        if self.lastrun_cache:
+            record = read_cached_record(self.lastrun_cache, key)
+        if record is None:
+            record = self._parse_lastrun_record(lastrunfile)
+            if self.lastrun_cache:
+                try:
+                    write_cached_record(self.lastrun_cache, key, record)
+                except OSError:
+                    # It's only a cache; without it, the next call parses again.
+                    pass
+        self._lastrun_memo = (lastrunfile, key, record)
+        return record
 
-        age_script = rubyscript_base + "puts output['time']['last_run'].to_i"
-        errors_script = rubyscript_base + "puts output['resources']['failed']"
-        config_script = rubyscript_base + "puts output['version']['config']"
+    def _parse_lastrun_record(self, lastrunfile):
+        ''' Parse the lastrunfile into its last_run_record, with our lastrun_parser '''
+        if self.lastrun_parser == 'ruby':
+            summary = self._ruby_load_lastrunfile(lastrunfile)
+        else:
+            summary = read_last_run_summary(lastrunfile)
+        return last_run_record(summary)
 
+    def _ruby_load_lastrunfile(self, lastrunfile):
+        '''
+            This function is weird.  It uses ruby to parse the puppet yaml
+            file.  This saves us from adding python's weird yaml module as a site-wide dependency.
+            It's only used if lastrun_parser is 'ruby', in case puppet ever writes
+            something our own parser can't read.
+        '''
+        # One ruby, handing the whole summary back as JSON.  The filename goes
+        # in as an argument, not as part of the script.
+        rubyscript = ("output = File.open(ARGV[0]){ |data| YAML::load(data) }; "
+                      "puts JSON.generate(output)")
         with subprocess.Popen(
-                ['ruby', '-ryaml', '-e', age_script],
-                env={'PATH': self.puppet_bin_path},
-                stdout=subprocess.PIPE,
-                ) as p_age:
-            p_age.wait()
-            age = p_age.communicate()[0].rstrip()
-        with subprocess.Popen(
-                ['ruby', '-ryaml', '-e', errors_script],
-                env={'PATH': self.puppet_bin_path},
-                stdout=subprocess.PIPE,
-                ) as p_errors:
-            p_errors.wait()
-            errors = p_errors.communicate()[0].rstrip()
-        with subprocess.Popen(
-                ['ruby', '-ryaml', '-e', config_script],
+                ['ruby', '-ryaml', '-rjson', '-e', rubyscript, lastrunfile],
                 env={'PATH': self.puppet_bin_path},
                 stdout=subprocess.PIPE,
-                ) as p_config:
-            p_config.wait()
-            config = p_config.communicate()[0].rstrip().decode()
-            now = int(time.time())
-        return {'age': now-int(age), 'errors': int(errors), 'config': config}
+                ) as p_ruby:
+            output = p_ruby.communicate()[0].decode()
+        if p_ruby.returncode != 0:
+            raise ValueError(f'ruby could not read {lastrunfile}')
+        summary = json.loads(output)
+        if not isinstance(summary, dict):
+            raise ValueError(f'not a puppet run summary: {lastrunfile}')
+        return summary
 
     @staticmethod
     def dhms(secs_in):
@@ -560,18 +744,24 @@ class PuppetctlExecution(object):
             result = '0s '
         return result.rstrip()
 
-    def _status_of_puppet(self, lastrunfile):
+    def _status_of_puppet(self, lastrunfile, root=None):
         '''
             return a structure containing info about the last run of puppet
-            (not about the locks in puppetctl)
+            (not about the locks in puppetctl).  Only root may know that; root
+            is whether the asker is, if it isn't us.
         '''
-        if os.geteuid() != 0:
+        if root is None:
+            root = os.geteuid() == 0
+        if not root:
             return {'errors': 0, 'message': ('Cannot provide the last run information '
                                              'on puppet without being root.')}
         if not os.path.exists(lastrunfile):
             msg = f'No "{lastrunfile}" file to get puppet information from.'
             return {'errors': 0, 'message': msg, }
-        last_run_data = self._parse_puppet_lastrunfile(lastrunfile)
+        try:
+            last_run_data = self._parse_puppet_lastrunfile(lastrunfile)
+        except (OSError, ValueError) as err:
+            return {'errors': 1, 'message': f'Cannot read "{lastrunfile}": {err}'}
         msg_template = 'Puppet last ran {dhms} ago with {errors} errors, applied version {config}'
         return {
             'errors': last_run_data['errors'],
@@ -584,18 +774,29 @@ class PuppetctlExecution(object):
         '''
             return a structure about the lock status of puppetctl (not puppet)
         '''
-        disable_locks = self.statefile_object.get_disable_lock_ids()
-        disable_locks_data = [self.statefile_object.get_lock_info(x) for x in disable_locks]
-        nooperate_locks = self.statefile_object.get_noop_lock_ids()
-        nooperate_locks_data = [self.statefile_object.get_lock_info(x) for x in nooperate_locks]
+        reply = self._ask_server('lock-status')
+        if reply is not None:
+            return {key: reply[key] for key in ['message', 'color', 'disable', 'nooperate']}
+        with self._statefile_session() as session:
+            disable_locks_data = [session.get_lock_info(x)
+                                  for x in session.get_disable_lock_ids()]
+            nooperate_locks_data = [session.get_lock_info(x)
+                                    for x in session.get_noop_lock_ids()]
+        return self._puppetctl_state(disable_locks_data, nooperate_locks_data)
 
-        if disable_locks and nooperate_locks:
+    @staticmethod
+    def _puppetctl_state(disable_locks_data, nooperate_locks_data):
+        '''
+            The _status_of_puppetctl structure, from the descriptions of the
+            disable and nooperate locks.
+        '''
+        if disable_locks_data and nooperate_locks_data:
             color = '1;31'
-        elif disable_locks and not nooperate_locks:
+        elif disable_locks_data and not nooperate_locks_data:
             color = '1;31'
-        elif not disable_locks and nooperate_locks:
+        elif not disable_locks_data and nooperate_locks_data:
             color = '0;36'
-        elif not disable_locks and not nooperate_locks:
+        elif not disable_locks_data and not nooperate_locks_data:
             color = None
         else:  # pragma: no cover
             # This should never happen since we covered the matrix above,
@@ -607,15 +808,19 @@ class PuppetctlExecution(object):
         else:
             message = '\n'.join(disable_locks_data + nooperate_locks_data)
         return {'message': message, 'color': color,
-                'disable': len(disable_locks), 'nooperate': len(nooperate_locks)}
+                'disable': len(disable_locks_data), 'nooperate': len(nooperate_locks_data)}
 
     def status(self):
         '''
             Determine the state of puppet and puppetctl's locks independently,
             and give an exit code based on the state of puppet (not puppetctl)
         '''
-        puppet_state = self._status_of_puppet(self.lastrunfile)
-        puppetctl_state = self._status_of_puppetctl()
+        reply = self._ask_server('status')
+        if reply is not None:
+            (puppet_state, puppetctl_state) = (reply['puppet'], reply['puppetctl'])
+        else:
+            puppet_state = self._status_of_puppet(self.lastrunfile)
+            puppetctl_state = self._status_of_puppetctl()
         self.color_print(puppet_state['message'], '0;33' if puppet_state['errors'] else None)
         self.color_print(puppetctl_state['message'], puppetctl_state['color'])
         # exit 0 if there are no errors, exit 1 if there were errors:
@@ -626,8 +831,228 @@ class PuppetctlExecution(object):
         puppetctl_state = self._status_of_puppetctl()
         self.color_print(puppetctl_state['message'], puppetctl_state['color'])
 
+    def export_state(self, state_format='json'):
+        '''
+            Print the current (unexpired) locks as human-readable JSON,
+            whichever format the state file is kept in.  Another
+            state_format is printed as that format's bytes instead, as a
+            state file of it would hold them.
+        '''
+        with self._statefile_session() as session:
+            statefiledata = session.read_state_file()
+        if state_format != 'json':
+            # Behind any text we've printed, and ahead of any to come.
+            sys.stdout.flush()
+            sys.stdout.buffer.write(encode_state(statefiledata, state_format))
+            sys.stdout.buffer.flush()
+            return
+        humanized = {lockid: humanize_lock(lockitem)
+                     for (lockid, lockitem) in statefiledata.items()}
+        print(json.dumps(humanized, sort_keys=True, indent=4))
+
+    def watch(self, as_json=False, timeout=None):
+        '''
+            Print lock events as they happen (see PuppetctlStatefile.watch):
+            one JSON object per line if as_json, else a line of text each.
+            Runs until interrupted, or for timeout seconds.
+        '''
+        try:
+            for event in self.statefile_object.watch(timeout):
+                if as_json:
+                    print(json.dumps(event, sort_keys=True), flush=True)
+                else:
+                    print(f"{time.ctime(event['time'])} {event['event']} {event['lockid']}: "
+                          f'{self.statefile_object.format_lock_info(event)}', flush=True)
+        except KeyboardInterrupt:
+            pass
+
+    def serve(self, socket_path=None, timeout=None):
+        '''
+            Answer status queries over a Unix socket (see PuppetctlServer)
+            until interrupted or terminated, or for timeout seconds.  The
+            socket is serve_socket unless given, or the one systemd hands us.
+        '''
+        from .server import PuppetctlServer  # pylint: disable=import-outside-toplevel
+        if socket_path is None:
+            socket_path = self.serve_socket or DEFAULT_SERVE_SOCKET
+        # We are the server; don't ask one.
+        self.serve_socket = ''
+        server = PuppetctlServer(self, socket_path)
+        try:
+            server.open()
+        except OSError as err:
+            self.error_print(f'Cannot serve on {socket_path}: {err}', '1;31')
+        previous_handler = signal.signal(signal.SIGTERM, lambda _signum, _frame: server.stop())
+        self.log(f'Serving status queries on {socket_path}.')
+        try:
+            server.serve(timeout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            server.close()
+        self.log(f"Stopped serving on {socket_path} after {server.metrics['queries']} queries.")
+
+    def lock_history(self, days=30, as_json=False):
+        '''
+            Summarize the locks that ended in the last 'days' days, from the
+            audit log: per user, time spent disabled and in nooperate, lock
+            durations, and how many locks were forgotten and left to expire.
+        '''
+        from .audit import lock_history  # pylint: disable=import-outside-toplevel
+        audit_log = self.statefile_object.audit_log_object
+        if audit_log is None:
+            self.error_print('There is no audit log to read.')
+        until = int(time.time())
+        since = until - days*24*60*60
+        summary = lock_history(audit_log.read(since=since), since, until)
+        if as_json:
+            print(json.dumps(summary, sort_keys=True, indent=4))
+            return
+        print(f"{summary['locks']} locks ended in the last {days} days, "
+              f"{summary['expired']} of them left to expire.")
+        for locktype in self.statefile_object.statefile_locktypes:
+            print(f'Time in {locktype}: '
+                  f"{self.dhms(summary['seconds'].get(locktype, 0))}, "
+                  f"{self.dhms(summary['expired_seconds'].get(locktype, 0))} "
+                  'of it under locks left to expire.')
+        if summary['locks']:
+            print(f"Lock durations: median {self.dhms(summary['duration_p50'])}, "
+                  f"95th percentile {self.dhms(summary['duration_p95'])}.")
+        for (user, usersummary) in sorted(summary['users'].items()):
+            print(f"  {user}: {usersummary['locks']} locks ({usersummary['expired']} expired), "
+                  f"{self.dhms(usersummary['seconds'])}")
+
+    def fleet_locks(self, directory, as_json=False, processes=None,
+                    pattern=None, soon=None, top=None, hosts=False):
+        '''
+            Summarize the locks in a tree of state files collected from many
+            hosts (see fleet.py): hosts disabled and in nooperate, locks per
+            user, and the locks expiring soonest and the oldest.  With hosts,
+            also print each host's locks as it is read.  pattern, soon and top
+            default to fleet.py's.
+        '''
+        # pylint: disable=import-outside-toplevel
+        from .fleet import (DEFAULT_FLEET_PATTERN, DEFAULT_SOON_SECONDS, DEFAULT_TOP,
+                            PuppetctlFleetSummary, scan_fleet)
+        if pattern is None:
+            pattern = DEFAULT_FLEET_PATTERN
+        if soon is None:
+            soon = DEFAULT_SOON_SECONDS
+        if top is None:
+            top = DEFAULT_TOP
+        start = time.monotonic()
+        summary = PuppetctlFleetSummary(time.time(), soon, top)
+        try:
+            for (host, error, locks) in scan_fleet(directory, processes, pattern, summary.now):
+                summary.add(host, error, locks)
+                if hosts and locks:
+                    if as_json:
+                        print(json.dumps({'host': host, 'locks': {x.lockid: x.as_dict()
+                                                                  for x in locks}},
+                                         sort_keys=True), flush=True)
+                    else:
+                        for lock in locks:
+                            print(self._fleet_lock_line(dict(lock.as_dict(), host=host,
+                                                             lockid=lock.lockid)), flush=True)
+        except (OSError, ValueError) as err:
+            self.error_print(f'Unable to scan {directory}: {err}', '1;31')
+        result = summary.as_dict()
+        if as_json:
+            print(json.dumps(result, sort_keys=True, indent=4))
+            return
+        print(f"Scanned {result['hosts']} hosts in {time.monotonic() - start:.1f}s, "
+              f"{result['unreadable']} of them unreadable.")
+        for unreadable in result['unreadable_hosts']:
+            print(f"  {unreadable['host']}: {unreadable['error']}")
+        for locktype in self.statefile_object.statefile_locktypes:
+            print(f"Hosts with {locktype} locks: {result['hosts_by_locktype'].get(locktype, 0)}")
+        print(f"Locks expiring in the next {self.dhms(soon)}: {result['expiring_soon']}")
+        for lock in result['soonest']:
+            print(f'  {self._fleet_lock_line(lock)}')
+        print('Oldest locks:')
+        for lock in result['oldest']:
+            print(f'  {self._fleet_lock_line(lock)}')
+        print('Locks by user:')
+        for (user, counts) in sorted(result['users'].items()):
+            print(f'  {user}: ' + ', '.join(f'{count} {locktype}'
+                                          for (locktype, count) in sorted(counts.items())))
+
+    def fleet_runs(self, directory, as_json=False, processes=None,
+                   pattern=None, stale=None, top=None):
+        '''
+            Summarize a tree of last_run_summary.yaml files collected from
+            many hosts (see fleet.py): percentiles of how long ago and how
+            long puppet ran, the stragglers that haven't run for 'stale'
+            seconds, failures, the slowest resource types, and config version
+            skew.  pattern, stale and top default to fleet.py's.
+        '''
+        # pylint: disable=import-outside-toplevel
+        from .fleet import (DEFAULT_RUNS_PATTERN, DEFAULT_STALE_SECONDS, DEFAULT_TOP,
+                            PuppetctlFleetRuns, read_run, scan_fleet)
+        if pattern is None:
+            pattern = DEFAULT_RUNS_PATTERN
+        if stale is None:
+            stale = DEFAULT_STALE_SECONDS
+        if top is None:
+            top = DEFAULT_TOP
+        start = time.monotonic()
+        runs = PuppetctlFleetRuns(time.time(), stale, top)
+        try:
+            for result in scan_fleet(directory, processes, pattern, runs.now, reader=read_run):
+                runs.add(*result)
+        except (OSError, ValueError) as err:
+            self.error_print(f'Unable to scan {directory}: {err}', '1;31')
+        result = runs.as_dict()
+        if as_json:
+            print(json.dumps(result, sort_keys=True, indent=4))
+            return
+
+        def _seconds(percentiles):
+            return ', '.join(f'{name} {self.dhms(value)}' for (name, value) in percentiles.items()
+                             if value is not None)
+        print(f"Read {result['hosts'] + result['unreadable']} run summaries in "
+              f"{time.monotonic() - start:.1f}s, {result['unreadable']} of them unreadable.")
+        for unreadable in result['unreadable_hosts']:
+            print(f"  {unreadable['host']}: {unreadable['error']}")
+        print(f"Time since last run: {_seconds(result['age'])}")
+        print(f"Run time: {_seconds(result['total_time'])}")
+        print(f"Hosts that haven't run in {self.dhms(stale)}: {result['stragglers']}")
+        for straggler in result['straggler_hosts']:
+            print(f"  {straggler['host']}: {self.dhms(straggler['value'])} ago")
+        print(f"Hosts with failed resources: {result['failing']}")
+        for failing in result['failing_hosts']:
+            print(f"  {failing['host']}: {int(failing['value'])} failed")
+        print('Slowest runs:')
+        for slowest in result['slowest_hosts']:
+            print(f"  {slowest['host']}: {slowest['value']:.1f}s")
+        print('Slowest resource types and phases (p90):')
+        slowest_types = sorted(((x['p90'], key) for (key, x) in result['times'].items()
+                                if x['p90'] is not None), reverse=True)[:top]
+        for (p90, key) in slowest_types:
+            print(f'  {key}: {p90:.1f}s')
+        print(f"Config versions: {result['versions']}, "
+              f"with {result['skewed']} hosts not on the most common one.")
+        for (version, hosts) in result['version_hosts'].items():
+            print(f'  {version}: {hosts} hosts')
+
+    @staticmethod
+    def _fleet_lock_line(lock):
+        '''
+            Private function.  A line about one host's lock, for fleet_locks.
+            Other hosts may run other versions, so any locktype will do.
+        '''
+        message = f": {lock['message']}" if lock['message'] else ''
+        return (f"{lock['host']} {lock['locktype']} by {lock['user']} since "
+                f"{time.ctime(lock['time_begin'])} until {time.ctime(lock['time_expiry'])}"
+                f'{message}')
+
     def motd_status(self):
         ''' Determine the state of puppetctl's locks.  Reports if there are locks. '''
+        summary = self.statefile_object.quick_lock_summary()
+        if summary is not None and not any(summary.values()):
+            # Nothing to report, and we didn't need to parse the locks to know that.
+            sys.exit(0)
         puppetctl_state = self._status_of_puppetctl()
         if puppetctl_state['disable'] != 0 or puppetctl_state['nooperate'] != 0:
             self.color_print(puppetctl_state['message'], puppetctl_state['color'])
@@ -0,0 +1,384 @@
+'''
+    A fleet's worth of files collected from many hosts, one directory per
+    host, scanned in a pool of processes:
+    * state files: who has puppet disabled or in nooperate, and for how
+      long.  'puppetctl fleet-locks' prints it.
+    * last_run_summary.yaml files: how long ago and how long puppet ran,
+      what failed, and which config versions are out there.  'puppetctl
+      fleet-runs' prints it.  NumPy does the sums if it's installed.
+
+    The files are only read.  One that won't decode is counted as
+    unreadable, never reset.
+'''
+import os
+import math
+import array
+import fnmatch
+import heapq
+import itertools
+import time
+import concurrent.futures
+from .stateformats import decode_state
+from .locktable import PuppetctlLock
+from .lastrun import read_last_run_summary, last_run_record
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# The state files to look for in the tree.
+DEFAULT_FLEET_PATTERN = 'puppetctl.status'
+# The run summaries to look for in the tree.
+DEFAULT_RUNS_PATTERN = 'last_run_summary.yaml'
+# Hosts whose last run is older than this many seconds are stragglers.
+DEFAULT_STALE_SECONDS = 2*60*60
+# The percentiles fleet-runs reports, by name.
+PERCENTILES = [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]
+# Locks expiring within this many seconds are 'expiring soon'.
+DEFAULT_SOON_SECONDS = 24*60*60
+# How many of the oldest and soonest-expiring locks, and unreadable hosts, to list.
+DEFAULT_TOP = 10
+# Files handed to a worker at once, so the pool's overhead is spread over many.
+FLEET_CHUNKSIZE = 256
+# Chunks queued per worker.  Enough to keep them busy, few enough that we
+# never hold much of the tree in memory.
+FLEET_CHUNKS_PER_WORKER = 4
+
+
+def find_state_files(root, pattern=DEFAULT_FLEET_PATTERN):
+    '''
+        Generate the paths of the regular files under root whose names match
+        pattern (a glob), walking the tree as we go.  Symlinks aren't followed.
+    '''
+    pending = [root]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and fnmatch.fnmatch(entry.name, pattern):
+                    yield entry.path
+            except OSError:  # pragma: no cover
+                continue
+
+
+def host_name(root, path):
+    '''
+        The host a state file is from: the top directory it's under in the
+        tree (root/web1/var/lib/puppetctl.status is web1), or its own name if
+        it's right in root.
+    '''
+    relpath = os.path.relpath(path, root)
+    return relpath.split(os.sep, 1)[0]
+
+
+def read_host(root, path, now):
+    '''
+        The unexpired locks in one host's state file, as (host, error, locks).
+        error is None, or why the file couldn't be used; then locks is [].
+    '''
+    host = host_name(root, path)
+    try:
+        with open(path, 'rb') as statefile_r:
+            statefiledata = decode_state(statefile_r.read())
+        if not isinstance(statefiledata, dict):
+            raise ValueError('not a dict of locks')
+        locks = [PuppetctlLock.from_dict(lockid, lockitem)
+                 for (lockid, lockitem) in statefiledata.items()]
+    except (OSError, ValueError, AttributeError, KeyError, TypeError) as err:
+        return (host, str(err) or type(err).__name__, [])
+    return (host, None, [x for x in locks if x.time_expiry >= now])
+
+
+def read_run(root, path, now):
+    '''
+        The figures from one host's last_run_summary.yaml (see
+        last_run_record), plus 'age', the seconds since that run, as
+        (host, error, record).  error is None, or why the file couldn't be
+        used; then record is None.
+    '''
+    host = host_name(root, path)
+    try:
+        record = last_run_record(read_last_run_summary(path))
+    except (OSError, ValueError, UnicodeDecodeError) as err:
+        return (host, str(err) or type(err).__name__, None)
+    record['age'] = now - record['last_run']
+    return (host, None, record)
+
+
+def _read_chunk(reader, root, paths, now):
+    ''' Private function.  reader for each of a chunk of paths, in a worker. '''
+    return [reader(root, path, now) for path in paths]
+
+
+class PuppetctlFleetSummary(object):
+    '''
+        A running summary of the hosts' locks, fed one host at a time by
+        add().  It keeps counts, and only the top few of anything it lists,
+        so its size doesn't grow with the fleet (only with the users).
+    '''
+
+    def __init__(self, now, soon=DEFAULT_SOON_SECONDS, top=DEFAULT_TOP):
+        ''' Init variables for PuppetctlFleetSummary '''
+        self.now = int(now)
+        self.soon = int(soon)
+        self.top = int(top)
+        self.hosts = 0
+        self.unreadable = 0
+        self.unreadable_hosts = []
+        self.locks = 0
+        self.hosts_by_locktype = {}
+        self.users = {}
+        self.expiring_soon = 0
+        # Heaps of (-sort key, tiebreak, lock entry): the top 'top' entries
+        # by smallest key, with the largest of those on top to push out.
+        self._soonest = []
+        self._oldest = []
+        self._tiebreak = itertools.count()
+
+    def _keep(self, heap, key, entry):
+        ''' Private function.  Keep entry in heap if it's among the top smallest by key. '''
+        item = (-key, next(self._tiebreak), entry)
+        if len(heap) < self.top:
+            heapq.heappush(heap, item)
+        elif self.top and item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def add(self, host, error, locks):
+        ''' Count one host's result, as read_host returns it '''
+        self.hosts += 1
+        if error is not None:
+            self.unreadable += 1
+            if len(self.unreadable_hosts) < self.top:
+                self.unreadable_hosts.append({'host': host, 'error': error})
+            return
+        for locktype in {x.locktype for x in locks}:
+            self.hosts_by_locktype[locktype] = self.hosts_by_locktype.get(locktype, 0) + 1
+        for lock in locks:
+            self.locks += 1
+            usersummary = self.users.setdefault(lock.user, {})
+            usersummary[lock.locktype] = usersummary.get(lock.locktype, 0) + 1
+            entry = dict(lock.as_dict(), host=host, lockid=lock.lockid)
+            if lock.time_expiry <= self.now + self.soon:
+                self.expiring_soon += 1
+                self._keep(self._soonest, lock.time_expiry, entry)
+            self._keep(self._oldest, lock.time_begin, entry)
+
+    @staticmethod
+    def _ordered(heap):
+        ''' Private function.  A heap's entries, smallest key first. '''
+        return [entry for (_key, _tiebreak, entry) in sorted(heap, reverse=True)]
+
+    def as_dict(self):
+        '''
+            The summary:
+                {'time': ..., 'hosts': scanned, 'unreadable': ...,
+                 'unreadable_hosts': [{'host': ..., 'error': ...}, ...],
+                 'locks': unexpired locks, 'hosts_by_locktype': {locktype: hosts},
+                 'users': {user: {locktype: locks}},
+                 'soon_seconds': ..., 'expiring_soon': how many,
+                 'soonest': [lock, ...], 'oldest': [lock, ...]}
+            where each lock is its state file fields plus 'host' and 'lockid'.
+        '''
+        return {
+            'time': self.now,
+            'hosts': self.hosts,
+            'unreadable': self.unreadable,
+            'unreadable_hosts': list(self.unreadable_hosts),
+            'locks': self.locks,
+            'hosts_by_locktype': dict(self.hosts_by_locktype),
+            'users': {user: dict(x) for (user, x) in self.users.items()},
+            'soon_seconds': self.soon,
+            'expiring_soon': self.expiring_soon,
+            'soonest': self._ordered(self._soonest),
+            'oldest': self._ordered(self._oldest),
+        }
+
+
+def scan_fleet(root, processes=None, pattern=DEFAULT_FLEET_PATTERN, now=None, reader=read_host):
+    '''
+        Generate (host, error, locks) for each state file under root, as
+        read_host does, in whatever order they finish.  (Or for each file
+        matching pattern, whatever reader returns: read_run for run
+        summaries.)  The files are read in a pool of 'processes' workers
+        (one per CPU if None; 1 reads them here, with no pool).  Only a few
+        chunks of paths are queued at a time, so memory doesn't grow with
+        the tree.
+    '''
+    if not os.path.isdir(root):
+        raise ValueError(f'{root} is not a directory')
+    if now is None:
+        now = time.time()
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes < 1:
+        raise ValueError('processes must be 1 or more')
+    paths = find_state_files(root, pattern)
+    if processes == 1:
+        for path in paths:
+            yield reader(root, path, now)
+        return
+    chunks = iter(lambda: list(itertools.islice(paths, FLEET_CHUNKSIZE)), [])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = set()
+        for chunk in chunks:
+            pending.add(pool.submit(_read_chunk, reader, root, chunk, now))
+            if len(pending) >= processes * FLEET_CHUNKS_PER_WORKER:
+                (done, pending) = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield from future.result()
+
+
+def _values(column):
+    ''' Private function.  The numbers in a column that aren't NaN, sorted. '''
+    if numpy is not None:
+        values = numpy.frombuffer(column, dtype=numpy.float64)
+        return numpy.sort(values[~numpy.isnan(values)])
+    return sorted(x for x in column if not math.isnan(x))
+
+
+def column_percentiles(column):
+    '''
+        {'p50': ..., 'p90': ..., 'p99': ..., 'max': ...} of a column of
+        floats, by nearest rank, leaving out NaNs (unknowns).  All None if
+        there are no numbers.
+    '''
+    values = _values(column)
+    if not len(values):  # pylint: disable=use-implicit-booleaness-not-len
+        return dict({name: None for (name, _fraction) in PERCENTILES}, max=None)
+    result = {name: float(values[min(len(values) - 1, int(fraction * len(values)))])
+              for (name, fraction) in PERCENTILES}
+    result['max'] = float(values[-1])
+    return result
+
+
+def column_top(column, count, above=-math.inf):
+    '''
+        (how many, rows) for the values in a column greater than 'above':
+        how many there are, and the rows of the 'count' biggest, biggest
+        first.  NaNs (unknowns) never count.
+    '''
+    if numpy is not None:
+        values = numpy.frombuffer(column, dtype=numpy.float64)
+        rows = numpy.nonzero(values > above)[0]
+        biggest = rows[numpy.argsort(-values[rows], kind='stable')[:count]]
+        return (len(rows), [int(x) for x in biggest])
+    rows = [row for (row, value) in enumerate(column) if value > above]
+    return (len(rows), sorted(rows, key=lambda row: -column[row])[:count])
+
+
+def code_counts(codes, size):
+    ''' How many times each of 0..size-1 is in a column of codes '''
+    if numpy is not None:
+        return [int(x) for x in numpy.bincount(numpy.frombuffer(codes, dtype=numpy.int64),
+                                               minlength=size)]
+    counts = [0] * size
+    for code in codes:
+        counts[code] += 1
+    return counts
+
+
+class PuppetctlFleetRuns(object):
+    '''
+        The hosts' last runs, fed one host at a time by add(), kept as
+        columns: one array of floats per figure, a row per host, NaN where
+        a host didn't say.  Config versions are kept as codes into a list
+        of the versions seen.  as_dict() works the columns out with NumPy
+        if it's there, and in pure Python if not, to the same answers.
+    '''
+
+    def __init__(self, now, stale=DEFAULT_STALE_SECONDS, top=DEFAULT_TOP):
+        ''' Init variables for PuppetctlFleetRuns '''
+        self.now = int(now)
+        self.stale = int(stale)
+        self.top = int(top)
+        self.unreadable = 0
+        self.unreadable_hosts = []
+        self.hosts = []
+        self.ages = array.array('d')
+        self.failed = array.array('d')
+        self.total_time = array.array('d')
+        # resource type or phase: seconds, a row per host.
+        self.times = {}
+        self.versions = []
+        self.version_codes = array.array('q')
+        self._version_index = {}
+
+    def add(self, host, error, record):
+        ''' Count one host's result, as read_run returns it '''
+        if error is not None:
+            self.unreadable += 1
+            if len(self.unreadable_hosts) < self.top:
+                self.unreadable_hosts.append({'host': host, 'error': error})
+            return
+        row = len(self.hosts)
+        self.hosts.append(host)
+        self.ages.append(record['age'])
+        for (column, value) in [(self.failed, record['failed']),
+                                (self.total_time, record['total_time'])]:
+            column.append(math.nan if value is None else value)
+        for (key, value) in record['times'].items():
+            if key not in self.times:
+                self.times[key] = array.array('d', [math.nan]) * row
+            self.times[key].append(value)
+        for column in self.times.values():
+            if len(column) == row:
+                column.append(math.nan)
+        version = record['config']
+        if version not in self._version_index:
+            self._version_index[version] = len(self.versions)
+            self.versions.append(version)
+        self.version_codes.append(self._version_index[version])
+
+    def _hosts_by(self, column, above=-math.inf):
+        ''' Private function.  column_top, with the rows as {'host': ..., 'value': ...} '''
+        (count, rows) = column_top(column, self.top, above)
+        return (count, [{'host': self.hosts[x], 'value': column[x]} for x in rows])
+
+    def as_dict(self):
+        '''
+            The summary:
+                {'time': ..., 'numpy': whether NumPy worked it out,
+                 'hosts': hosts read, 'unreadable': ..., 'unreadable_hosts': [...],
+                 'age', 'total_time', 'failed': {'p50', 'p90', 'p99', 'max'},
+                 'times': {resource type or phase: {'p50', ...}},
+                 'stale_seconds': ..., 'stragglers': how many last ran longer ago,
+                 'straggler_hosts': [{'host': ..., 'value': age}, ...], oldest first,
+                 'failing': hosts with failed resources, 'failing_hosts': [...],
+                 'slowest_hosts': [{'host': ..., 'value': total_time}, ...],
+                 'versions': how many config versions, 'version_hosts': {version: hosts},
+                 'skewed': hosts not on the most common version}
+            version_hosts and the host lists hold the top few only.
+        '''
+        (stragglers, straggler_hosts) = self._hosts_by(self.ages, self.stale)
+        (failing, failing_hosts) = self._hosts_by(self.failed, 0)
+        (_count, slowest_hosts) = self._hosts_by(self.total_time)
+        counts = code_counts(self.version_codes, len(self.versions))
+        by_count = sorted(range(len(counts)), key=lambda code: -counts[code])
+        return {
+            'time': self.now,
+            'numpy': numpy is not None,
+            'hosts': len(self.hosts),
+            'unreadable': self.unreadable,
+            'unreadable_hosts': list(self.unreadable_hosts),
+            'age': column_percentiles(self.ages),
+            'total_time': column_percentiles(self.total_time),
+            'failed': column_percentiles(self.failed),
+            'times': {key: column_percentiles(column) for (key, column) in self.times.items()},
+            'stale_seconds': self.stale,
+            'stragglers': stragglers,
+            'straggler_hosts': straggler_hosts,
+            'failing': failing,
+            'failing_hosts': failing_hosts,
+            'slowest_hosts': slowest_hosts,
+            'versions': len(self.versions),
+            'version_hosts': {self.versions[code]: counts[code] for code in by_count[:self.top]},
+            'skewed': len(self.hosts) - (counts[by_count[0]] if by_count else 0),
+        }
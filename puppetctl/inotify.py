@@ -0,0 +1,119 @@
+'''
+    Linux inotify, through ctypes, for waiting on changes to the locks
+    without polling.  Only the standard library is needed; where inotify
+    isn't available, PuppetctlInotify raises OSError and callers poll instead.
+'''
+import os
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+# Everything that changes what's in a file or directory, or which files it has.
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+_EVENT_HEADER = struct.Struct('iIII')
+
+_LIBC = None
+
+
+def _libc():
+    ''' The C library, with the inotify calls checked for.  Raises OSError if there are none. '''
+    global _LIBC  # pylint: disable=global-statement
+    if _LIBC is None:
+        library = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(library, use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError, TypeError) as err:
+            raise OSError(errno.ENOSYS, f'inotify is not available: {err}') from err
+        _LIBC = libc
+    return _LIBC
+
+
+class PuppetctlInotify(object):
+    '''
+        Watch one directory for changes to some of its entries.  Watching the
+        directory rather than the files themselves means we see a file that is
+        replaced by a rename, as the state file is on every write.
+
+            with PuppetctlInotify('/var/lib', ['puppetctl.status']) as watcher:
+                watcher.wait(timeout)
+    '''
+
+    def __init__(self, directory, names=None):
+        '''
+            Start watching directory, for changes to the entries in names (any
+            entry, if names is None).  Raises OSError if we can't.
+        '''
+        libc = _libc()
+        self.names = None if names is None else {os.fsencode(x) for x in names}
+        self.inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory), WATCH_MASK) < 0:
+            err = ctypes.get_errno()
+            self.close()
+            raise OSError(err, os.strerror(err), directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        self.close()
+
+    def close(self):
+        ''' Stop watching '''
+        if self.inotify_fd >= 0:
+            os.close(self.inotify_fd)
+            self.inotify_fd = -1
+
+    def _relevant(self, buffer):
+        ''' Private function.  Whether any event in what we read is one we're watching for. '''
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buffer):
+            (_wd, mask, _cookie, length) = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            # Events about the directory itself, and lost events, have no
+            # name, and may hide anything.
+            if not name or mask & IN_Q_OVERFLOW or self.names is None or name in self.names:
+                return True
+        return False
+
+    def wait(self, timeout=None):
+        '''
+            Wait for a change to one of the watched entries.  Returns True if
+            there was one, False if timeout seconds passed first.
+        '''
+        poller = select.poll()
+        poller.register(self.inotify_fd, select.POLLIN)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not poller.poll(None if remaining is None else remaining * 1000):
+                return False
+            try:
+                buffer = os.read(self.inotify_fd, 65536)
+            except BlockingIOError:  # pragma: no cover
+                continue
+            if self._relevant(buffer):
+                return True
@@ -0,0 +1,201 @@
+'''
+    A native reader for puppet's last_run_summary.yaml, so we needn't spawn
+    ruby (or add a YAML module) to read it.  Puppet writes a small, fixed
+    shape: a mapping of sections, each a mapping of scalars.
+
+        ---
+        version:
+          config: a294ac4f4fcd5264e5246df0787757a74fc3d966
+          puppet: 6.14.0
+        resources:
+          failed: 0
+        time:
+          total: 29.360705031
+          last_run: 1586995296
+
+    That shape is all we read.  Anything else YAML can do (lists, deeper
+    nesting, anchors, block scalars) is a ValueError, not a guess.
+
+    Puppet rewrites the file once a run, and we're asked about it far more
+    often than that, so what we make of it can be kept in a small cache
+    file, keyed by the summary's stat().
+'''
+import os
+import re
+import json
+import math
+import tempfile
+
+_INT_RE = re.compile(r'[-+]?[0-9]+$')
+_FLOAT_RE = re.compile(r'[-+]?([0-9]+\.[0-9]*|\.[0-9]+|[0-9]+)([eE][-+]?[0-9]+)?$')
+# What an unquoted YAML value may not start with, that we don't read.
+_UNSUPPORTED_STARTS = ('&', '*', '!', '[', '{', '|', '>', '- ', '%', '@', '`')
+_NUMBER_STARTS = frozenset('0123456789-+.')
+# Bumped whenever what we cache changes, so an old cache is just a miss.
+LASTRUN_CACHE_VERSION = 1
+
+
+def _scalar(text, lineno):
+    ''' Private function.  The value of a YAML scalar, as text in a line. '''
+    if text[0] in _NUMBER_STARTS:
+        # Nearly everything in a summary is a number, so try those first.
+        try:
+            return int(text)
+        except ValueError:
+            if _FLOAT_RE.match(text):
+                return float(text)
+    if text.startswith("'"):
+        if len(text) < 2 or not text.endswith("'"):
+            raise ValueError(f'line {lineno}: unterminated quoted value')
+        return text[1:-1].replace("''", "'")
+    if text.startswith('"'):
+        try:
+            # Close enough: YAML's double-quoted escapes are a superset of JSON's.
+            return json.loads(text)
+        except ValueError as err:
+            raise ValueError(f'line {lineno}: unreadable quoted value') from err
+    if text.startswith(_UNSUPPORTED_STARTS):
+        raise ValueError(f'line {lineno}: unsupported YAML value {text!r}')
+    # A comment needs a space before it; a '#' inside a word is the word's.
+    text = text.split(' #', 1)[0].rstrip()
+    if _INT_RE.match(text):
+        return int(text)
+    if _FLOAT_RE.match(text):
+        return float(text)
+    lowered = text.lower()
+    if lowered in ['.inf', '+.inf', '-.inf']:
+        return -math.inf if lowered.startswith('-') else math.inf
+    if lowered == '.nan':
+        return math.nan
+    if lowered in ['true', 'false']:
+        return lowered == 'true'
+    if lowered in ['', '~', 'null']:
+        return None
+    return text
+
+
+def parse_last_run_summary(text):
+    '''
+        Parse the contents (str) of a last_run_summary.yaml into
+        {section: {key: value}}.  Raises ValueError for anything outside the
+        shape described above.
+    '''
+    summary = {}
+    section = None
+    section_indent = None
+    for (lineno, line) in enumerate(text.splitlines(), 1):
+        stripped = line.strip()
+        if not stripped or stripped[0] == '#':
+            continue
+        if line[0] == '-' and line.startswith('---'):
+            continue
+        if line[0] == '.' and line.startswith('...'):
+            # the end of the document
+            break
+        indent = len(line) - len(line.lstrip())
+        if '\t' in line[:indent]:
+            raise ValueError(f'line {lineno}: tabs in indentation')
+        (key, colon, value) = stripped.partition(':')
+        if not colon or not key or (value and value[0] != ' '):
+            raise ValueError(f'line {lineno}: expected "key: value"')
+        if key[0] in '\'"':
+            key = _scalar(key, lineno)
+        value = value.strip()
+        if value and value[0] == '#':
+            value = ''
+        if not indent:
+            if value:
+                summary[key] = _scalar(value, lineno)
+                section = None
+            else:
+                section = summary[key] = {}
+                section_indent = None
+            continue
+        if section_indent is None:
+            section_indent = indent
+        if section is None or indent != section_indent:
+            raise ValueError(f'line {lineno}: nesting deeper than we read')
+        # An empty value is how ruby writes nil.
+        section[key] = _scalar(value, lineno) if value else None
+    return summary
+
+
+def read_last_run_summary(lastrunfile):
+    ''' Parse a last_run_summary.yaml file.  Raises OSError or ValueError. '''
+    with open(lastrunfile, 'r', encoding='utf-8') as lastrun_r:
+        return parse_last_run_summary(lastrun_r.read())
+
+
+def last_run_record(summary):
+    '''
+        The figures we report from a parsed summary:
+            {'last_run': epoch seconds, 'failed': failed resources,
+             'total_time': seconds, 'config': config version (str),
+             'times': {resource type or phase: seconds}}
+        A run that failed before applying a catalog has no resources or
+        times; those are None and {}.  Raises ValueError if there's no
+        last_run time, without which there's nothing to say.
+    '''
+    try:
+        times = summary.get('time') or {}
+        last_run = int(times['last_run'])
+        failed = (summary.get('resources') or {}).get('failed')
+        total_time = times.get('total')
+        config = (summary.get('version') or {}).get('config')
+        return {
+            'last_run': last_run,
+            'failed': None if failed is None else int(failed),
+            'total_time': None if total_time is None else float(total_time),
+            'config': None if config is None else str(config),
+            'times': {key: float(value) for (key, value) in times.items()
+                      if key not in ['last_run', 'total'] and value is not None},
+        }
+    except (AttributeError, KeyError, TypeError, ValueError) as err:
+        raise ValueError(f'not a puppet run summary: {err}') from err
+
+
+def summary_cache_key(statinfo):
+    '''
+        What tells one summary file from the next: puppet replaces the file
+        each run, so any of these changing means there's a new one.
+    '''
+    return [statinfo.st_dev, statinfo.st_ino, statinfo.st_mtime_ns, statinfo.st_size]
+
+
+def read_cached_record(cache_file, key):
+    '''
+        The record cached in cache_file for key (a JSON-able list), or None
+        if there isn't one.  A missing or damaged cache is just a miss.
+    '''
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as cache_r:
+            cached = json.load(cache_r)
+        if cached['version'] != LASTRUN_CACHE_VERSION or cached['key'] != key:
+            return None
+        record = cached['record']
+        if isinstance(record, dict) and isinstance(record.get('last_run'), int):
+            return record
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+    return None
+
+
+def write_cached_record(cache_file, key, record):
+    '''
+        Cache record for key in cache_file, replacing whatever was there in
+        one step, so readers see the old cache or the new one.  Raises OSError.
+    '''
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    (tmp_fd, tmp_name) = tempfile.mkstemp(dir=cache_dir,
+                                          prefix=f'.{os.path.basename(cache_file)}.')
+    try:
+        with os.fdopen(tmp_fd, 'w', encoding='utf-8') as cache_w:
+            json.dump({'version': LASTRUN_CACHE_VERSION, 'key': key, 'record': record},
+                      cache_w, sort_keys=True)
+        os.rename(tmp_name, cache_file)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:  # pragma: no cover
+            pass
+        raise
@@ -0,0 +1,234 @@
+'''
+    In-memory lock records, and a table of them indexed for the questions we ask.
+'''
+import heapq
+import types
+
+
+class PuppetctlLock(object):
+    '''
+        One lock.  Immutable, so the same record can be handed to any number
+        of callers and snapshots without copying it.  Reading it like the
+        old dict (lock['user']) still works; as_dict() gives a real dict.
+    '''
+    __slots__ = ('lockid', 'user', 'locktype', 'message', 'time_begin', 'time_expiry')
+
+    def __init__(self, lockid, user, locktype, message, time_begin, time_expiry):
+        ''' Init variables for PuppetctlLock '''
+        for (name, value) in zip(self.__slots__,
+                                 (lockid, user, locktype, message, time_begin, time_expiry)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __getitem__(self, key):
+        if key == 'lockid' or key not in self.__slots__:
+            # lockid was never a field of the stored dict.
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, PuppetctlLock):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+    def __reduce__(self):
+        # The default pickling sets the fields one by one, which we don't allow.
+        return (type(self), self._fields())
+
+    def _fields(self):
+        ''' Private function.  All the fields, in order. '''
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, lockid, lockitem):
+        ''' Make a lock from its state file structure.  The *_human fields are dropped. '''
+        return cls(lockid, lockitem['user'], lockitem['locktype'],
+                   lockitem.get('message', ''), lockitem['time_begin'], lockitem['time_expiry'])
+
+    def as_dict(self):
+        ''' The state file structure of this lock, as a new dict '''
+        return {
+            'user': self.user,
+            'locktype': self.locktype,
+            'message': self.message,
+            'time_begin': self.time_begin,
+            'time_expiry': self.time_expiry,
+        }
+
+    def replace(self, **changes):
+        ''' A new lock like this one, with some fields changed '''
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return type(self)(**fields)
+
+
+class PuppetctlLockTable(object):
+    '''
+        A set of PuppetctlLock records keyed by lockid, plus:
+        * an index of lockids per locktype
+        * an index of lockids per (locktype, user)
+        * a min-heap of (time_expiry, lockid) per locktype
+
+        So "is anyone disabling puppet", "what are my locks" and "what expires
+        next" don't have to scan every lock.  The heaps are pruned lazily: a
+        removed lock leaves its entry behind until it reaches the top.
+
+        snapshot() hands out a read-only view of the locks without copying
+        them.  The table copies its mapping the next time it changes, so the
+        view never sees later changes.
+    '''
+
+    def __init__(self, locks=None):
+        ''' Init variables for PuppetctlLockTable '''
+        self.locks = {}
+        self._by_type = {}
+        self._by_type_user = {}
+        self._expiry_heaps = {}
+        # heap entries left behind by removes, so we know when to rebuild.
+        self._stale_entries = 0
+        # whether a snapshot shares self.locks with us.
+        self._shared = False
+        for (lockid, lock) in (locks or {}).items():
+            self._index(lockid, lock)
+            self._expiry_heaps.setdefault(lock.locktype, []).append((lock.time_expiry, lockid))
+        for heap in self._expiry_heaps.values():
+            heapq.heapify(heap)
+
+    @classmethod
+    def from_state(cls, statefiledata):
+        ''' Build a table from the state file structure (a dict of lock dicts) '''
+        return cls({lockid: PuppetctlLock.from_dict(lockid, lockitem)
+                    for (lockid, lockitem) in statefiledata.items()})
+
+    def as_state(self):
+        ''' The state file structure of the table, as new dicts '''
+        return {lockid: lock.as_dict() for (lockid, lock) in self.locks.items()}
+
+    def snapshot(self):
+        ''' A read-only {lockid: PuppetctlLock} view that later changes won't touch '''
+        self._shared = True
+        return types.MappingProxyType(self.locks)
+
+    def __len__(self):
+        return len(self.locks)
+
+    def __contains__(self, lockid):
+        return lockid in self.locks
+
+    def get(self, lockid, default=None):
+        ''' The lock with this id, or default '''
+        return self.locks.get(lockid, default)
+
+    def items(self):
+        ''' (lockid, lock) pairs, like a dict '''
+        return self.locks.items()
+
+    def _unshare(self):
+        ''' Private function.  Copy the mapping before changing it, if a snapshot has it. '''
+        if self._shared:
+            self.locks = dict(self.locks)
+            self._shared = False
+
+    def _index(self, lockid, lock):
+        ''' Private function.  Put a lock in the table and the indexes, but not the heaps. '''
+        if lockid in self.locks:
+            raise ValueError(f'lock {lockid} is already in the table')
+        self._unshare()
+        self.locks[lockid] = lock
+        self._by_type.setdefault(lock.locktype, set()).add(lockid)
+        self._by_type_user.setdefault((lock.locktype, lock.user), set()).add(lockid)
+
+    def add(self, lock):
+        ''' Add a lock.  Raises ValueError if its lockid is taken. '''
+        self._index(lock.lockid, lock)
+        heapq.heappush(self._expiry_heaps.setdefault(lock.locktype, []),
+                       (lock.time_expiry, lock.lockid))
+
+    def remove(self, lockid):
+        ''' Remove a lock and return it.  Raises KeyError if it isn't here. '''
+        lock = self.locks[lockid]
+        self._unshare()
+        del self.locks[lockid]
+        self._by_type[lock.locktype].discard(lockid)
+        user_key = (lock.locktype, lock.user)
+        self._by_type_user[user_key].discard(lockid)
+        if not self._by_type_user[user_key]:
+            del self._by_type_user[user_key]
+        self._stale_entries += 1
+        if self._stale_entries > len(self.locks) + 16:
+            self._rebuild_heaps()
+        return lock
+
+    def _rebuild_heaps(self):
+        ''' Private function.  Drop the stale heap entries in one pass. '''
+        self._expiry_heaps = {}
+        for (lockid, lock) in self.locks.items():
+            self._expiry_heaps.setdefault(lock.locktype, []).append((lock.time_expiry, lockid))
+        for heap in self._expiry_heaps.values():
+            heapq.heapify(heap)
+        self._stale_entries = 0
+
+    def _heap_top(self, locktype):
+        ''' Private function.  The live (time_expiry, lockid) on top of a heap, or None. '''
+        heap = self._expiry_heaps.get(locktype, [])
+        while heap:
+            (time_expiry, lockid) = heap[0]
+            lock = self.locks.get(lockid)
+            if (lock is not None and lock.locktype == locktype and
+                    lock.time_expiry == time_expiry):
+                return heap[0]
+            heapq.heappop(heap)
+            self._stale_entries = max(self._stale_entries - 1, 0)
+        return None
+
+    def count(self, locktype, user=None):
+        ''' How many locks of a type there are (for a user, if given) '''
+        if user is None:
+            return len(self._by_type.get(locktype, ()))
+        return len(self._by_type_user.get((locktype, user), ()))
+
+    def ids(self, locktype, user=None):
+        ''' The lockids of a type (for a user, if given), soonest expiry first '''
+        if user is None:
+            lockids = self._by_type.get(locktype, ())
+        else:
+            lockids = self._by_type_user.get((locktype, user), ())
+        return sorted(lockids, key=lambda x: (self.locks[x].time_expiry, x))
+
+    def next_expiry(self, locktype=None):
+        '''
+            (time_expiry, lockid) of the lock that expires soonest, of one
+            locktype or of any.  None if there are no locks.
+        '''
+        if locktype is not None:
+            return self._heap_top(locktype)
+        tops = [self._heap_top(x) for x in list(self._expiry_heaps)]
+        tops = [x for x in tops if x is not None]
+        return min(tops) if tops else None
+
+    def pop_expired(self, now):
+        ''' Remove every lock that expired before 'now'.  Return their lockids. '''
+        expired = []
+        for locktype in list(self._expiry_heaps):
+            while True:
+                top = self._heap_top(locktype)
+                if top is None or top[0] >= now:
+                    break
+                heapq.heappop(self._expiry_heaps[locktype])
+                self.remove(top[1])
+                # that entry is gone from the heap, not left behind.
+                self._stale_entries = max(self._stale_entries - 1, 0)
+                expired.append(top[1])
+        return expired
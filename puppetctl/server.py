@@ -0,0 +1,391 @@
+'''
+    A resident query server for the status commands, over a Unix socket, and
+    the client side of it.  The server keeps the locks and the last run
+    summary in memory, so that a query costs neither a parse nor a start-up:
+
+        $ echo is-enabled | nc -U /run/puppetctl.sock
+        {"enabled": true, "state": [...]}
+
+    One request per line, one JSON object per line in reply, in order, until
+    the client closes.  The requests are:
+        is-enabled    {"enabled": bool}
+        is-operating  {"operating": bool}
+        lock-status   {"message", "color", "disable", "nooperate"}, as
+                      PuppetctlExecution._status_of_puppetctl
+        status        {"puppet": {"errors", "message"}, "puppetctl": as above}
+        ping          {}
+    Every reply also carries "state", which locks and run summary the server
+    is answering about, so a client set up for others doesn't believe it.
+    Anything else gets {"error": "..."}.
+
+    The last run is only described to clients running as root, as
+    'puppetctl status' does without a server.
+
+    Clients are served together, each for at most CLIENT_DEADLINE seconds,
+    so one that connects and says nothing holds up nobody else.
+'''
+import os
+import json
+import time
+import errno
+import selectors
+import socket
+import stat
+import struct
+from .locktable import PuppetctlLockTable
+
+# How long a client may stay connected, to send its requests and read the
+# replies.  Ours come from memory, so this is plenty.
+CLIENT_DEADLINE = 1.0
+# How long a client waits to connect and for each reply before it gives up
+# and reads the files itself.  A server answers in well under this.
+QUERY_TIMEOUT = 0.15
+# The most clients connected at once; past this, the oldest is dropped.
+MAX_CLIENTS = 64
+# How often serve() looks up from its clients to see if it should stop.
+ACCEPT_INTERVAL = 0.5
+# The first socket systemd hands a socket-activated service.
+SD_LISTEN_FDS_START = 3
+# The longest request line we'll read.
+MAX_REQUEST = 1024
+# struct ucred: pid_t pid; uid_t uid; gid_t gid
+_UCRED = struct.Struct('iII')
+
+
+def state_identity(runner):
+    '''
+        Which locks and run summary a PuppetctlExecution reports on, as a
+        JSON-able list.  A client only believes a server with the same.
+    '''
+    statefile = runner.statefile_object
+    location = {'file': statefile.state_file, 'directory': statefile.state_dir,
+                'sqlite': statefile.state_db}.get(statefile.backend)
+    return [statefile.backend, location, runner.lastrunfile]
+
+
+def peer_uid(connection):
+    ''' The uid of the process at the other end of a Unix socket, or None if we can't tell '''
+    try:
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _UCRED.size)
+    except (AttributeError, OSError):
+        # Not Linux.
+        return None
+    return _UCRED.unpack(credentials)[1]
+
+
+def query_server(socket_path, request, identity, timeout=QUERY_TIMEOUT):
+    '''
+        Ask the server at socket_path one request.  Returns its reply (a
+        dict), or None if there's no server there we should believe: none
+        listening, one run by someone other than root or us, one answering
+        about other locks than identity, or one that doesn't answer within
+        timeout seconds, all told.
+    '''
+    deadline = time.monotonic() + timeout
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(socket_path)
+            if peer_uid(connection) not in [0, os.geteuid()]:
+                return None
+            connection.sendall(request.encode() + b'\n')
+            received = b''
+            while not received.endswith(b'\n'):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                connection.settimeout(remaining)
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                received += chunk
+            reply = json.loads(received.split(b'\n', 1)[0])
+    except (OSError, ValueError):
+        # Including socket.timeout, and no server there at all.
+        return None
+    if not isinstance(reply, dict) or reply.get('state') != identity or 'error' in reply:
+        return None
+    return reply
+
+
+class PuppetctlServer(object):
+    '''
+        Answer status queries about runner's locks and last run summary from
+        memory, over a Unix socket.
+
+        The locks are read once, and read again only when inotify says the
+        state has changed (or, where there's no inotify, when the backend's
+        version() has).  Locks expire without any write, so each query drops
+        the ones that have expired since.  The runner keeps the last run
+        summary in memory, and reads it again once its stat() changes.
+    '''
+    # We answer as the runner would, from what we keep.
+    # pylint: disable=protected-access
+
+    def __init__(self, runner, socket_path=None):
+        '''
+            Serve for runner, a PuppetctlExecution, on socket_path.  If
+            systemd started us for a socket, that one is used instead.
+        '''
+        if socket_path is None:
+            socket_path = runner.defaults['serve_socket']
+        self.runner = runner
+        self.socket_path = socket_path
+        self.identity = state_identity(runner)
+        self.listener = None
+        # Whether we made the socket, and so should remove it.
+        self._bound = False
+        self._locks = None
+        self._lock_version = None
+        self._lock_watcher = None
+        self._stopping = False
+        self.metrics = {'queries': 0, 'lock_reads': 0, 'clients': 0, 'clients_dropped': 0}
+
+    def _inherited_socket(self):
+        ''' Private function.  The socket systemd passed us, or None. '''
+        try:
+            if (int(os.environ.get('LISTEN_PID', '')) != os.getpid() or
+                    int(os.environ.get('LISTEN_FDS', '')) < 1):
+                return None
+        except ValueError:
+            return None
+        return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+    def open(self):
+        '''
+            Start listening.  A socket left behind by a server that's gone is
+            replaced; one that's still answering is an OSError (EADDRINUSE).
+        '''
+        self.listener = self._inherited_socket()
+        if self.listener is not None:
+            return
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    try:
+                        probe.connect(self.socket_path)
+                    except OSError:
+                        # Nobody home.
+                        os.unlink(self.socket_path)
+                    else:
+                        raise OSError(errno.EADDRINUSE, 'already being served',
+                                      self.socket_path)
+        except FileNotFoundError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.socket_path)
+            # Anyone may ask about the locks, as anyone may run is-enabled
+            # and read them from the state file.  That's all they're told:
+            # the last run only goes to root, and no request changes
+            # anything.  Nor can they hold up root's queries, since no
+            # client is kept past CLIENT_DEADLINE, nor more than MAX_CLIENTS.
+            os.chmod(self.socket_path, 0o666)
+            listener.listen(64)
+        except OSError:
+            listener.close()
+            raise
+        self.listener = listener
+        self._bound = True
+
+    def close(self):
+        ''' Stop listening, and remove the socket if we made it '''
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        if self._bound:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:  # pragma: no cover
+                pass
+            self._bound = False
+        if self._lock_watcher is not None:
+            self._lock_watcher.close()
+            self._lock_watcher = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        self.close()
+
+    def stop(self):
+        ''' Have serve() return, within ACCEPT_INTERVAL '''
+        self._stopping = True
+
+    def _locks_changed(self):
+        ''' Private function.  Whether the locks may have changed since we read them. '''
+        if self._lock_watcher is not None:
+            # Reads what events there are, without waiting.
+            return self._lock_watcher.wait(0)
+        return self.runner.statefile_object.backend_object.version() != self._lock_version
+
+    def _read_locks(self):
+        ''' Private function.  Read the locks, watching for them to change from here on. '''
+        backend = self.runner.statefile_object.backend_object
+        # Watch again each time, since what we watch can change (the lock
+        # directory being made, say).  Watch before reading, so that no
+        # change falls between the two.
+        if self._lock_watcher is not None:
+            self._lock_watcher.close()
+            self._lock_watcher = None
+        paths = backend.watch_paths()
+        if paths is not None:
+            # Clients import us too, and have no use for inotify.
+            from .inotify import PuppetctlInotify  # pylint: disable=import-outside-toplevel
+            try:
+                self._lock_watcher = PuppetctlInotify(*paths)
+            except OSError:
+                # Not Linux, or out of watches: we'll compare versions instead.
+                pass
+        self._lock_version = backend.version()
+        # Without the state file lock: every client waits while we read, so
+        # we mustn't wait on a writer.  Writes are atomic, so it's safe.
+        self._locks = PuppetctlLockTable.from_state(
+            self.runner.statefile_object.read_state_file(locked=False))
+        self.metrics['lock_reads'] += 1
+
+    def lock_table(self):
+        ''' The unexpired locks, read again only if they've changed '''
+        if self._locks is None or self._locks_changed():
+            self._read_locks()
+        self._locks.pop_expired(time.time())
+        return self._locks
+
+    def _lock_status(self):
+        ''' Private function.  The lock-status reply '''
+        statefile = self.runner.statefile_object
+        locks = self.lock_table()
+        lines = {locktype: [statefile.format_lock_info(locks.get(x))
+                            for x in locks.ids(locktype)]
+                 for locktype in statefile.statefile_locktypes}
+        return self.runner._puppetctl_state(lines[statefile.flag_state_disable],
+                                            lines[statefile.flag_state_noop])
+
+    def answer(self, request, uid=None):
+        ''' The reply (a dict) to one request line, from a client running as uid '''
+        self.metrics['queries'] += 1
+        statefile = self.runner.statefile_object
+        request = request.strip()
+        try:
+            if request == 'is-enabled':
+                reply = {'enabled': not self.lock_table().count(statefile.flag_state_disable)}
+            elif request == 'is-operating':
+                reply = {'operating': not self.lock_table().count(statefile.flag_state_noop)}
+            elif request == 'lock-status':
+                reply = self._lock_status()
+            elif request == 'status':
+                puppet_state = self.runner._status_of_puppet(self.runner.lastrunfile,
+                                                             root=uid == 0)
+                reply = {'puppet': puppet_state, 'puppetctl': self._lock_status()}
+            elif request == 'ping':
+                reply = {}
+            else:
+                reply = {'error': f'unknown request {request!r}'}
+        except Exception as err:  # pylint: disable=broad-except
+            # Whatever went wrong, the client can still read the files itself.
+            self._locks = None
+            reply = {'error': f'{type(err).__name__}: {err}'}
+        reply['state'] = self.identity
+        return reply
+
+    def _accept(self, selector, clients):
+        ''' Private function.  Take on a new client, dropping the oldest if there are too many. '''
+        try:
+            (connection, _address) = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            # Someone else's, or gone already.
+            return
+        if len(clients) >= MAX_CLIENTS:
+            self._drop(selector, clients, min(clients, key=lambda x: clients[x]['deadline']))
+        connection.setblocking(False)
+        clients[connection] = {'uid': peer_uid(connection), 'received': b'', 'replies': b'',
+                               'closing': False,
+                               'deadline': time.monotonic() + CLIENT_DEADLINE}
+        selector.register(connection, selectors.EVENT_READ)
+        self.metrics['clients'] += 1
+
+    def _drop(self, selector, clients, connection, dropped=True):
+        ''' Private function.  Be done with a client, counting it if it didn't finish. '''
+        if dropped:
+            self.metrics['clients_dropped'] += 1
+        selector.unregister(connection)
+        del clients[connection]
+        connection.close()
+
+    def _service(self, selector, clients, connection, events):
+        '''
+            Private function.  Read what a client has sent, answer its whole
+            request lines, and send what we can of the replies.  Returns
+            False once the client is done with.
+        '''
+        client = clients[connection]
+        if events & selectors.EVENT_READ:
+            data = connection.recv(MAX_REQUEST)
+            if not data:
+                client['closing'] = True
+            client['received'] += data
+            while b'\n' in client['received']:
+                (line, client['received']) = client['received'].split(b'\n', 1)
+                reply = self.answer(line.decode('utf-8', 'replace'), client['uid'])
+                client['replies'] += json.dumps(reply, sort_keys=True).encode() + b'\n'
+            if len(client['received']) > MAX_REQUEST:
+                return False
+        if client['replies']:
+            sent = connection.send(client['replies'])
+            client['replies'] = client['replies'][sent:]
+        if client['closing'] and not client['replies']:
+            return False
+        # Read while there's room for more requests; write while there are replies.
+        wanted = 0 if client['closing'] else selectors.EVENT_READ
+        if client['replies']:
+            wanted |= selectors.EVENT_WRITE
+        selector.modify(connection, wanted)
+        return True
+
+    def serve(self, timeout=None):
+        '''
+            Answer clients, together, until stop() is called or timeout
+            seconds have passed.  A client still connected CLIENT_DEADLINE
+            seconds after it connected is dropped, whatever it's doing.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.listener.setblocking(False)
+        clients = {}
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.listener, selectors.EVENT_READ)
+            try:
+                while not self._stopping:
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        return
+                    for connection in [x for (x, client) in clients.items()
+                                       if client['deadline'] <= now]:
+                        self._drop(selector, clients, connection)
+                    wait = min([ACCEPT_INTERVAL] +
+                               [x['deadline'] - now for x in clients.values()] +
+                               ([] if deadline is None else [deadline - now]))
+                    for (key, events) in selector.select(max(wait, 0)):
+                        if key.fileobj is self.listener:
+                            self._accept(selector, clients)
+                            continue
+                        if key.fileobj not in clients:
+                            # Dropped to make room for a newer client.
+                            continue
+                        try:
+                            finished = not self._service(selector, clients, key.fileobj,
+                                                         events)
+                        except (BlockingIOError, InterruptedError):
+                            # Woken for nothing; wait again.
+                            finished = False
+                        except OSError:
+                            # A client that went away: its loss.
+                            finished = True
+                        if finished:
+                            client = clients[key.fileobj]
+                            self._drop(selector, clients, key.fileobj,
+                                       dropped=not client['closing'] or bool(client['replies']))
+            finally:
+                for connection in list(clients):
+                    self._drop(selector, clients, connection, dropped=False)
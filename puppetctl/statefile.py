@@ -3,15 +3,58 @@
     locking-out of puppet runs, or running in noop mode.
 '''
 import os
-import copy
+import errno
+import fcntl
 import re
+import stat
 import time
 import hashlib
 import shutil
-import json
+import tempfile
+from .stateformats import (STATE_FORMATS, DEFAULT_STATE_FORMAT, SUMMARY_SIZE, JOURNAL_MAGIC,
+                           TRAILER_SIZE, encode_state, encode_journal_records, decode_state,
+                           decode_summary, add_trailer, trailer_generation, salvage_journal)
+from .locktable import PuppetctlLock, PuppetctlLockTable
+from .backends import (DEFAULT_STATE_DIR, DEFAULT_STATE_DB, PuppetctlBackend,
+                       PuppetctlMemoryBackend, PuppetctlDirectoryBackend, PuppetctlSqliteBackend)
 
 DEFAULT_STATE_FILE = '/var/lib/puppetctl.status'
 BOGUS_STATE_FILE = '/tmp/broken-puppetctl.status'
+# How hard we try to get a state file write onto the disk before we call it committed:
+#   none       the new file is renamed into place; the OS flushes it when it likes
+#   file       the new file is fsync'ed before it is renamed into place
+#   directory  as 'file', and the directory is fsync'ed after the rename, so the
+#              rename itself survives a crash
+DURABILITY_LEVELS = ['none', 'file', 'directory']
+DEFAULT_DURABILITY = 'directory'
+# How long (seconds) a session waits for the state file lock before giving up:
+DEFAULT_LOCK_TIMEOUT = 10.0
+# A 'journal' state file is compacted (rewritten as one snapshot) instead of
+# appended to once it would grow past this many bytes:
+DEFAULT_JOURNAL_MAX_BYTES = 65536
+# Known-good copies of the state file kept beside it, to recover from if it's
+# damaged.  Each full write of the state file copies it to one.
+DEFAULT_STATE_BACKUPS = 3
+# The audit log is rotated once it would grow past this many bytes:
+DEFAULT_AUDIT_MAX_BYTES = 1048576
+# Where the locks live:
+#   file       the state_file, in its state_format (with a lock file beside it)
+#   directory  one file per lock in state_dir, with no global lock; see backends.py
+#   sqlite     a row per lock in the state_db database; see backends.py
+#   memory     in this process only, for embedding and tests; see backends.py
+BACKENDS = ['file', 'directory', 'sqlite', 'memory']
+DEFAULT_BACKEND = 'file'
+# How long after a lock's time_expiry watch() looks for it to have gone.
+EXPIRY_WAKE_DELAY = 0.05
+
+
+def _copy_state(statefiledata):
+    '''
+        A copy of a state structure that shares nothing mutable with the
+        original.  Locks are flat dicts of scalars, so two levels is enough.
+    '''
+    return {key: dict(value) if isinstance(value, dict) else value
+            for (key, value) in statefiledata.items()}
 
 
 class PuppetctlStatefile(object):
@@ -28,76 +71,348 @@ class PuppetctlStatefile(object):
                 "user": "username"
             }
         }
+        That is the 'json' state_format.  There is also a compact 'binary' one,
+        and an append-only 'journal'; see stateformats.py.  Reads recognize any.
+        The 'directory' and 'sqlite' backends keep the same locks as one file
+        or one database row each instead; see backends.py.
     '''
 
-    def __init__(self, state_file=None):
+    def __init__(self, state_file=None, durability=None, lock_timeout=None, cache=False,
+                 state_format=None, journal_max_bytes=None, backend=None, state_dir=None,
+                 state_db=None, audit_log=None, audit_max_bytes=None, state_backups=None):
         ''' Init variables for PuppetctlStatefile '''
         self.defaults = {
             'state_file': DEFAULT_STATE_FILE,
+            'durability': DEFAULT_DURABILITY,
+            'lock_timeout': DEFAULT_LOCK_TIMEOUT,
+            'state_format': DEFAULT_STATE_FORMAT,
+            'journal_max_bytes': DEFAULT_JOURNAL_MAX_BYTES,
+            'state_backups': DEFAULT_STATE_BACKUPS,
+            'backend': DEFAULT_BACKEND,
+            'state_dir': DEFAULT_STATE_DIR,
+            'state_db': DEFAULT_STATE_DB,
+            'audit_max_bytes': DEFAULT_AUDIT_MAX_BYTES,
         }
         if state_file is None:
             state_file = self.defaults.get('state_file')
+        if durability is None:
+            durability = self.defaults.get('durability')
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"durability must be one of {', '.join(DURABILITY_LEVELS)}")
+        if state_format is None:
+            state_format = self.defaults.get('state_format')
+        if state_format not in STATE_FORMATS:
+            raise ValueError(f"state_format must be one of {', '.join(STATE_FORMATS)}")
+        if backend is None:
+            backend = self.defaults.get('backend')
+        if backend not in BACKENDS and not isinstance(backend, PuppetctlBackend):
+            raise ValueError(f"backend must be one of {', '.join(BACKENDS)}")
+        if state_dir is None:
+            state_dir = self.defaults.get('state_dir')
+        if state_db is None:
+            state_db = self.defaults.get('state_db')
+        if lock_timeout is None:
+            lock_timeout = self.defaults.get('lock_timeout')
+        # config files hand us strings.
+        lock_timeout = float(lock_timeout)
+        if lock_timeout < 0:
+            raise ValueError('lock_timeout must be zero or more seconds')
+        if journal_max_bytes is None:
+            journal_max_bytes = self.defaults.get('journal_max_bytes')
+        journal_max_bytes = int(journal_max_bytes)
+        if journal_max_bytes < 0:
+            raise ValueError('journal_max_bytes must be zero or more')
+        if state_backups is None:
+            state_backups = self.defaults.get('state_backups')
+        state_backups = int(state_backups)
+        if state_backups < 0:
+            raise ValueError('state_backups must be zero or more')
         self.state_file = state_file
+        # The state file itself is replaced on every write, so we can't lock it.
+        # Lock a sibling that never moves instead.
+        self.lock_file = f'{state_file}.lock'
+        self.durability = durability
+        self.lock_timeout = lock_timeout
+        # What we write.  What we read can be either.
+        self.state_format = state_format
+        self.journal_max_bytes = journal_max_bytes
+        self.state_backups = state_backups
+        self.state_dir = state_dir
+        self.state_db = state_db
+        # config files hand us strings here, too.
+        if isinstance(cache, str):
+            cache = cache.strip().lower() in ['1', 'yes', 'true', 'on']
+        # When caching, we keep the last parse of the state file, keyed by the
+        # stat() of the file it came from.  Long-lived callers that poll
+        # then pay a stat() per query while the file is unchanged.
+        self.cache = bool(cache)
+        if isinstance(backend, PuppetctlBackend):
+            # An embedder's own, or one shared with another statefile.
+            self.backend_object = backend
+        elif backend == 'directory':
+            self.backend_object = PuppetctlDirectoryBackend(state_dir, durability)
+        elif backend == 'sqlite':
+            self.backend_object = PuppetctlSqliteBackend(state_db, durability, lock_timeout)
+        elif backend == 'memory':
+            self.backend_object = PuppetctlMemoryBackend()
+        else:
+            self.backend_object = PuppetctlFileBackend(self)
+        self.backend = self.backend_object.name
+        # The audit log sits beside the state file, like the lock file, unless
+        # the locks live in memory.  An empty string turns it off.
+        if audit_log is None:
+            audit_log = f'{state_file}.audit' if self.backend_object.root_only else ''
+        if audit_max_bytes is None:
+            audit_max_bytes = self.defaults.get('audit_max_bytes')
+        audit_max_bytes = int(audit_max_bytes)
+        if audit_max_bytes < 0:
+            raise ValueError('audit_max_bytes must be zero or more')
+        self.audit_log = audit_log
+        self.audit_max_bytes = audit_max_bytes
+        # Made on first use; a status check never needs it.
+        self._audit_log_object = None
         self.bogus_state_file = BOGUS_STATE_FILE
         self.flag_state_disable = 'disable'
         self.flag_state_noop = 'nooperate'
         self.statefile_locktypes = [self.flag_state_disable, self.flag_state_noop]
         self.empty_state_file_contents = {}
+        self._active_session = None
+        # What the last load did to recover a damaged state file, as a
+        # sentence to log, or None if it didn't need to.
+        self.last_recovery = None
+        # Counters for how the state file lock is behaving.  lock_wait_* only
+        # accumulate when we actually had to wait on someone else.
+        self.metrics = {
+            'lock_acquired': 0,
+            'lock_contended': 0,
+            'lock_timeouts': 0,
+            'lock_wait_seconds': 0.0,
+            'lock_wait_max': 0.0,
+            # queries answered from the binary summary header alone
+            'summary_reads': 0,
+            # 'journal' writes that appended, and that rewrote the file instead
+            'journal_appends': 0,
+            'journal_compactions': 0,
+            # Expired lock purges that made it to disk: how many, how many
+            # locks went, and the bytes and seconds the writes carrying them cost.
+            'gc_runs': 0,
+            'gc_locks_purged': 0,
+            'gc_bytes_written': 0,
+            'gc_seconds': 0.0,
+            # Damaged state files put right (from a backup, or a journal
+            # replayed as far as the damage), and the ones there was nothing
+            # to recover from (so were reset); and backups written.
+            'recoveries': 0,
+            'recovery_failures': 0,
+            # The recoveries that lost changes (or may have: we can't always tell).
+            'recovery_losses': 0,
+            'recovery_seconds': 0.0,
+            'backups_written': 0,
+        }
+
+    def quick_lock_summary(self):
+        '''
+            {locktype: whether there are unexpired locks of that type}, when
+            the backend can tell without a load: without parsing the locks,
+            taking the state file lock, or purging anything.  For the state
+            file, that's from the summary at the front of a binary one.
+            None when there is no summary to be had (a JSON state file, say),
+            or while a session is open, which has a better answer.  Then the
+            caller should ask a session.
+        '''
+        if self._active_session is not None:
+            return None
+        summary = self.backend_object.summary()
+        if summary is None:
+            return None
+        self.metrics['summary_reads'] += 1
+        return {locktype: summary.get(locktype, False) for locktype in self.statefile_locktypes}
 
     def _read_state_file(self, ):
         '''
             Private function.
             Perform a raw read of the state file with no embellishment.
             Do our best to return a usable structure, but if the file is
-            crap then reset it to a known good state.
+            crap then reset it to a known good state (in a write session).
+            The result is the caller's to change.
         '''
-        if not os.path.isfile(self.state_file):
-            self.reset_state_file()
-            return copy.deepcopy(self.empty_state_file_contents)
-        # at this point there is a state file.
-        with open(self.state_file,
-                  'r', encoding='utf-8') as statefile_r:
+        return _copy_state(self._load_state_file())
+
+    def _load_state_file(self, ):
+        '''
+            Private function.
+            As _read_state_file, but the result may be shared with the cache,
+            so it must not be changed.  Sessions use this, since they build
+            their own lock records from it anyway.
+        '''
+        self.last_recovery = None
+        try:
+            statefiledata = self.backend_object.load()
+        except ValueError:
+            # We have managed to get unusable data into the state file.  The
+            # backend has set aside what it could; wipe it and start over.
+            statefiledata = None
+        if statefiledata is None:
+            if self._may_repair():
+                # Nothing readable, so nothing to audit.
+                self.reset_state_file(audit=False)
+            return dict(self.empty_state_file_contents)
+        return statefiledata
+
+    @property
+    def last_write_bytes(self):
+        ''' Size of the last write, appended or not, where the backend can tell. '''
+        return self.backend_object.last_write_bytes
+
+    def wait_for_change(self, timeout=None):
+        '''
+            Wait until the locks may have changed.  Returns True if they did,
+            False if timeout seconds passed first.
+        '''
+        return self.backend_object.watch(timeout)
+
+    def watch(self, timeout=None):
+        '''
+            Generate an event each time a lock is added, removed or expires,
+            as a dict of the lock's fields plus 'event' ('lock-added',
+            'lock-removed' or 'lock-expired'), 'lockid' and 'time'.  A changed
+            lock (an extend) is removed and added again, as sessions record it.
+            Locks there when we start aren't reported.  Sleeps on the backend's
+            watch (inotify, where it can) between writes, and wakes at each
+            lock's expiry, since nothing need be written when one expires.
+            Stops after timeout seconds if given, else runs for ever.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        version = self.backend_object.version()
+        known = self.read_state_file()
+        while True:
+            wait = None
+            if known:
+                # A lock is expired once now is past its time_expiry.
+                next_expiry = min(x['time_expiry'] for x in known.values())
+                wait = max(0, next_expiry - time.time()) + EXPIRY_WAKE_DELAY
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                wait = remaining if wait is None else min(wait, remaining)
+            self.backend_object.watch(wait, since=version)
+            version = self.backend_object.version()
+            current = self.read_state_file()
+            now = time.time()
+            for lockid in sorted(known):
+                if current.get(lockid) != known[lockid]:
+                    event = 'lock-expired' if known[lockid]['time_expiry'] < now else 'lock-removed'
+                    yield dict(known[lockid], event=event, lockid=lockid, time=int(now))
+            for lockid in sorted(current):
+                if known.get(lockid) != current[lockid]:
+                    yield dict(current[lockid], event='lock-added', lockid=lockid, time=int(now))
+            known = current
+
+    def session(self, write=False, locked=True):
+        '''
+            Return the session that loads the state file once and serves all
+            queries and changes from memory.  If a session is already open on
+            this object, that one is handed back, so nested callers share a
+            single read (and a single write).
+            write=True sessions hold the state file lock exclusively, so nobody
+            else can read-modify-write underneath them.  Read sessions hold it
+            shared, if they could write and are locked; other readers don't
+            take it, and so never wait on a writer.
+        '''
+        if self._active_session is None:
+            return PuppetctlStatefileSession(self, write, locked)
+        if write and not self._active_session.write:
+            # flock can't upgrade a shared lock atomically, and what we read
+            # under it might be stale by the time we had the exclusive one.
+            raise RuntimeError('cannot start a write session inside a read session')
+        return self._active_session
+
+    def _acquire_state_lock(self, exclusive):
+        '''
+            Private function.
+            Take the state file lock, shared for readers or exclusive for writers.
+            Returns (fd, seconds_waited).  fd is None when there's no lock to take:
+            a reader who can't write the state file, a caller who can't open the
+            lock file (who won't be able to write the state file either), or a
+            backend that doesn't use one.
+            Raises TimeoutError after lock_timeout seconds.
+        '''
+        if not self.backend_object.uses_lock_file:
+            return (None, 0.0)
+        if not exclusive and not self._may_write():
+            # Writes replace the state file by a rename (or append whole
+            # journal lines), so a read without the lock is still consistent.
+            # Those who can't write don't take it, so they can't hold up
+            # those who can.  (Nor do unlocked sessions; see session().)
+            return (None, 0.0)
+        if exclusive:
+            open_flags = os.O_RDWR | os.O_CREAT
+        else:
+            open_flags = os.O_RDONLY
+        try:
+            # Only those who may write can open it, and so hold it.
+            lock_fd = os.open(self.lock_file, open_flags | os.O_CLOEXEC, 0o600)
+        except OSError:
+            return (None, 0.0)
+        if exclusive:
             try:
-                statefiledata_in = json.load(statefile_r)
-            except ValueError:
-                # We have managed to get unusable json into the state file.
-                # The most likely scenario is that someone edited it by hand.
-                # Try to take a backup of it in case we want to triage...
-                try:
-                    shutil.copyfile(self.state_file, self.bogus_state_file)
-                except Exception:  # pragma: no cover  pylint: disable=locally-disabled,broad-except
-                    # Deliberately catch any error from the copy, because this is
-                    # a best-effort-only attempt to save the state file
-                    pass
-                # ... and then wipe the file and start over.
-                self.reset_state_file()
-                return copy.deepcopy(self.empty_state_file_contents)
-        if not isinstance(statefiledata_in, dict):
-            # Somehow the statefile isn't structured properly.  reset.
-            self.reset_state_file()
-            return copy.deepcopy(self.empty_state_file_contents)
-        return copy.deepcopy(statefiledata_in)
-
-    def read_state_file(self, ):
+                # One made by an older puppetctl was anyone's to open.
+                if os.fstat(lock_fd).st_mode & 0o077:
+                    os.fchmod(lock_fd, 0o600)
+            except OSError:  # pragma: no cover
+                pass
+        lock_op = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        start = time.monotonic()
+        backoff = 0.001
+        waited = 0.0
+        while True:
+            try:
+                fcntl.flock(lock_fd, lock_op | fcntl.LOCK_NB)
+                break
+            except OSError as err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):  # pragma: no cover
+                    os.close(lock_fd)
+                    raise
+            waited = time.monotonic() - start
+            if waited >= self.lock_timeout:
+                os.close(lock_fd)
+                self.metrics['lock_timeouts'] += 1
+                self._record_lock_wait(waited)
+                raise TimeoutError(f'Timed out after {waited:.1f}s waiting for '
+                                   f'the state file lock {self.lock_file}')
+            time.sleep(min(backoff, self.lock_timeout - waited))
+            backoff = min(backoff * 2, 0.05)
+        self.metrics['lock_acquired'] += 1
+        if waited:
+            waited = time.monotonic() - start
+            self._record_lock_wait(waited)
+        return (lock_fd, waited)
+
+    def _record_lock_wait(self, waited):
+        ''' Private function.  Count a wait on the state file lock. '''
+        self.metrics['lock_contended'] += 1
+        self.metrics['lock_wait_seconds'] += waited
+        self.metrics['lock_wait_max'] = max(self.metrics['lock_wait_max'], waited)
+
+    @staticmethod
+    def _release_state_lock(lock_fd):
+        ''' Private function.  Drop a lock from _acquire_state_lock. '''
+        if lock_fd is not None:
+            # closing the fd drops the flock.
+            os.close(lock_fd)
+
+    def read_state_file(self, locked=True):
         '''
             Public function.
             Read the statefile, but massage it to where we don't report back
-            on any expired locks.  Keep in mind that we may be reading the
-            state file as a non-root user, so we end up doing double work,
-            cleaning up expired locks on the thing we're going to report back,
-            and also purging those same locks from the file (except that
-            a write won't happen if we're not root).
-        '''
-        statefiledata_in = self._read_state_file()
-        statefiledata_out = copy.deepcopy(statefiledata_in)
-        for (lockid, lockitem) in statefiledata_in.items():
-            if lockitem['time_expiry'] < time.time():
-                # Remove it from the mem copy we're going to return...
-                del statefiledata_out[lockid]
-                # ... and from the disk copy (which we may not be
-                # able to do for permissions reasons)
-                self.remove_lock(lockid)
-        return statefiledata_out
+            on any expired locks.  They stay in the file until a write (or
+            purge_expired_locks) clears them out; a read never writes.
+            locked=False reads without the state file lock, as those who
+            can't write always do, for a reader that mustn't wait on writers.
+        '''
+        with self.session(locked=locked) as session:
+            return session.read_state_file()
 
     @staticmethod
     def _allowed_to_write_statefile():  # pragma: no cover
@@ -105,39 +420,140 @@ class PuppetctlStatefile(object):
         # This is a very simple function; we stomp it in mock testing, though.
         # In normal operations, we only want root to write to the state
         # file.  We're okay with nonroot doing reads for status-like
-        # things.  Since a read operation can trigger cleanups, we could
-        # end up with nonroot users being the first user on a clean box
-        # and becoming owners of the statefile, or them failing to write
-        # in the more general case.  So just return True to pretend like
-        # we wrote a state file even if we didn't, because it doesn't
-        # matter.  A nonroot is just going to get statuses which we'll
-        # soft-filter.  The next root call can do the real writing.
+        # things; reads never write, so a nonroot can't become the owner
+        # of the statefile on a clean box.  If a nonroot does get into a
+        # write, just return False to skip it, because it doesn't matter.
+        # The next root call can do the real writing.
         if os.geteuid() == 0:
             return True
         return False
 
-    def write_state_file(self, json_obj):
-        ''' Commit a blob to the state file.  Return True upon success. '''
-        if not self._allowed_to_write_statefile():
+    def write_state_file(self, json_obj, changes=None):
+        '''
+            Commit a blob to the state file.  Return True upon success.
+            'changes' is how json_obj differs from what's in the file now, as
+            (op, lockid, lock) tuples; a 'journal' state file appends those
+            instead of being rewritten, when it can, and the other backends
+            apply only those.
+        '''
+        if not self._may_write():
             return False
-        with open(self.state_file,
-                  'w', encoding='utf-8') as statefile_w:
-            json.dump(json_obj, statefile_w, sort_keys=True, indent=4)
-            statefile_w.write('\n')
         # This write could raise.
-        return True
+        result = self.backend_object.commit(json_obj, changes)
+        if result:
+            self._audit_purged()
+        return result
+
+    def _audit_purged(self):
+        '''
+            Private function.  Audit the expired locks the last write removed
+            on its own: those a backend leaves out of loads, so that no
+            session ever saw them to audit.
+        '''
+        self._audit([('expire', lockid, lockitem) for (lockid, lockitem)
+                     in sorted(self.backend_object.last_purged.items())])
 
-    def reset_state_file(self):
-        ''' Wipe out the state file using our default setting '''
+    def _may_write(self):
+        ''' Private function.  Whether we can write to our backend. '''
+        if not self.backend_object.root_only:
+            return True
+        return self._allowed_to_write_statefile()
+
+    def _may_repair(self):
+        '''
+            Private function.
+            Whether a load may write to the state file: purge expired locks,
+            or put right (or set aside) a damaged file.  Only a write session
+            may, so reads never change anything, nor open anything to write.
+        '''
+        session = self._active_session
+        return session is not None and session.write and self._may_write()
+
+    def reset_state_file(self, audit=True):
+        '''
+            Wipe out the state file using our default setting.  Unless audit is
+            False, any locks we can still read are audited as broken (or
+            expired, if they were).
+        '''
         try:
-            return self.write_state_file(self.empty_state_file_contents)
+            if self._active_session is not None:
+                # The session already holds the lock.
+                return self._reset_and_audit(audit)
+            (lock_fd, _waited) = self._acquire_state_lock(exclusive=True)
+            try:
+                return self._reset_and_audit(audit)
+            finally:
+                self._release_state_lock(lock_fd)
         except IOError:
+            # This includes timing out on the lock.
             return False
 
-    def add_lock(self, user, locktype, expiry, message=''):
+    def _reset_and_audit(self, audit):
+        ''' Private function.  The write of a reset, under the state file lock. '''
+        broken = {}
+        if audit and self.audit_log_object is not None and self._may_write():
+            try:
+                broken = self.backend_object.load() or {}
+            except (OSError, ValueError):
+                # Damaged, which is likely why we're resetting.  Nothing to audit.
+                pass
+        result = self.write_state_file(self.empty_state_file_contents)
+        if result:
+            now = time.time()
+            self._audit([('expire' if lockitem['time_expiry'] < now else 'break', lockid, lockitem)
+                         for (lockid, lockitem) in sorted(broken.items())])
+        return result
+
+    @property
+    def audit_log_object(self):
+        ''' The PuppetctlAuditLog we append to, or None if there's no audit log '''
+        if self._audit_log_object is None and self.audit_log:
+            from .audit import PuppetctlAuditLog  # pylint: disable=import-outside-toplevel
+            self._audit_log_object = PuppetctlAuditLog(self.audit_log, self.audit_max_bytes)
+        return self._audit_log_object
+
+    def _audit(self, events):
         '''
-            Add a lock to the state file.  lockid if it commits, False if not
+            Private function.  Append (event, lockid, lock) events to the audit
+            log, after the write that made them.
+        '''
+        if self.audit_log_object is None or not events:
+            return
+        from .audit import audit_record  # pylint: disable=import-outside-toplevel
+        now = time.time()
+        try:
+            self.audit_log_object.append([audit_record(event, lockid, lockitem, now)
+                                          for (event, lockid, lockitem) in events])
+        except OSError:
+            # The locks are written, which is what matters; the audit log is
+            # a best-effort record, and must not fail the change it records.
+            pass
+
+    def import_state_file(self, source_file):
+        '''
+            Copy the unexpired locks from a state file (in any state_format)
+            into the 'sqlite' backend, keeping the locks it already has.
+            Returns how many were copied.  Raises ValueError if we aren't
+            using the 'sqlite' backend or the file can't be decoded, and
+            OSError if it can't be read.
         '''
+        if self.backend_object.name != 'sqlite':
+            raise ValueError("importing a state file needs the 'sqlite' backend")
+        with open(source_file, 'rb') as statefile_r:
+            statefiledata = decode_state(statefile_r.read())
+        try:
+            statefiledata = {lockid: PuppetctlLock.from_dict(lockid, lockitem).as_dict()
+                             for (lockid, lockitem) in statefiledata.items()}
+        except (AttributeError, KeyError, TypeError) as err:
+            raise ValueError(f'{source_file} does not hold puppetctl locks') from err
+        if not self._may_write():
+            return 0
+        imported = self.backend_object.import_state(statefiledata)
+        self._audit_purged()
+        return imported
+
+    def _validate_lock(self, user, locktype, expiry, message):
+        ''' Raise ValueError if the parameters can't make a lock '''
         if not re.match(r'^\w+$', user):
             raise ValueError('user must be an alphanumeric string')
         if not locktype in self.statefile_locktypes:
@@ -146,11 +562,306 @@ class PuppetctlStatefile(object):
             raise ValueError('expiry must epoch seconds in the future')
         if not isinstance(message, str):
             raise ValueError('message must be a string')
-        if self._get_lock_ids(locktype, user):
+
+    def purge_expired_locks(self):
+        '''
+            Remove every expired lock from the state file, in one write.
+            Returns how many were removed; 0 if there were none, or we couldn't
+            write.  Reads only hide expired locks, so this (or any change to
+            the locks) is what clears them out.
+        '''
+        with self.session(write=True) as session:
+            if session.purge_pending and session.commit():
+                return len(session.expired_lock_ids)
+        return 0
+
+    def add_lock(self, user, locktype, expiry, message=''):
+        '''
+            Add a lock to the state file.  lockid if it commits, False if not
+        '''
+        with self.session(write=True) as session:
+            lockid = session.add_lock(user, locktype, expiry, message)
+            if lockid and session.commit():
+                return lockid
+        return False
+
+    def remove_lock(self, lockids):
+        ''' Remove one-or-many locks from the state file '''
+        with self.session(write=True) as session:
+            session.remove_lock(lockids)
+            return session.commit()
+
+    def apply_changes(self, operations):
+        '''
+            Apply a list of lock operations together: all of them in one write,
+            or none of them.  Each operation is a dict:
+                {'op': 'add', 'user': ..., 'locktype': ..., 'expiry': ..., 'message': ...}
+                {'op': 'remove', 'lockid': ...}
+                {'op': 'extend', 'lockid': ..., 'expiry': ...}
+            remove and extend may name 'user' and 'locktype' instead of 'lockid',
+            meaning that user's lock of that type.  message is optional.
+            Returns the lockids of the added locks, in order, or False if the
+            write failed.  Raises ValueError, writing nothing, if any operation
+            can't be done.
+        '''
+        with self.session(write=True) as session:
+            added = session.apply_changes(operations)
+            if session.commit():
+                return added
+        return False
+
+    def get_disable_lock_ids(self, user=None):
+        ''' Wrapper to list disable locks '''
+        return self._get_lock_ids(self.flag_state_disable, user)
+
+    def get_noop_lock_ids(self, user=None):
+        ''' Wrapper to list noop locks '''
+        return self._get_lock_ids(self.flag_state_noop, user)
+
+    def _get_lock_ids(self, locktype, user=None):
+        '''
+            Get the locks of a particular type, and if there's a user, also limit by that user.
+        '''
+        with self.session() as session:
+            return session.get_lock_ids(locktype, user)
+
+    def get_lock_info(self, lockid):
+        ''' Get information about a lock from the state file '''
+        with self.session() as session:
+            return session.get_lock_info(lockid)
+
+    def get_lock(self, lockid):
+        ''' The PuppetctlLock with this id, or None '''
+        with self.session() as session:
+            return session.get_lock(lockid)
+
+    def get_locks(self, locktype=None, user=None):
+        '''
+            PuppetctlLock records, of a type and/or for a user if given,
+            soonest expiry first.
+        '''
+        with self.session() as session:
+            return session.get_locks(locktype, user)
+
+    def next_expiry(self, locktype=None):
+        '''
+            (time_expiry, lockid) of the lock that expires soonest, of one
+            locktype or of any.  None if there are no locks.
+        '''
+        with self.session() as session:
+            return session.next_expiry(locktype)
+
+    def format_lock_info(self, lock):
+        ''' Turn a lock structure into a human-readable sentence '''
+        if lock['locktype'] == self.flag_state_disable:
+            tstr1 = 'Puppet has been disabled by {user} at {begintime} until {endtime}{message}'
+        elif lock['locktype'] == self.flag_state_noop:
+            tstr1 = 'Puppet is in nooperate mode by {user} at {begintime} until {endtime}{message}'
+        else:  # pragma: no cover
+            # This should never happen, all the above if's are the only allowed values
+            raise ValueError('locktype was not valid')
+
+        tstr2 = f" with the following message: {lock['message']}" if lock['message'] else ''
+        outputstring = tstr1.format(user=lock['user'],
+                                    begintime=time.ctime(lock['time_begin']),
+                                    endtime=time.ctime(lock['time_expiry']),
+                                    message=tstr2,)
+        return outputstring
+
+
+class PuppetctlStatefileSession(object):
+    '''
+        One load of the state file.  All queries and changes are served from
+        memory, and the file is written at most once, either by an explicit
+        commit() or when the outermost 'with' block exits cleanly:
+
+        with statefile.session(write=True) as session:
+            if not session.get_disable_lock_ids(user):
+                session.add_lock(user, 'disable', expiry)
+                session.commit()
+
+        Expired locks are dropped while loading.  A write session writes that
+        purge out along with any other change, so it costs no extra writes.
+        Read sessions never write: not the purge, and not the repair of a
+        damaged file, and they don't create the lock file either.  So the
+        status checks any user runs have no side effects.
+    '''
+    # A session is the statefile's own machinery, split out; it uses the private parts.
+    # pylint: disable=protected-access
+
+    def __init__(self, statefile_object, write=False, locked=True):
+        ''' Init variables for PuppetctlStatefileSession '''
+        self.statefile_object = statefile_object
+        self.write = write
+        # Whether a read session takes the state file lock; a write session always does.
+        self.locked = locked or write
+        self.locks = None
+        self.expired_lock_ids = []
+        # Whether the expired locks still have to be written out of the file.
+        self.purge_pending = False
+        # Seconds spent finding the expired locks, until they're written out.
+        self._purge_seconds = 0.0
+        # What we did to the locks since load, for state formats that record it.
+        self.changes = []
+        # The same, as (event, lockid, lock) for the audit log.
+        self.audit = []
+        self.dirty = False
+        self.depth = 0
+        self.lock_fd = None
+        # Seconds we spent waiting on someone else's lock; 0.0 if there was no contention.
+        self.lock_wait = 0.0
+        # How the load recovered a damaged state file, to log; None if it didn't.
+        self.recovery = None
+
+    def __enter__(self):
+        ''' Lock and load the state file, unless we are nested inside an open session '''
+        if self.depth == 0:
+            if self.locked:
+                (self.lock_fd, self.lock_wait) = \
+                    self.statefile_object._acquire_state_lock(exclusive=self.write)
+            try:
+                self.statefile_object._active_session = self
+                self.load()
+            except BaseException:
+                self.statefile_object._active_session = None
+                self.statefile_object._release_state_lock(self.lock_fd)
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''
+            Write out any pending changes when the outermost block finishes cleanly,
+            then let go of the lock.
+        '''
+        self.depth -= 1
+        if self.depth == 0:
+            try:
+                if exc_type is None:
+                    self.commit()
+            finally:
+                self.statefile_object._active_session = None
+                self.statefile_object._release_state_lock(self.lock_fd)
+                self.lock_fd = None
+        return False
+
+    def load(self):
+        ''' Read the state file into a lock table, and set aside any expired locks '''
+        statefiledata = self.statefile_object._load_state_file()
+        self.recovery = self.statefile_object.last_recovery
+        self.locks = PuppetctlLockTable.from_state(statefiledata)
+        start = time.monotonic()
+        self.expired_lock_ids = self.locks.pop_expired(time.time())
+        self._purge_seconds = time.monotonic() - start
+        # Writing the purge is up to write sessions; readers just don't see
+        # the expired locks, and don't try.
+        self.purge_pending = (bool(self.expired_lock_ids) and
+                              self.statefile_object._may_repair())
+        if self.purge_pending:
+            self.changes = [('expire', lockid, None) for lockid in self.expired_lock_ids]
+            self.audit = [('expire', lockid, statefiledata[lockid])
+                          for lockid in self.expired_lock_ids]
+        else:
+            self.changes = []
+            self.audit = []
+        self.dirty = self.purge_pending
+
+    def commit(self):
+        '''
+            Write the state file if anything changed.  Return True upon success,
+            or if there was nothing to write.
+        '''
+        if not self.dirty:
+            return True
+        # Clear the flag first: a failed write is reported to the caller,
+        # and should not be retried behind their back when the session closes.
+        self.dirty = False
+        (changes, self.changes) = (self.changes, [])
+        (audit, self.audit) = (self.audit, [])
+        start = time.monotonic()
+        result = self.statefile_object.write_state_file(self.locks.as_state(), changes)
+        if result:
+            self.statefile_object._audit(audit)
+        if self.purge_pending:
+            self.purge_pending = False
+            if result:
+                metrics = self.statefile_object.metrics
+                metrics['gc_runs'] += 1
+                metrics['gc_locks_purged'] += len(self.expired_lock_ids)
+                metrics['gc_bytes_written'] += self.statefile_object.last_write_bytes
+                metrics['gc_seconds'] += self._purge_seconds + time.monotonic() - start
+        return result
+
+    def read_state_file(self):
+        ''' Return the unexpired locks as a new state structure (dicts) '''
+        return self.locks.as_state()
+
+    def snapshot(self):
+        '''
+            Return the unexpired locks as a read-only {lockid: PuppetctlLock}
+            mapping.  It costs no copying, and later changes in this session
+            don't show up in it.
+        '''
+        return self.locks.snapshot()
+
+    def get_disable_lock_ids(self, user=None):
+        ''' Wrapper to list disable locks '''
+        return self.get_lock_ids(self.statefile_object.flag_state_disable, user)
+
+    def get_noop_lock_ids(self, user=None):
+        ''' Wrapper to list noop locks '''
+        return self.get_lock_ids(self.statefile_object.flag_state_noop, user)
+
+    def get_lock_ids(self, locktype, user=None):
+        '''
+            Get the locks of a particular type, and if there's a user, also limit by that user.
+        '''
+        return self.locks.ids(locktype, user)
+
+    def has_locks(self, locktype, user=None):
+        ''' Whether there are any locks of a type (for a user, if given) '''
+        return self.locks.count(locktype, user) > 0
+
+    def next_expiry(self, locktype=None):
+        '''
+            (time_expiry, lockid) of the lock that expires soonest, of one
+            locktype or of any.  None if there are no locks.
+        '''
+        return self.locks.next_expiry(locktype)
+
+    def get_lock(self, lockid):
+        ''' The PuppetctlLock with this id, or None '''
+        return self.locks.get(lockid, None)
+
+    def get_locks(self, locktype=None, user=None):
+        '''
+            PuppetctlLock records, of a type and/or for a user if given,
+            soonest expiry first.
+        '''
+        if locktype is None:
+            locktypes = self.statefile_object.statefile_locktypes
+        else:
+            locktypes = [locktype]
+        locks = [self.locks.get(lockid) for ltype in locktypes
+                 for lockid in self.locks.ids(ltype, user)]
+        return sorted(locks, key=lambda x: (x.time_expiry, x.lockid))
+
+    def get_lock_info(self, lockid):
+        ''' Get information about a lock '''
+        lock = self.locks.get(lockid, None)
+        if lock is None:
+            return ''
+        return self.statefile_object.format_lock_info(lock)
+
+    def add_lock(self, user, locktype, expiry, message=''):
+        '''
+            Add a lock to the session.  lockid if it was added, False if not.
+            Nothing is written until commit.
+        '''
+        self.statefile_object._validate_lock(user, locktype, expiry, message)
+        if self.has_locks(locktype, user):
             # one lock of a type per user.
             return False
-        statefiledata_in = self.read_state_file()
-        statefiledata_out = copy.deepcopy(statefiledata_in)
         lockitem = {
             'user': user,
             'locktype': locktype,
@@ -172,64 +883,459 @@ class PuppetctlStatefile(object):
             md5obj = hashlib.md5()
             md5obj.update(_junk_str.encode('utf-8'))
             hashstr = md5obj.hexdigest()[:8]
-            if hashstr not in statefiledata_out:
+            if hashstr not in self.locks and hashstr not in self.expired_lock_ids:
                 break
-        statefiledata_out[hashstr] = lockitem
-        if self.write_state_file(statefiledata_out):
-            return hashstr
-        return False
+        lock = PuppetctlLock.from_dict(hashstr, lockitem)
+        self.locks.add(lock)
+        self.changes.append(('add', hashstr, lock.as_dict()))
+        self.audit.append(('add', hashstr, lock.as_dict()))
+        self.dirty = True
+        return hashstr
+
+    def extend_lock(self, lockid, expiry):
+        '''
+            Give a lock a new expiry (sooner or later).  Nothing is written until commit.
+            Raises KeyError if there's no such lock, ValueError if the expiry is bad.
+        '''
+        lock = self.locks.get(lockid)
+        if lock is None:
+            raise KeyError(lockid)
+        self.statefile_object._validate_lock(lock.user, lock.locktype, expiry, lock.message)
+        self.locks.remove(lockid)
+        lock = lock.replace(time_expiry=int(expiry))
+        self.locks.add(lock)
+        self.changes.append(('remove', lockid, None))
+        self.changes.append(('add', lockid, lock.as_dict()))
+        self.audit.append(('extend', lockid, lock.as_dict()))
+        self.dirty = True
+        return True
+
+    def _operation_lock_ids(self, operation):
+        ''' Private function.  The locks a remove or extend operation is about. '''
+        if 'lockid' in operation:
+            return [operation['lockid']]
+        if 'user' in operation and 'locktype' in operation:
+            lockids = self.get_lock_ids(operation['locktype'], operation['user'])
+            if lockids:
+                return lockids
+            raise KeyError(f"{operation['user']} has no {operation['locktype']} lock")
+        raise ValueError("needs a 'lockid', or a 'user' and 'locktype'")
+
+    def apply_changes(self, operations):
+        '''
+            Apply a list of lock operations to the session; see
+            PuppetctlStatefile.apply_changes.  Returns the lockids added.
+            Raises ValueError on the first operation that can't be done; the
+            caller should then leave the session without committing.
+        '''
+        if not isinstance(operations, list):
+            raise ValueError('operations must be a list')
+        added = []
+        for (index, operation) in enumerate(operations):
+            try:
+                if not isinstance(operation, dict):
+                    raise ValueError('operation must be a dict')
+                if operation.get('op') == 'add':
+                    lockid = self.add_lock(operation.get('user', ''), operation.get('locktype'),
+                                           operation.get('expiry'), operation.get('message', ''))
+                    if not lockid:
+                        raise ValueError(f"{operation['user']} already has a "
+                                         f"{operation['locktype']} lock")
+                    added.append(lockid)
+                elif operation.get('op') == 'remove':
+                    self.remove_lock(self._operation_lock_ids(operation))
+                elif operation.get('op') == 'extend':
+                    for lockid in self._operation_lock_ids(operation):
+                        self.extend_lock(lockid, operation.get('expiry'))
+                else:
+                    raise ValueError("'op' must be add, remove or extend")
+            except KeyError as err:
+                raise ValueError(f'operation {index}: no such lock: {err.args[0]}') from err
+            except (ValueError, TypeError) as err:
+                raise ValueError(f'operation {index}: {err}') from err
+        return added
 
     def remove_lock(self, lockids):
-        ''' Remove one-or-many locks from the state file '''
-        statefiledata_in = self._read_state_file()
-        statefiledata_out = copy.deepcopy(statefiledata_in)
+        '''
+            Remove one-or-many locks from the session.  Nothing is written until commit.
+            Raises KeyError if a lock never existed.
+        '''
         if not isinstance(lockids, list):
             lockids = [lockids]
         for lockid in lockids:
-            del statefiledata_out[lockid]
-        return self.write_state_file(statefiledata_out)
+            if lockid in self.expired_lock_ids:
+                # Already on its way out of the file.
+                continue
+            lock = self.locks.remove(lockid)
+            self.changes.append(('remove', lockid, None))
+            self.audit.append(('remove', lockid, lock.as_dict()))
+            self.dirty = True
+        return True
 
-    def get_disable_lock_ids(self, user=None):
-        ''' Wrapper to list disable locks '''
-        return self._get_lock_ids(self.flag_state_disable, user)
 
-    def get_noop_lock_ids(self, user=None):
-        ''' Wrapper to list noop locks '''
-        return self._get_lock_ids(self.flag_state_noop, user)
+class PuppetctlFileBackend(PuppetctlBackend):
+    '''
+        The state file backend: the locks in one file, in the statefile's
+        state_format, written whole by an atomic rename (or appended to, for a
+        'journal').  Concurrent sessions serialize on the statefile's lock
+        file.  This is the statefile's own machinery, so its settings (file
+        names, format, durability, caching) are read from the statefile.
+    '''
+    # pylint: disable=protected-access
+    name = 'file'
+    uses_lock_file = True
 
-    def _get_lock_ids(self, locktype, user=None):
+    def __init__(self, statefile_object):
+        ''' Init variables for PuppetctlFileBackend '''
+        super().__init__()
+        self.statefile_object = statefile_object
+        self._cache_key = None
+        self._cache_data = None
+
+    def load(self):
         '''
-            Get the locks of a particular type, and if there's a user, also limit by that user.
+            Read the state file.  None if there's no file.  If it's unusable,
+            recover the newest good backup (ValueError if there is none), and
+            in a write session take a copy of it to the bogus state file.
+            The result may be shared with the cache, so it must not be changed.
         '''
-        statefiledata_in = self.read_state_file()
-        statefiledata_out = copy.deepcopy(statefiledata_in)
-        for (lockid, _lockitem) in statefiledata_in.items():
-            if statefiledata_in[lockid]['locktype'] != locktype:
-                del statefiledata_out[lockid]
+        state_file = self.statefile_object.state_file
+        try:
+            statinfo = os.stat(state_file)
+        except OSError:
+            statinfo = None
+        if statinfo is None or not stat.S_ISREG(statinfo.st_mode):
+            return None
+        if self.statefile_object.cache and self._cache_key == self._stat_cache_key(statinfo):
+            return self._cache_data
+        # at this point there is a state file.
+        with open(state_file, 'rb') as statefile_r:
+            # Key the cache on the file we actually opened, not the one we
+            # stat'ed above, in case it was replaced in between.
+            cache_key = self._stat_cache_key(os.fstat(statefile_r.fileno()))
+            data = statefile_r.read()
+            try:
+                statefiledata_in = decode_state(data)
+                if not isinstance(statefiledata_in, dict):
+                    # Somehow the statefile isn't structured properly.
+                    raise ValueError(f'{state_file} does not hold a dict of locks')
+            except ValueError:
+                # The most likely scenario is that someone edited it by hand.
+                # Try to take a backup of it in case we want to triage, if
+                # we're the ones who will put it right...
+                if self.statefile_object._may_repair():
+                    try:
+                        shutil.copyfile(state_file, self.statefile_object.bogus_state_file)
+                    # Deliberately catch any error from the copy, because this is
+                    # a best-effort-only attempt to save the state file
+                    # pylint: disable=locally-disabled,broad-except
+                    except Exception:  # pragma: no cover
+                        pass
+                statefiledata_in = self._recover(data)
+                if statefiledata_in is None:
+                    raise
+                return statefiledata_in
+        self._update_cache(cache_key, statefiledata_in)
+        return statefiledata_in
+
+    def _backup_files(self):
+        ''' Private function.  The names of the backups of the state file. '''
+        state_file = self.statefile_object.state_file
+        return [f'{state_file}.backup.{num}' for num in range(self.statefile_object.state_backups)]
+
+    def _recover(self, damaged):
+        '''
+            Private function.
+            The locks recovered from a damaged state file's contents (bytes),
+            written back as the state file in a write session.  A journal is
+            replayed as far as the damage.  Otherwise they come from the
+            newest backup that passes its checksum and decodes.  None if
+            neither will do.  Costs at most a read of each backup.  Losing
+            changes on the way is counted, and said in last_recovery.
+        '''
+        start = time.monotonic()
+        metrics = self.statefile_object.metrics
+        if damaged.startswith(JOURNAL_MAGIC):
+            try:
+                (statefiledata, lost) = salvage_journal(damaged)
+            except ValueError:
+                pass
+            else:
+                self._recovered(statefiledata, start,
+                                f'Replayed the damaged journal {self.statefile_object.state_file}'
+                                f' as far as the damage' + (', losing nothing' if lost == 0
+                                                            else ''), lost)
+                return statefiledata
+        # Everything since the newest backup is lost: the appends to a
+        # journal, or the writes after it (which a readable trailer numbers).
+        damaged_generation = (None if damaged.startswith(JOURNAL_MAGIC)
+                              else trailer_generation(damaged))
+        candidates = []
+        for backup_file in self._backup_files():
+            try:
+                with open(backup_file, 'rb') as backup_r:
+                    data = backup_r.read()
+            except OSError:
+                continue
+            generation = trailer_generation(data)
+            candidates.append((-1 if generation is None else generation, backup_file, data))
+        for (generation, backup_file, data) in sorted(candidates, reverse=True):
+            try:
+                statefiledata = decode_state(data)
+            except ValueError:
                 continue
-            if user is not None and statefiledata_in[lockid]['user'] != user:
-                del statefiledata_out[lockid]
-        output = sorted(list(statefiledata_out.keys()),
-                        key=lambda x: statefiledata_out[x]['time_expiry'])
-        return output
+            if not isinstance(statefiledata, dict):
+                continue
+            # How many writes we lost, if we can tell, else None.
+            lost = (damaged_generation - generation
+                    if damaged_generation is not None and damaged_generation >= generation
+                    else None)
+            how = (f'Restored the damaged state file {self.statefile_object.state_file}'
+                   f' from {backup_file}')
+            if lost == 0:
+                # We wrote the same generation as the backup; what's changed
+                # in the state file since wasn't us.
+                how += ('; no change puppetctl made is lost, but any made to the file '
+                        'outside puppetctl are discarded')
+            self._recovered(statefiledata, start, how, lost)
+            return statefiledata
+        metrics['recovery_failures'] += 1
+        self.statefile_object.last_recovery = (
+            f'The state file {self.statefile_object.state_file} is damaged, and there was no '
+            f'good backup to restore; all its locks are lost.')
+        return None
 
-    def get_lock_info(self, lockid):
-        ''' Get information about a lock from the state file '''
-        statefiledata_in = self.read_state_file()
-        lock = statefiledata_in.get(lockid, None)
-        if lock is None:
-            return ''
-        if lock['locktype'] == self.flag_state_disable:
-            tstr1 = 'Puppet has been disabled by {user} at {begintime} until {endtime}{message}'
-        elif lock['locktype'] == self.flag_state_noop:
-            tstr1 = 'Puppet is in nooperate mode by {user} at {begintime} until {endtime}{message}'
-        else:  # pragma: no cover
-            # This should never happen, all the above if's are the only allowed values
-            raise ValueError('locktype was not valid')
+    def _recovered(self, statefiledata, start, how, lost):
+        '''
+            Private function.  Write back what we recovered (in a write
+            session), and count it.  lost is how many changes (journal
+            records, or writes) didn't make it, or None if we can't tell.
+        '''
+        if self.statefile_object._may_repair():
+            try:
+                self.commit(statefiledata)
+            except OSError:
+                # Readers still get the locks; the next write tries again.
+                pass
+        metrics = self.statefile_object.metrics
+        metrics['recoveries'] += 1
+        metrics['recovery_seconds'] += time.monotonic() - start
+        if lost == 0:
+            self.statefile_object.last_recovery = f'{how}.'
+            return
+        metrics['recovery_losses'] += 1
+        if lost is None:
+            self.statefile_object.last_recovery = (f'{how}; changes made since may be lost, '
+                                                   f'locks added since among them.')
+        else:
+            self.statefile_object.last_recovery = (f'{how}; the {lost} changes made since '
+                                                   f'are lost, locks added since among them.')
 
-        tstr2 = f" with the following message: {lock['message']}" if lock['message'] else ''
-        outputstring = tstr1.format(user=lock['user'],
-                                    begintime=time.ctime(lock['time_begin']),
-                                    endtime=time.ctime(lock['time_expiry']),
-                                    message=tstr2,)
-        return outputstring
+    @staticmethod
+    def _stat_cache_key(statinfo):
+        ''' Private function.  What identifies one version of the state file. '''
+        return (statinfo.st_dev, statinfo.st_ino, statinfo.st_mtime_ns, statinfo.st_size)
+
+    def _update_cache(self, cache_key, statefiledata):
+        ''' Private function.  Remember a parse of the state file, if we're caching. '''
+        if self.statefile_object.cache:
+            self._cache_key = cache_key
+            self._cache_data = _copy_state(statefiledata)
+
+    def version(self):
+        ''' The stat of the state file, which every write replaces or grows '''
+        try:
+            return self._stat_cache_key(os.stat(self.statefile_object.state_file))
+        except OSError:
+            return None
+
+    def watch_paths(self):
+        ''' The state file, which writes replace or (in a journal) grow '''
+        (parent, name) = os.path.split(os.path.abspath(self.statefile_object.state_file))
+        return (parent, [name])
+
+    def summary(self):
+        '''
+            {locktype: whether there are unexpired locks of that type}, from
+            the summary at the front of a binary state file.  Writes replace
+            the file in one rename, so the few bytes we pread are always from
+            one consistent file.  None for other formats, for a summary that
+            fails its check (so that a load finds the damage and recovers),
+            or no file at all.
+        '''
+        try:
+            summary_fd = os.open(self.statefile_object.state_file, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            # Including no file at all: a session will set one up.
+            return None
+        try:
+            if not stat.S_ISREG(os.fstat(summary_fd).st_mode):
+                return None
+            header = os.pread(summary_fd, SUMMARY_SIZE, 0)
+        finally:
+            os.close(summary_fd)
+        summary = decode_summary(header)
+        if summary is None:
+            return None
+        now = time.time()
+        # A session drops locks whose expiry is before now.  So if the
+        # latest expiry of a type isn't, that lock at least is live.
+        return {locktype: count > 0 and latest >= now
+                for (locktype, (count, _earliest, latest)) in summary.items()}
+
+    def commit(self, statefiledata, changes=None):
+        '''
+            Write the state file.  A 'journal' appends the changes instead of
+            being rewritten, when it can.  Raises if the write fails.
+        '''
+        state_format = self.statefile_object.state_format
+        statinfo = None
+        if state_format == 'journal' and changes is not None:
+            records = encode_journal_records(changes)
+            statinfo = self._journal_append(records)
+            self.last_write_bytes = len(records)
+        if statinfo is None:
+            contents = encode_state(statefiledata, state_format)
+            generation = self._next_generation()
+            backup = add_trailer(contents, generation)
+            if state_format == 'binary':
+                contents = backup
+            # Only a binary state file carries its trailer.  A journal is
+            # appended to, and a json file has to stay plain JSON: for hand
+            # edits, other tools, and older puppetctl, which resets a state
+            # file it can't parse.  Their backups have trailers all the same.
+            if state_format == 'journal':
+                self.statefile_object.metrics['journal_compactions'] += 1
+            statinfo = self._atomic_write(contents)
+            self.last_write_bytes = len(contents)
+            self._write_backup(backup, generation)
+        # We know what we just wrote, so there's no need to read it back.
+        self._update_cache(self._stat_cache_key(statinfo), statefiledata)
+        return True
+
+    def _next_generation(self):
+        '''
+            Private function.  One more than the generation of the state file,
+            from its trailer, or if it has none (as json and journal files
+            don't), the newest of its backups'.
+        '''
+        generations = []
+        for filename in [self.statefile_object.state_file] + self._backup_files():
+            try:
+                with open(filename, 'rb') as tail_r:
+                    size = os.fstat(tail_r.fileno()).st_size
+                    tail = os.pread(tail_r.fileno(), TRAILER_SIZE, max(0, size - TRAILER_SIZE))
+            except OSError:
+                continue
+            generation = trailer_generation(tail)
+            if generation is not None:
+                generations.append(generation)
+                if filename == self.statefile_object.state_file:
+                    # Only a file without a trailer needs the backups looked at.
+                    break
+        return max(generations, default=0) + 1
+
+    def _write_backup(self, contents, generation):
+        '''
+            Private function.
+            Copy what we just wrote to the backup this generation rotates to.
+            A copy, not a link, so damage to the state file's blocks can't
+            reach it.  Not synced: a backup a crash damaged fails its checksum,
+            and the one before it is used.  Failing to write one doesn't fail
+            the write it backs up.
+        '''
+        backup_files = self._backup_files()
+        if not backup_files:
+            return
+        backup_file = backup_files[generation % len(backup_files)]
+        try:
+            (tmp_fd, tmp_name) = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(backup_file)),
+                prefix=f'.{os.path.basename(backup_file)}.')
+            try:
+                with os.fdopen(tmp_fd, 'wb') as backup_w:
+                    backup_w.write(contents)
+                    os.fchmod(backup_w.fileno(), 0o644)
+                os.rename(tmp_name, backup_file)
+            except BaseException:
+                os.unlink(tmp_name)
+                raise
+        except OSError:
+            return
+        self.statefile_object.metrics['backups_written'] += 1
+
+    def _journal_append(self, records):
+        '''
+            Private function.
+            Append journal records (bytes) to the state file.  Returns the stat
+            of the file afterwards, or None if it should be rewritten instead:
+            it isn't a journal yet, ends in an unfinished append, or would grow
+            past journal_max_bytes.
+            Raises if the append itself fails.
+        '''
+        try:
+            journal_fd = os.open(self.statefile_object.state_file,
+                                 os.O_RDWR | os.O_APPEND | os.O_CLOEXEC)
+        except OSError:
+            return None
+        try:
+            statinfo = os.fstat(journal_fd)
+            if (not stat.S_ISREG(statinfo.st_mode) or
+                    statinfo.st_size + len(records) > self.statefile_object.journal_max_bytes or
+                    os.pread(journal_fd, len(JOURNAL_MAGIC), 0) != JOURNAL_MAGIC or
+                    # an unfinished append; appending after it would damage our record.
+                    os.pread(journal_fd, 1, statinfo.st_size - 1) != b'\n'):
+                return None
+            written = 0
+            while written < len(records):
+                written += os.write(journal_fd, records[written:])
+            if self.statefile_object.durability != 'none':
+                # No new directory entry, so the file is all there is to sync.
+                os.fsync(journal_fd)
+            statinfo = os.fstat(journal_fd)
+        finally:
+            os.close(journal_fd)
+        self.statefile_object.metrics['journal_appends'] += 1
+        return statinfo
+
+    def _atomic_write(self, contents):
+        '''
+            Private function.
+            Replace the state file with 'contents' (bytes) in one step.  We write
+            a temp file in the same directory and rename it over the state file,
+            so a reader (or a crash) sees either the old file or the new one,
+            never a truncated one.  Raises on failure, leaving the old file alone.
+            Returns the stat of the new file.
+        '''
+        state_file = self.statefile_object.state_file
+        statefile_dir = os.path.dirname(os.path.abspath(state_file))
+        try:
+            mode = os.stat(state_file).st_mode & 0o7777
+        except OSError:
+            # non-root users need to read this for status checks.
+            mode = 0o644
+        (tmp_fd, tmp_name) = tempfile.mkstemp(
+            dir=statefile_dir, prefix=f'.{os.path.basename(state_file)}.')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as statefile_w:
+                statefile_w.write(contents)
+                statefile_w.flush()
+                if self.statefile_object.durability != 'none':
+                    os.fsync(statefile_w.fileno())
+                os.fchmod(statefile_w.fileno(), mode)
+                # The rename keeps the inode and mtime, so this is the new file's stat.
+                statinfo = os.fstat(statefile_w.fileno())
+            os.rename(tmp_name, state_file)
+        except BaseException:
+            try:
+                os.unlink(tmp_name)
+            except OSError:  # pragma: no cover
+                pass
+            raise
+        if self.statefile_object.durability == 'directory':
+            dir_fd = os.open(statefile_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        return statinfo
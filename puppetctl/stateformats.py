@@ -0,0 +1,365 @@
+'''
+    On-disk encodings of the puppetctl state file.
+
+    'json' is the original pretty-printed format, easy to read by hand.
+    'binary' is a compact format of fixed-width records plus a string table,
+    which decodes with struct and no JSON tokenizing:
+
+        header   magic (8s), version (H), flags (H), record count (I), string count (I)
+        summary  for disable locks, then nooperate locks: count (I), earliest
+                 and latest time_expiry (2 x q); zeroes when there are none
+        check    CRC-32 (I) of the header and summary
+        records  one per lock: lockid, user, locktype, message as string-table
+                 indexes (4 x I), then time_begin, time_expiry (2 x q)
+        strings  a length (I) per string, then the UTF-8 bytes of all of them
+
+    Everything is in network byte order.  Strings that repeat (usernames,
+    locktypes, empty messages) are stored once.  The *_human fields are not
+    stored; they can be rendered from the timestamps on demand.
+
+    The summary sits at a fixed offset, so "are there live disable locks"
+    can be answered by reading SUMMARY_SIZE bytes: if the latest expiry of a
+    type hasn't passed, there's a live lock of that type, whatever the rest
+    of the file says.  The check covers those bytes, so a damaged summary is
+    never believed; the reader loads the whole file instead.  Version 1
+    files had no summary, and version 2 had no check; we still read them,
+    but don't answer from a summary without a check.
+
+    'journal' is append-only JSON lines.  A header line, then records of
+    what happened to the locks, in order:
+
+        PCTLJRNL 1
+        {"op": "snapshot", "locks": {...}, "time": ...}
+        {"op": "add", "lockid": "...", "lock": {...}, "time": ...}
+        {"op": "remove", "lockid": "...", "time": ...}
+        {"op": "expire", "lockid": "...", "time": ...}
+
+    Reading replays it.  A change appends a record or two rather than
+    rewriting the file; compacting it is writing a fresh header and a single
+    snapshot.  A last line without its newline is an append that never
+    finished, and is ignored.  A journal damaged further back can still be
+    replayed as far as the damage, by salvage_journal().
+
+    A 'binary' file, and any backup of a state file, ends in a fixed-size
+    trailer line:
+
+        PCTLSUM1 <generation, 16 hex digits> <CRC-32, 8 hex digits>
+
+    The CRC-32 covers everything before the trailer and the generation, so
+    damage is found by a checksum of the bytes, before any parsing.  The
+    generation counts writes, and orders backups.  A live journal has no
+    trailer (it's appended to), nor does a live 'json' file, which stays
+    plain JSON for other tools, hand edits and older puppetctl; its damage
+    is found by failing to parse.  Files without a trailer read as ever, and
+    so do json files written with one.
+
+    decode_state() recognizes any of the formats, so a state file can be
+    switched between them without a migration step.
+'''
+import json
+import struct
+import time
+import zlib
+
+STATE_FORMATS = ['json', 'binary', 'journal']
+DEFAULT_STATE_FORMAT = 'json'
+
+BINARY_MAGIC = b'PCTLSTAT'
+BINARY_VERSION = 3
+_BINARY_HEADER = struct.Struct('!8sHHII')
+_BINARY_SUMMARY = struct.Struct('!IqqIqq')
+_BINARY_SUMMARY_CHECK = struct.Struct('!I')
+_BINARY_RECORD = struct.Struct('!IIIIqq')
+SUMMARY_LOCKTYPES = ['disable', 'nooperate']
+SUMMARY_SIZE = _BINARY_HEADER.size + _BINARY_SUMMARY.size + _BINARY_SUMMARY_CHECK.size
+
+JOURNAL_MAGIC = b'PCTLJRNL'
+JOURNAL_VERSION = 1
+JOURNAL_OPS = ['snapshot', 'add', 'remove', 'expire']
+
+TRAILER_MAGIC = b'PCTLSUM1'
+TRAILER_SIZE = len(TRAILER_MAGIC) + 1 + 16 + 1 + 8 + 1
+
+
+def humanize_lock(lockitem):
+    ''' Return a copy of a lock with the *_human fields filled in from the timestamps '''
+    lockitem = dict(lockitem)
+    for field in ['time_begin', 'time_expiry']:
+        if field in lockitem:
+            lockitem[f'{field}_human'] = time.ctime(int(lockitem[field]))
+    return lockitem
+
+
+def encode_json(statefiledata):
+    ''' Encode a state dict in the human-readable JSON format '''
+    humanized = {lockid: humanize_lock(lockitem) if isinstance(lockitem, dict) else lockitem
+                 for (lockid, lockitem) in statefiledata.items()}
+    return (json.dumps(humanized, sort_keys=True, indent=4) + '\n').encode('utf-8')
+
+
+def encode_binary(statefiledata):
+    ''' Encode a state dict in the compact binary format '''
+    strings = []
+    string_index = {}
+
+    def intern(value):
+        ''' Put a string in the table once, and return where it is '''
+        if value not in string_index:
+            string_index[value] = len(strings)
+            strings.append(value.encode('utf-8'))
+        return string_index[value]
+
+    records = []
+    summary = {locktype: [0, 0, 0] for locktype in SUMMARY_LOCKTYPES}
+    for (lockid, lockitem) in sorted(statefiledata.items()):
+        if lockitem['locktype'] in summary:
+            (count, earliest, latest) = summary[lockitem['locktype']]
+            expiry = int(lockitem['time_expiry'])
+            summary[lockitem['locktype']] = [count + 1,
+                                             min(earliest, expiry) if count else expiry,
+                                             max(latest, expiry) if count else expiry]
+        records.append(_BINARY_RECORD.pack(intern(lockid),
+                                           intern(lockitem['user']),
+                                           intern(lockitem['locktype']),
+                                           intern(lockitem['message']),
+                                           int(lockitem['time_begin']),
+                                           int(lockitem['time_expiry'])))
+    header = _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, len(records), len(strings))
+    header += _BINARY_SUMMARY.pack(*[x for locktype in SUMMARY_LOCKTYPES
+                                     for x in summary[locktype]])
+    header += _BINARY_SUMMARY_CHECK.pack(zlib.crc32(header))
+    lengths = struct.pack(f'!{len(strings)}I', *[len(x) for x in strings])
+    return b''.join([header] + records + [lengths] + strings)
+
+
+def decode_summary(data):
+    '''
+        Decode the summary at the front of a binary state file: {locktype:
+        (count, earliest time_expiry, latest time_expiry)}.  data need only
+        be the first SUMMARY_SIZE bytes.  None if there is no summary to be
+        believed: a JSON file, one from before the summary was checked, too
+        little data, or a summary that fails its check.
+    '''
+    if len(data) < SUMMARY_SIZE:
+        return None
+    (magic, version, _flags, _record_count, _string_count) = _BINARY_HEADER.unpack_from(data, 0)
+    if magic != BINARY_MAGIC or version < 3:
+        return None
+    checked = SUMMARY_SIZE - _BINARY_SUMMARY_CHECK.size
+    if zlib.crc32(data[:checked]) != _BINARY_SUMMARY_CHECK.unpack_from(data, checked)[0]:
+        return None
+    values = _BINARY_SUMMARY.unpack_from(data, _BINARY_HEADER.size)
+    return {locktype: values[3*ix:3*ix+3] for (ix, locktype) in enumerate(SUMMARY_LOCKTYPES)}
+
+
+def decode_binary(data):
+    ''' Decode the compact binary format.  Raises ValueError if it is damaged. '''
+    try:
+        (magic, version, _flags, record_count, string_count) = \
+            _BINARY_HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC or version not in (1, 2, BINARY_VERSION):
+            raise ValueError('not a puppetctl binary state file')
+        records_start = _BINARY_HEADER.size
+        if version >= 2:
+            records_start += _BINARY_SUMMARY.size
+        if version >= 3:
+            records_start += _BINARY_SUMMARY_CHECK.size
+            if decode_summary(data) is None:
+                raise ValueError('binary state file summary does not match its check')
+        lengths_start = records_start + record_count * _BINARY_RECORD.size
+        lengths = struct.unpack_from(f'!{string_count}I', data, lengths_start)
+        strings = []
+        offset = lengths_start + 4 * string_count
+        for length in lengths:
+            strings.append(data[offset:offset+length].decode('utf-8'))
+            offset += length
+        if offset != len(data):
+            raise ValueError('binary state file has the wrong length')
+        statefiledata = {}
+        for (lockid_ix, user_ix, locktype_ix, message_ix, time_begin, time_expiry) in \
+                _BINARY_RECORD.iter_unpack(data[records_start:lengths_start]):
+            statefiledata[strings[lockid_ix]] = {
+                'user': strings[user_ix],
+                'locktype': strings[locktype_ix],
+                'message': strings[message_ix],
+                'time_begin': time_begin,
+                'time_expiry': time_expiry,
+            }
+    except (struct.error, IndexError) as err:
+        raise ValueError(f'binary state file is damaged: {err}') from err
+    return statefiledata
+
+
+def encode_journal_records(changes):
+    '''
+        Encode journal records for a list of changes: (op, lockid, lock)
+        tuples, where lock is the lock dict for an add and None otherwise.
+    '''
+    now = int(time.time())
+    lines = []
+    for (operation, lockid, lockitem) in changes:
+        if operation not in JOURNAL_OPS or operation == 'snapshot':
+            raise ValueError(f'not a journal change: {operation}')
+        record = {'op': operation, 'lockid': lockid, 'time': now}
+        if operation == 'add':
+            record['lock'] = lockitem
+        lines.append(json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n')
+    return ''.join(lines).encode('utf-8')
+
+
+def encode_journal(statefiledata):
+    ''' Encode a state dict as a compacted journal: the header and one snapshot '''
+    snapshot = {'op': 'snapshot', 'locks': statefiledata, 'time': int(time.time())}
+    return (JOURNAL_MAGIC + f' {JOURNAL_VERSION}\n'.encode('utf-8') +
+            (json.dumps(snapshot, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8'))
+
+
+def _journal_lines(data):
+    ''' Private function.  The record lines of a journal, after checking its header. '''
+    lines = data.split(b'\n')
+    # Whatever follows the last newline is an unfinished append (or nothing).
+    lines.pop()
+    if not lines or lines[0] != JOURNAL_MAGIC + f' {JOURNAL_VERSION}'.encode('utf-8'):
+        raise ValueError('not a puppetctl journal state file')
+    return lines[1:]
+
+
+def _journal_record(line):
+    ''' Private function.  Decode one journal line.  Raises ValueError if it is damaged. '''
+    try:
+        record = json.loads(line.decode('utf-8'))
+    except UnicodeDecodeError as err:
+        raise ValueError(f'journal record is damaged: {err}') from err
+    if not isinstance(record, dict) or record.get('op') not in JOURNAL_OPS:
+        raise ValueError(f'journal record is damaged: {line!r}')
+    return record
+
+
+def iter_journal(data):
+    '''
+        Yield the records of a journal in order.  Raises ValueError if it is
+        damaged anywhere but an unfinished last line.
+    '''
+    for line in _journal_lines(data):
+        yield _journal_record(line)
+
+
+def _replay_journal_record(statefiledata, record):
+    '''
+        Private function.  Apply one journal record to a state dict.  Raises
+        ValueError, changing nothing, if it is damaged.
+    '''
+    try:
+        if record['op'] == 'snapshot':
+            if not isinstance(record['locks'], dict):
+                raise ValueError('journal snapshot is damaged')
+            statefiledata.clear()
+            statefiledata.update(record['locks'])
+        elif record['op'] == 'add':
+            if not isinstance(record['lock'], dict):
+                raise ValueError('journal record is damaged')
+            statefiledata[record['lockid']] = record['lock']
+        else:
+            # Journals written by older puppetctl, whose readers purged
+            # expired locks too, can record the same expiry twice.  Ending a
+            # lock that's already gone is a no-op, not damage.
+            statefiledata.pop(record['lockid'], None)
+    except (KeyError, TypeError) as err:
+        raise ValueError(f'journal record is damaged: {err}') from err
+
+
+def decode_journal(data):
+    ''' Replay a journal into a state dict.  Raises ValueError if it is damaged. '''
+    statefiledata = {}
+    for record in iter_journal(data):
+        _replay_journal_record(statefiledata, record)
+    return statefiledata
+
+
+def salvage_journal(data):
+    '''
+        Replay a damaged journal as far as its first damaged record:
+        (state dict, how many record lines were left out from there on).
+        Raises ValueError if there's nothing to salvage: its header or its
+        first record, the snapshot everything else builds on, is damaged.
+    '''
+    lines = _journal_lines(data)
+    statefiledata = {}
+    for (num, line) in enumerate(lines):
+        try:
+            _replay_journal_record(statefiledata, _journal_record(line))
+        except ValueError:
+            if num == 0:
+                raise
+            return (statefiledata, len(lines) - num)
+    return (statefiledata, 0)
+
+
+def add_trailer(contents, generation):
+    ''' contents (bytes) followed by a trailer of their generation and checksum '''
+    return contents + b'%s %016x %08x\n' % (TRAILER_MAGIC, generation,
+                                             _trailer_checksum(contents, generation))
+
+
+def _trailer_checksum(contents, generation):
+    ''' The CRC-32 a trailer holds: of the contents, then the generation's digits '''
+    return zlib.crc32(b'%016x' % generation, zlib.crc32(contents))
+
+
+def trailer_generation(tail):
+    '''
+        The generation in a trailer, from (at least) the last TRAILER_SIZE
+        bytes of a file, without checking the checksum.  None if there's no
+        trailer there.
+    '''
+    tail = tail[-TRAILER_SIZE:]
+    if len(tail) < TRAILER_SIZE or not tail.startswith(TRAILER_MAGIC + b' '):
+        return None
+    try:
+        return int(tail[len(TRAILER_MAGIC)+1:len(TRAILER_MAGIC)+17], 16)
+    except ValueError:
+        return None
+
+
+def split_trailer(data):
+    '''
+        (contents, generation) of a file's data.  generation is None if there
+        is no trailer.  Raises ValueError if there is one, and the contents
+        don't match its checksum.
+    '''
+    generation = trailer_generation(data)
+    if generation is None:
+        return (data, None)
+    contents = data[:-TRAILER_SIZE]
+    try:
+        checksum = int(data[-9:-1], 16)
+    except ValueError as err:
+        raise ValueError('state file trailer is damaged') from err
+    if (_trailer_checksum(contents, generation) != checksum or
+            data[-10:-9] != b' ' or data[-1:] != b'\n'):
+        raise ValueError('state file does not match its checksum')
+    return (contents, generation)
+
+
+def encode_state(statefiledata, state_format):
+    ''' Encode a state dict in the named format '''
+    if state_format == 'binary':
+        return encode_binary(statefiledata)
+    if state_format == 'journal':
+        return encode_journal(statefiledata)
+    return encode_json(statefiledata)
+
+
+def decode_state(data):
+    '''
+        Decode the state file contents (bytes), whichever format they are in,
+        and with or without a trailer.  Raises ValueError if they can't be
+        decoded or fail their checksum.  The result is whatever was stored;
+        checking that it's a dict is up to the caller.
+    '''
+    (data, _generation) = split_trailer(data)
+    if data.startswith(BINARY_MAGIC):
+        return decode_binary(data)
+    if data.startswith(JOURNAL_MAGIC):
+        return decode_journal(data)
+    return json.loads(data.decode('utf-8'))
@@ -51,6 +51,10 @@ setup(
     install_requires=[
         'setuptools',
     ],
+    extras_require={
+        # 'puppetctl fleet-runs' uses it for the sums if it's there.
+        'numpy': ['numpy'],
+    },
     license='Apache License 2.0',
     entry_points={
         'console_scripts': ['puppetctl=puppetctl.command_line:main'],
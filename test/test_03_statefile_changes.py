@@ -176,3 +176,46 @@ class TestLockChanges(unittest.TestCase):
         self.assertIn('somebody2', rresult2)
         self.assertIn('This worked', rresult2)
         self.library.remove_lock(wresult2)
+
+    def test_apply_changes(self):
+        ''' Verify a batch of changes lands in one write '''
+        now = int(time.time())
+        noop = self.library.add_lock('somebody1', 'nooperate', now+30*60)
+        other = self.library.add_lock('somebody2', 'disable', now+30*60)
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file',
+                               wraps=self.library.write_state_file) as mock_write:
+            added = self.library.apply_changes([
+                {'op': 'remove', 'user': 'somebody1', 'locktype': 'nooperate'},
+                {'op': 'add', 'user': 'somebody1', 'locktype': 'disable',
+                 'expiry': now+60*60, 'message': 'deploying'},
+                {'op': 'extend', 'lockid': other, 'expiry': now+90*60},
+                {'op': 'add', 'user': 'svcaccount', 'locktype': 'disable', 'expiry': now+60*60},
+            ])
+        mock_write.assert_called_once()
+        self.assertEqual(len(added), 2)
+        locks = self.library.read_state_file()
+        self.assertNotIn(noop, locks)
+        self.assertEqual(sorted(locks.keys()), sorted(added + [other]))
+        self.assertEqual(locks[added[0]]['message'], 'deploying')
+        self.assertEqual(locks[other]['time_expiry'], now+90*60)
+        self.assertEqual(self.library.apply_changes([]), [])
+
+    def test_apply_changes_all_or_nothing(self):
+        ''' Verify one bad operation means nothing is written '''
+        now = int(time.time())
+        lockid = self.library.add_lock('somebody1', 'disable', now+30*60)
+        before = self.library.read_state_file()
+        for operations in [
+                [{'op': 'remove', 'lockid': lockid}, {'op': 'remove', 'lockid': 'nosuchlock'}],
+                [{'op': 'remove', 'lockid': lockid},
+                 {'op': 'add', 'user': 'somebody2', 'locktype': 'disable', 'expiry': now-60}],
+                [{'op': 'add', 'user': 'somebody1', 'locktype': 'disable', 'expiry': now+60}],
+                [{'op': 'extend', 'user': 'somebody1', 'locktype': 'nooperate',
+                  'expiry': now+60}],
+                [{'op': 'extend', 'expiry': now+60}],
+                [{'op': 'explode'}], ['remove'], {'op': 'remove'}]:
+            with self.assertRaises(ValueError):
+                self.library.apply_changes(operations)
+        self.assertDictEqual(self.library.read_state_file(), before)
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file', return_value=False):
+            self.assertFalse(self.library.apply_changes([{'op': 'remove', 'lockid': lockid}]))
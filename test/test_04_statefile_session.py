@@ -0,0 +1,201 @@
+'''
+    Test sessions on the state file: one read, at most one write.
+'''
+
+import unittest
+import os
+import json
+import time
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlStatefileSession, PuppetctlExecution
+
+
+class TestStatefileSession(unittest.TestCase):
+    ''' Class of tests about loading and committing through a session. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_reading_file = '/tmp/session-reading-file.test.txt'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(self.test_reading_file)
+        self.sf_patcher.start()
+        now = int(time.time())
+        self.locks = {
+            '24682468': {'message': 'I should be expired', 'locktype': 'nooperate',
+                         'time_begin': now-90*60, 'time_expiry': now-30*60, 'user': 'username1'},
+            'whodoyou': {'message': 'I disabled 1h', 'locktype': 'disable',
+                         'time_begin': now-30*60, 'time_expiry': now+30*60, 'user': 'username2'},
+        }
+        with open(self.test_reading_file,
+                  'w', encoding='utf-8') as filepointer:
+            json.dump(self.locks, filepointer)
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in [self.test_reading_file] + \
+                [f'{self.test_reading_file}.backup.{x}' for x in range(self.library.state_backups)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def test_session_type(self):
+        ''' Verify we get a session object '''
+        self.assertIsInstance(self.library.session(), PuppetctlStatefileSession)
+
+    def test_single_read_single_write(self):
+        ''' Verify a whole conversation with the file is one read and one write '''
+        now = int(time.time())
+        with mock.patch.object(PuppetctlStatefile, '_load_state_file',
+                               wraps=self.library._load_state_file) as mock_read, \
+                mock.patch.object(PuppetctlStatefile, 'write_state_file',
+                                  wraps=self.library.write_state_file) as mock_write:
+            with self.library.session() as session:
+                self.assertEqual(session.get_disable_lock_ids(), ['whodoyou'])
+                self.assertEqual(session.get_noop_lock_ids('username1'), [])
+                self.assertEqual(session.remove_lock('whodoyou'), True)
+                lockid = session.add_lock('somebody1', 'disable', now+60*60, 'mine')
+                self.assertTrue(lockid)
+                self.assertIn('somebody1', session.get_lock_info(lockid))
+                self.assertTrue(session.commit())
+                # Nothing left to write:
+                self.assertTrue(session.commit())
+        mock_read.assert_called_once_with()
+        mock_write.assert_called_once()
+        self.assertEqual(list(self.library._read_state_file().keys()), [lockid])
+
+    def test_expired_purged_on_close(self):
+        ''' Verify that the expiry purge is written once when a write session closes '''
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file',
+                               wraps=self.library.write_state_file) as mock_write:
+            with self.library.session(write=True) as session:
+                self.assertEqual(list(session.read_state_file().keys()), ['whodoyou'])
+                # removing an already-expired lock is harmless:
+                self.assertTrue(session.remove_lock('24682468'))
+        mock_write.assert_called_once()
+        self.assertEqual(list(self.library._read_state_file().keys()), ['whodoyou'])
+
+    def test_read_session_never_writes(self):
+        ''' Verify a read session leaves expired locks and damage alone, even for root '''
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file') as mock_write, \
+                mock.patch.object(PuppetctlStatefile, 'reset_state_file') as mock_reset, \
+                mock.patch.object(PuppetctlStatefile, '_acquire_state_lock',
+                                  wraps=self.library._acquire_state_lock) as mock_lock:
+            self.assertEqual(list(self.library.read_state_file().keys()), ['whodoyou'])
+            with open(self.test_reading_file, 'w', encoding='utf-8') as filepointer:
+                filepointer.write('{"truncat')
+            self.assertEqual(self.library.read_state_file(), {})
+        mock_write.assert_not_called()
+        mock_reset.assert_not_called()
+        # and it never asked for the lock file to be created:
+        self.assertEqual(mock_lock.call_args_list, [mock.call(exclusive=False)] * 2)
+        # a write session puts the damage right:
+        self.assertEqual(self.library.purge_expired_locks(), 0)
+        self.assertEqual(self.library._read_state_file(), {})
+        self.assertEqual(self.library.metrics['recovery_failures'], 2)
+
+    def test_purge_batched(self):
+        ''' Verify several expired locks go in one write, and it's measured '''
+        now = int(time.time())
+        self.library.add_lock('username3', 'disable', now+60*60)
+        self.library.add_lock('username4', 'disable', now+60*60)
+        # That first add wrote out the expired lock from the fixture:
+        self.assertEqual(self.library.metrics['gc_locks_purged'], 1)
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file',
+                               wraps=self.library.write_state_file) as mock_write, \
+                mock.patch('time.time', return_value=now+2*60*60):
+            self.assertEqual(self.library.purge_expired_locks(), 3)
+            self.assertEqual(self.library.purge_expired_locks(), 0)
+        mock_write.assert_called_once()
+        self.assertEqual(self.library.metrics['gc_runs'], 2)
+        self.assertEqual(self.library.metrics['gc_locks_purged'], 4)
+        self.assertEqual(self.library.last_write_bytes, os.stat(self.test_reading_file).st_size)
+        self.assertGreater(self.library.metrics['gc_bytes_written'],
+                           self.library.last_write_bytes)
+        self.assertGreater(self.library.metrics['gc_seconds'], 0.0)
+
+    def test_purge_skipped_when_readonly(self):
+        ''' Verify a caller who can't write doesn't try to purge '''
+        with mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                               return_value=False), \
+                mock.patch.object(PuppetctlStatefile, 'write_state_file') as mock_write:
+            with self.library.session() as session:
+                self.assertEqual(session.expired_lock_ids, ['24682468'])
+                self.assertFalse(session.purge_pending)
+                self.assertEqual(list(session.read_state_file().keys()), ['whodoyou'])
+            self.assertEqual(self.library.purge_expired_locks(), 0)
+        mock_write.assert_not_called()
+        self.assertEqual(self.library.metrics['gc_runs'], 0)
+
+    def test_nested_sessions(self):
+        ''' Verify that nested sessions share one read, and the statefile calls use it '''
+        with mock.patch.object(PuppetctlStatefile, '_load_state_file',
+                               wraps=self.library._load_state_file) as mock_read:
+            with self.library.session() as outer:
+                with self.library.session() as inner:
+                    self.assertIs(outer, inner)
+                self.assertEqual(self.library.get_disable_lock_ids(), ['whodoyou'])
+                self.assertIn('username2', self.library.get_lock_info('whodoyou'))
+        mock_read.assert_called_once_with()
+        # and once closed, we get a fresh one:
+        self.assertIsNot(self.library.session(), outer)
+
+    def test_exception_discards(self):
+        ''' Verify an error inside the session writes nothing '''
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file') as mock_write:
+            with self.assertRaises(KeyError):
+                with self.library.session() as session:
+                    session.remove_lock('whodoyou')
+                    session.remove_lock('nonsense_key_that_will_not_exist')
+        mock_write.assert_not_called()
+
+    def test_failed_commit_not_retried(self):
+        ''' Verify a failed write is reported once, and not retried on close '''
+        now = int(time.time())
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file',
+                               return_value=False) as mock_write:
+            with self.library.session() as session:
+                self.assertTrue(session.add_lock('somebody1', 'disable', now+60*60))
+                self.assertFalse(session.commit())
+        mock_write.assert_called_once()
+
+    def test_disable_one_read_one_write(self):
+        ''' Verify a disable that swaps out a noop lock reads once and writes once '''
+        runner = PuppetctlExecution(self.test_reading_file)
+        runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+        runner.statefile_object.add_lock(runner.invoking_user, 'nooperate',
+                                         int(time.time())+30*60, 'old lock')
+        with mock.patch.object(PuppetctlStatefile, '_load_state_file',
+                               wraps=runner.statefile_object._load_state_file) as mock_read, \
+                mock.patch.object(PuppetctlStatefile, 'write_state_file',
+                                  wraps=runner.statefile_object.write_state_file) as mock_write, \
+                mock.patch.object(PuppetctlExecution, '_puppet_processes_running',
+                                  return_value={}), \
+                mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                                  return_value=True), \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            runner.disable(force=False, expiry=int(time.time())+60*60, message='new lock')
+        self.assertIn('Puppet has been disabled', fake_out.getvalue())
+        mock_read.assert_called_once_with()
+        mock_write.assert_called_once()
+        self.assertEqual(runner.statefile_object.get_noop_lock_ids(), [])
+        my_disables = runner.statefile_object.get_disable_lock_ids(runner.invoking_user)
+        self.assertEqual(len(my_disables), 1)
+
+    def test_disable_commit_fails(self):
+        ''' Verify a disable complains if the single write fails '''
+        runner = PuppetctlExecution(self.test_reading_file)
+        runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file', return_value=False), \
+                mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                                  return_value=True), \
+                self.assertRaises(SystemExit) as lockfail, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            runner.disable(force=False, expiry=int(time.time())+60*60, message='new lock')
+        self.assertIn('Unable to add lock', fake_out.getvalue())
+        self.assertEqual(lockfail.exception.code, 2)
@@ -0,0 +1,88 @@
+'''
+    Test that state file writes are atomic, and honor the durability setting.
+'''
+
+import unittest
+import os
+import stat
+import time
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+
+
+class TestAtomicStatefile(unittest.TestCase):
+    ''' Class of tests about how the state file reaches the disk. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_dir = '/tmp/atomic-statefile-dir.test'
+        os.makedirs(self.test_dir, exist_ok=True)
+        self.test_reading_file = os.path.join(self.test_dir, 'status.test.txt')
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(self.test_reading_file)
+        self.sf_patcher.start()
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in os.listdir(self.test_dir):
+            os.remove(os.path.join(self.test_dir, filename))
+        os.rmdir(self.test_dir)
+        self.sf_patcher.stop()
+
+    def _debris(self):
+        ''' List any temp files left behind by a write '''
+        return [x for x in os.listdir(self.test_dir) if x.startswith('.')]
+
+    def test_durability_init(self):
+        ''' Verify the durability setting is checked '''
+        self.assertEqual(self.library.durability, self.library.defaults.get('durability'))
+        for level in ['none', 'file', 'directory']:
+            library = PuppetctlStatefile(self.test_reading_file, durability=level)
+            self.assertEqual(library.durability, level)
+        with self.assertRaises(ValueError):
+            PuppetctlStatefile(self.test_reading_file, durability='sometimes')
+
+    def test_rename_replaces(self):
+        ''' Verify a write lands as a new file, and leaves no temp files behind '''
+        self.assertTrue(self.library.reset_state_file())
+        before = os.stat(self.test_reading_file)
+        lockid = self.library.add_lock('somebody1', 'disable', int(time.time())+60)
+        after = os.stat(self.test_reading_file)
+        self.assertNotEqual(before.st_ino, after.st_ino)
+        self.assertEqual(self._debris(), [])
+        self.assertEqual(list(self.library._read_state_file().keys()), [lockid])
+
+    def test_mode_kept(self):
+        ''' Verify a new file is world-readable, and an existing mode is kept '''
+        self.library.reset_state_file()
+        self.assertEqual(stat.S_IMODE(os.stat(self.test_reading_file).st_mode), 0o644)
+        os.chmod(self.test_reading_file, 0o640)
+        self.library.reset_state_file()
+        self.assertEqual(stat.S_IMODE(os.stat(self.test_reading_file).st_mode), 0o640)
+
+    def test_fsync_levels(self):
+        ''' Verify how many fsyncs each durability level costs '''
+        for (level, syncs) in [('none', 0), ('file', 1), ('directory', 2)]:
+            self.library.durability = level
+            with mock.patch('os.fsync') as mock_fsync:
+                self.assertTrue(self.library.reset_state_file())
+            self.assertEqual(mock_fsync.call_count, syncs)
+
+    def test_failed_write_keeps_old(self):
+        ''' Verify a failure partway through leaves the old file intact and no debris '''
+        lockid = self.library.add_lock('somebody1', 'disable', int(time.time())+60)
+        with mock.patch('os.rename', side_effect=OSError), \
+                self.assertRaises(OSError):
+            self.library.write_state_file({})
+        self.assertEqual(self._debris(), [])
+        self.assertEqual(list(self.library._read_state_file().keys()), [lockid])
+        # and reset reports it rather than raising
+        with mock.patch('os.rename', side_effect=OSError):
+            self.assertFalse(self.library.reset_state_file())
+
+    def test_execution_passthrough(self):
+        ''' Verify PuppetctlExecution hands statefile settings along '''
+        runner = PuppetctlExecution(self.test_reading_file, durability='none')
+        self.assertEqual(runner.statefile_object.durability, 'none')
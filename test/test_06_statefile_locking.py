@@ -0,0 +1,236 @@
+'''
+    Test the reader/writer locking around state file sessions.
+'''
+
+import unittest
+import os
+import fcntl
+import time
+import threading
+import multiprocessing
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+
+
+def _add_one_lock(state_file, user):
+    ''' Child process body: add a lock for 'user' '''
+    library = PuppetctlStatefile(state_file)
+    with mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                           return_value=True):
+        result = library.add_lock(user, 'disable', int(time.time())+60*60, 'racing')
+    os._exit(0 if result else 1)  # pylint: disable=protected-access
+
+
+class TestStatefileLocking(unittest.TestCase):
+    ''' Class of tests about locking the state file. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_reading_file = '/tmp/locking-reading-file.test.txt'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(self.test_reading_file, lock_timeout=2)
+        self.sf_patcher.start()
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in [self.test_reading_file, self.library.lock_file]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def _try_flock(self, lock_op):
+        ''' From a separate open file, see if we could take the lock right now '''
+        with open(self.library.lock_file, 'r', encoding='utf-8') as other:
+            try:
+                fcntl.flock(other.fileno(), lock_op | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            return True
+
+    def test_lock_init(self):
+        ''' Verify the lock settings '''
+        self.assertEqual(self.library.lock_file, self.test_reading_file + '.lock')
+        self.assertEqual(self.library.lock_timeout, 2.0)
+        from_config = PuppetctlStatefile(self.test_reading_file, lock_timeout='0.5')
+        self.assertEqual(from_config.lock_timeout, 0.5)
+        with self.assertRaises(ValueError):
+            PuppetctlStatefile(self.test_reading_file, lock_timeout=-1)
+        with self.assertRaises(ValueError):
+            PuppetctlStatefile(self.test_reading_file, lock_timeout='soon')
+
+    def test_write_session_exclusive(self):
+        ''' Verify a write session keeps everyone else out '''
+        with self.library.session(write=True):
+            self.assertFalse(self._try_flock(fcntl.LOCK_SH))
+        self.assertTrue(self._try_flock(fcntl.LOCK_EX))
+
+    def test_read_session_shared(self):
+        ''' Verify a read session lets readers in but keeps writers out '''
+        self.library.reset_state_file()
+        with self.library.session():
+            self.assertTrue(self._try_flock(fcntl.LOCK_SH))
+            self.assertFalse(self._try_flock(fcntl.LOCK_EX))
+
+    def test_reader_without_lockfile(self):
+        ''' Verify a reader who can't open the lock file still gets an answer '''
+        self.assertFalse(os.path.exists(self.library.lock_file))
+        with self.library.session() as session:
+            self.assertIsNone(session.lock_fd)
+            self.assertEqual(session.get_disable_lock_ids(), [])
+
+    def test_lockfile_private(self):
+        ''' Verify only those who may write can open the lock file, and so hold it '''
+        with open(self.library.lock_file, 'w', encoding='utf-8'):
+            # As an older puppetctl left it.
+            os.chmod(self.library.lock_file, 0o644)
+        self.library.reset_state_file()
+        self.assertEqual(os.stat(self.library.lock_file).st_mode & 0o777, 0o600)
+        os.remove(self.library.lock_file)
+        self.library.reset_state_file()
+        self.assertEqual(os.stat(self.library.lock_file).st_mode & 0o777, 0o600)
+
+    def test_unprivileged_holder(self):
+        ''' Verify an unprivileged user can't hold the lock to keep root from writing '''
+        self.library.reset_state_file()
+        ctx = multiprocessing.get_context('fork')
+        (ready_r, ready_w) = ctx.Pipe(duplex=False)
+
+        def _hold_lock():
+            ''' Child process body: as nobody, take the lock and keep it '''
+            os.setgid(65534)
+            os.setuid(65534)
+            try:
+                with open(self.library.lock_file, 'r', encoding='utf-8') as other:
+                    fcntl.flock(other.fileno(), fcntl.LOCK_SH)
+                    ready_w.send(True)
+                    time.sleep(5)
+            except OSError:
+                ready_w.send(False)
+            os._exit(0)  # pylint: disable=protected-access
+
+        holder = ctx.Process(target=_hold_lock)
+        holder.start()
+        try:
+            self.assertFalse(ready_r.recv())
+            self.library.lock_timeout = 0.5
+            self.assertTrue(self.library.add_lock('somebody1', 'disable',
+                                                  int(time.time())+60))
+        finally:
+            holder.terminate()
+            holder.join()
+        self.assertEqual(self.library.metrics['lock_contended'], 0)
+
+    def test_unprivileged_reader(self):
+        ''' Verify a reader who can't write takes no lock, and isn't held up by a writer '''
+        self.library.reset_state_file()
+        self.library.add_lock('somebody1', 'disable', int(time.time())+60)
+        self.library.lock_timeout = 0.05
+        with open(self.library.lock_file, 'r', encoding='utf-8') as other:
+            fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+            with mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                   return_value=False):
+                with self.library.session() as session:
+                    self.assertIsNone(session.lock_fd)
+                    self.assertEqual(len(session.get_disable_lock_ids()), 1)
+        self.assertEqual(self.library.metrics['lock_timeouts'], 0)
+
+    def test_unlocked_reader(self):
+        ''' Verify an unlocked read doesn't wait on a writer, even for those who could write '''
+        self.library.add_lock('somebody1', 'disable', int(time.time())+60)
+        self.library.lock_timeout = 0.05
+        with open(self.library.lock_file, 'r', encoding='utf-8') as other:
+            fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+            self.assertEqual(len(self.library.read_state_file(locked=False)), 1)
+            with self.assertRaises(TimeoutError):
+                self.library.read_state_file()
+            with self.library.session(locked=False) as session:
+                self.assertIsNone(session.lock_fd)
+        self.assertEqual(self.library.metrics['lock_timeouts'], 1)
+
+    def test_no_upgrade(self):
+        ''' Verify we refuse to turn a read session into a write session '''
+        with self.library.session():
+            with self.assertRaises(RuntimeError):
+                self.library.session(write=True)
+            with self.assertRaises(RuntimeError):
+                self.library.add_lock('somebody1', 'disable', int(time.time())+60)
+        # but reading inside a write session is fine:
+        with self.library.session(write=True) as outer:
+            self.assertIs(self.library.session(), outer)
+
+    def test_timeout(self):
+        ''' Verify we give up after lock_timeout, and count it '''
+        self.library.lock_timeout = 0.05
+        with open(self.library.lock_file, 'w', encoding='utf-8') as other:
+            fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+            with self.assertRaises(TimeoutError):
+                with self.library.session():
+                    pass  # pragma: no cover
+            self.assertFalse(self.library.reset_state_file())
+        self.assertEqual(self.library.metrics['lock_timeouts'], 2)
+        self.assertGreaterEqual(self.library.metrics['lock_wait_max'], 0.05)
+        # We let go of everything, so the next session works:
+        with self.library.session(write=True) as session:
+            self.assertEqual(session.lock_wait, 0.0)
+
+    def test_contention_measured(self):
+        ''' Verify a wait on someone else's lock is recorded '''
+        self.library.reset_state_file()
+        # pylint: disable=consider-using-with
+        other = open(self.library.lock_file, 'r', encoding='utf-8')
+        fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+        releaser = threading.Timer(0.1, other.close)
+        releaser.start()
+        with self.library.session(write=True) as session:
+            self.assertGreater(session.lock_wait, 0.05)
+        releaser.join()
+        self.assertEqual(self.library.metrics['lock_contended'], 1)
+        self.assertGreater(self.library.metrics['lock_wait_seconds'], 0.05)
+
+    def test_no_lost_updates(self):
+        ''' Verify concurrent writers in separate processes don't lose each other's locks '''
+        self.library.reset_state_file()
+        users = [f'racer{x}' for x in range(12)]
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=_add_one_lock, args=(self.test_reading_file, user))
+                 for user in users]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            self.assertEqual(proc.exitcode, 0)
+        locks = self.library.read_state_file()
+        self.assertEqual(sorted(x['user'] for x in locks.values()), sorted(users))
+
+    def test_execution_timeout(self):
+        ''' Verify PuppetctlExecution reports a lock timeout and exits '''
+        runner = PuppetctlExecution(self.test_reading_file, lock_timeout=0.05)
+        runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+        with open(self.library.lock_file, 'w', encoding='utf-8') as other:
+            fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+            with self.assertRaises(SystemExit) as lockfail, \
+                    mock.patch('sys.stdout', new=StringIO()) as fake_out:
+                runner.is_enabled()
+        self.assertEqual(lockfail.exception.code, 2)
+        self.assertIn('Timed out', fake_out.getvalue())
+
+    def test_execution_logs_wait(self):
+        ''' Verify PuppetctlExecution logs when it had to wait '''
+        runner = PuppetctlExecution(self.test_reading_file)
+        runner.statefile_object.reset_state_file()
+        # pylint: disable=consider-using-with
+        other = open(self.library.lock_file, 'r', encoding='utf-8')
+        fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+        releaser = threading.Timer(0.1, other.close)
+        releaser.start()
+        with mock.patch.object(PuppetctlExecution, 'log') as mock_log:
+            self.assertTrue(runner.is_enabled())
+        releaser.join()
+        mock_log.assert_called_once()
+        self.assertIn('Waited', mock_log.call_args[0][0])
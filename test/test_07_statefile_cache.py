@@ -0,0 +1,99 @@
+'''
+    Test the optional in-process cache of the parsed state file.
+'''
+
+import unittest
+import os
+import json
+import time
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl.stateformats import decode_state
+
+
+class TestStatefileCache(unittest.TestCase):
+    ''' Class of tests about caching state file parses. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_reading_file = '/tmp/cache-reading-file.test.txt'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(self.test_reading_file, cache=True)
+        self.sf_patcher.start()
+        now = int(time.time())
+        self.locks = {
+            'whodoyou': {'message': 'I disabled 1h', 'locktype': 'disable',
+                         'time_begin': now-30*60, 'time_expiry': now+30*60, 'user': 'username2'},
+        }
+        with open(self.test_reading_file,
+                  'w', encoding='utf-8') as filepointer:
+            json.dump(self.locks, filepointer)
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in [self.test_reading_file, self.library.lock_file]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def test_cache_init(self):
+        ''' Verify the cache is off unless asked for '''
+        self.assertFalse(PuppetctlStatefile(self.test_reading_file).cache)
+        self.assertTrue(self.library.cache)
+        self.assertTrue(PuppetctlStatefile(self.test_reading_file, cache='yes').cache)
+        self.assertFalse(PuppetctlStatefile(self.test_reading_file, cache='no').cache)
+
+    def test_unchanged_file_not_parsed(self):
+        ''' Verify an unchanged file is only parsed once '''
+        with mock.patch('puppetctl.statefile.decode_state', wraps=decode_state) as mock_load:
+            first = self.library.read_state_file()
+            second = self.library.read_state_file()
+        self.assertEqual(mock_load.call_count, 1)
+        self.assertDictEqual(first, self.locks)
+        self.assertDictEqual(second, self.locks)
+        # Callers mangling what they got back don't poison the cache:
+        first['whodoyou']['user'] = 'mangled'
+        self.assertDictEqual(self.library.read_state_file(), self.locks)
+
+    def test_uncached_parses_every_time(self):
+        ''' Verify that without the cache we parse every time '''
+        self.library.cache = False
+        with mock.patch('puppetctl.statefile.decode_state', wraps=decode_state) as mock_load:
+            self.library.read_state_file()
+            self.library.read_state_file()
+        self.assertEqual(mock_load.call_count, 2)
+
+    def test_changed_file_reparsed(self):
+        ''' Verify another writer's change is noticed '''
+        self.assertEqual(self.library.get_disable_lock_ids(), ['whodoyou'])
+        other = PuppetctlStatefile(self.test_reading_file)
+        lockid = other.add_lock('somebody1', 'nooperate', int(time.time())+60*60)
+        self.assertEqual(self.library.get_noop_lock_ids(), [lockid])
+        other.remove_lock(lockid)
+        self.assertEqual(self.library.get_noop_lock_ids(), [])
+
+    def test_own_write_seeds_cache(self):
+        ''' Verify we don't read back what we just wrote '''
+        lockid = self.library.add_lock('somebody1', 'nooperate', int(time.time())+60*60)
+        with mock.patch('puppetctl.statefile.decode_state', wraps=decode_state) as mock_load:
+            self.assertEqual(self.library.get_noop_lock_ids(), [lockid])
+        mock_load.assert_not_called()
+
+    def test_expiry_honored(self):
+        ''' Verify a lock disappears at its expiry, even though the file never changed '''
+        runner = PuppetctlExecution(self.test_reading_file, cache=True)
+        self.assertFalse(runner.is_enabled())
+        later = time.time() + 31*60
+        with mock.patch('puppetctl.statefile.decode_state', wraps=decode_state) as mock_load, \
+                mock.patch.object(PuppetctlStatefile, 'write_state_file') as mock_write, \
+                mock.patch('time.time', return_value=later):
+            self.assertTrue(runner.is_enabled())
+            self.assertTrue(runner.is_enabled())
+        mock_load.assert_not_called()
+        # reads hide the expired lock, and leave purging it to a write:
+        mock_write.assert_not_called()
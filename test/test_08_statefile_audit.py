@@ -0,0 +1,237 @@
+'''
+    Test the lock audit log.
+'''
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import time
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl.audit import (AUDIT_LOG_GENERATIONS, PuppetctlAuditLog, audit_record,
+                             lock_history)
+
+
+def _lock(user, locktype, time_begin, time_expiry):
+    ''' Make a lock structure as the state file has it '''
+    return {'user': user, 'locktype': locktype, 'message': '',
+            'time_begin': time_begin, 'time_expiry': time_expiry}
+
+
+class TestAuditLog(unittest.TestCase):
+    ''' Class of tests about the audit log file. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-audit.')
+        self.audit = PuppetctlAuditLog(os.path.join(self.workdir, 'audit'), max_bytes=1000)
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_append_and_read(self):
+        ''' Verify records come back in order, skipping old and torn ones '''
+        records = [audit_record('add', f'lock{num}', _lock('user1', 'disable', 100, 200), num)
+                   for num in range(5)]
+        self.audit.append(records[:3])
+        with open(self.audit.audit_log, 'a', encoding='utf-8') as logfile:
+            logfile.write('{"time": 3, "ev\n')
+        self.audit.append(records[3:])
+        self.audit.append([])
+        self.assertEqual(list(self.audit.read()), records)
+        self.assertEqual([x['lockid'] for x in self.audit.read(since=3)], ['lock3', 'lock4'])
+        with self.assertRaises(ValueError):
+            PuppetctlAuditLog(self.audit.audit_log, max_bytes=-1)
+
+    def test_rotation(self):
+        ''' Verify the log rotates by size, keeps its generations, and reads across them '''
+        record = audit_record('add', 'lockid', _lock('user1', 'disable', 100, 200), 1)
+        size = len(json.dumps(record, sort_keys=True)) + 1
+        per_file = 1000 // size
+        for _num in range(per_file * (AUDIT_LOG_GENERATIONS + 3)):
+            self.audit.append([record])
+        self.assertTrue(all(os.path.exists(x) for x in self.audit.generations()))
+        self.assertFalse(os.path.exists(f'{self.audit.audit_log}.{AUDIT_LOG_GENERATIONS+1}'))
+        for filename in self.audit.generations():
+            self.assertLessEqual(os.path.getsize(filename), 1000)
+        self.assertEqual(len(list(self.audit.read())), per_file * (AUDIT_LOG_GENERATIONS + 1))
+
+    def test_lock_history(self):
+        ''' Verify the summary of the locks that ended in a window '''
+        records = [
+            audit_record('add', 'aaaa', _lock('user1', 'disable', 1000, 5000), 1000),
+            # ended before the window:
+            audit_record('remove', 'old', _lock('user1', 'disable', 0, 5000), 500),
+            # half in the window:
+            audit_record('remove', 'aaaa', _lock('user1', 'disable', 1000, 5000), 3000),
+            audit_record('expire', 'bbbb', _lock('user2', 'nooperate', 2000, 2600), 9000),
+            audit_record('break', 'cccc', _lock('user2', 'disable', 2500, 9000), 3500),
+            # past the window's end:
+            audit_record('expire', 'dddd', _lock('user3', 'disable', 2500, 9000), 9500),
+        ]
+        summary = lock_history(iter(records), 2000, 4000)
+        self.assertEqual(summary['locks'], 3)
+        self.assertEqual(summary['seconds'], {'disable': 1000 + 1000, 'nooperate': 600})
+        self.assertEqual((summary['expired'], summary['expired_seconds']), (1, {'nooperate': 600}))
+        self.assertEqual(summary['users'], {'user1': {'locks': 1, 'expired': 0, 'seconds': 1000},
+                                            'user2': {'locks': 2, 'expired': 1, 'seconds': 1600}})
+        self.assertEqual((summary['duration_p50'], summary['duration_p95']), (1000, 2000))
+        self.assertIsNone(lock_history(iter([]), 0, 1)['duration_p50'])
+
+
+class TestStatefileAudit(unittest.TestCase):
+    ''' Class of tests about what the statefile writes to the audit log. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-audit.')
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.sf_patcher.start()
+        self.library = PuppetctlStatefile(os.path.join(self.workdir, 'puppetctl.status'))
+        self.now = int(time.time())
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        self.sf_patcher.stop()
+
+    def _events(self, library=None):
+        ''' (event, lockid) of each audit record '''
+        library = self.library if library is None else library
+        return [(x['event'], x['lockid']) for x in library.audit_log_object.read()]
+
+    def _lifecycle(self, library):
+        ''' Put library through each event, and check they're recorded '''
+        lock1 = library.add_lock('somebody1', 'disable', self.now+60*60)
+        lock2 = library.add_lock('somebody2', 'nooperate', self.now+60)
+        library.apply_changes([{'op': 'extend', 'lockid': lock1,
+                                'expiry': self.now+2*60*60}])
+        library.remove_lock(lock1)
+        lock3 = library.add_lock('somebody1', 'disable', self.now+60*60)
+        with mock.patch('time.time', return_value=self.now+120):
+            self.assertEqual(library.get_noop_lock_ids(), [])
+            lock4 = library.add_lock('somebody2', 'disable', self.now+60*60)
+        self.assertTrue(library.reset_state_file())
+        self.assertEqual(self._events(library), [('add', lock1), ('add', lock2),
+                                                 ('extend', lock1), ('remove', lock1),
+                                                 ('add', lock3), ('expire', lock2),
+                                                 ('add', lock4),
+                                                 ('break', min(lock3, lock4)),
+                                                 ('break', max(lock3, lock4))])
+        records = list(library.audit_log_object.read())
+        self.assertEqual(records[2]['time_expiry'], self.now+2*60*60)
+        self.assertEqual(records[5]['user'], 'somebody2')
+        self.assertEqual(records[5]['time_expiry'], self.now+60)
+
+    def test_lifecycle(self):
+        ''' Verify adds, extends, removes, expiries and breaks are all recorded '''
+        self.assertEqual(self.library.audit_log_object.audit_log,
+                         f'{self.library.state_file}.audit')
+        self._lifecycle(self.library)
+
+    def test_lifecycle_backends(self):
+        ''' Verify the directory and sqlite backends record the same, expiries included '''
+        for backend in ['directory', 'sqlite']:
+            with self.subTest(backend=backend):
+                library = PuppetctlStatefile(os.path.join(self.workdir, f'{backend}.status'),
+                                             backend=backend,
+                                             state_dir=os.path.join(self.workdir, 'state.d'),
+                                             state_db=os.path.join(self.workdir, 'state.db'))
+                self._lifecycle(library)
+
+    def test_sqlite_expiry(self):
+        ''' Verify sqlite audits the expired rows a write deletes, and only once '''
+        library = PuppetctlStatefile(os.path.join(self.workdir, 'sqlite.status'),
+                                     backend='sqlite',
+                                     state_db=os.path.join(self.workdir, 'state.db'))
+        lockid = library.add_lock('somebody1', 'disable', self.now+60)
+        with mock.patch('time.time', return_value=self.now+120):
+            # Reads leave the row be:
+            self.assertEqual(library.get_disable_lock_ids(), [])
+            self.assertEqual(library.backend_object.last_purged, {})
+            library.add_lock('somebody2', 'disable', self.now+60*60)
+            self.assertEqual(list(library.backend_object.last_purged), [lockid])
+            library.add_lock('somebody3', 'disable', self.now+60*60)
+        self.assertEqual([x for x in self._events(library) if x[0] == 'expire'],
+                         [('expire', lockid)])
+        with mock.patch('time.time', return_value=self.now+3*60*60):
+            self.assertEqual(library.get_disable_lock_ids(), [])
+            self.assertTrue(library.reset_state_file())
+        self.assertEqual([x[0] for x in self._events(library)][-2:], ['expire', 'expire'])
+
+    def test_no_record_without_write(self):
+        ''' Verify failed or refused writes, and reads, record nothing '''
+        lockid = self.library.add_lock('somebody1', 'disable', self.now+60*60)
+        self.assertFalse(self.library.add_lock('somebody1', 'disable', self.now+60*60))
+        with mock.patch.object(PuppetctlStatefile, 'write_state_file', return_value=False):
+            self.library.remove_lock(lockid)
+        with mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                               return_value=False), \
+                mock.patch('time.time', return_value=self.now+2*60*60):
+            self.assertEqual(self.library.get_disable_lock_ids(), [])
+        self.assertEqual(self._events(), [('add', lockid)])
+
+    def test_audit_failure(self):
+        ''' Verify an unwritable audit log doesn't fail the change '''
+        with mock.patch.object(PuppetctlAuditLog, 'append', side_effect=OSError):
+            self.assertTrue(self.library.add_lock('somebody1', 'disable', self.now+60*60))
+        # a damaged state file has no locks to record, and is still reset:
+        with open(self.library.state_file, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('garbage')
+        self.library.bogus_state_file = os.path.join(self.workdir, 'bogus')
+        self.assertTrue(self.library.reset_state_file())
+
+    def test_turned_off(self):
+        ''' Verify an empty audit_log, or the memory backend, keeps no log '''
+        self.assertIsNone(PuppetctlStatefile(audit_log='').audit_log_object)
+        self.assertIsNone(PuppetctlStatefile(backend='memory').audit_log_object)
+        self.assertEqual(PuppetctlStatefile(audit_log='/tmp/x', audit_max_bytes='10')
+                         .audit_log_object.max_bytes, 10)
+
+
+class TestExecutionLockHistory(unittest.TestCase):
+    ''' Class of tests about 'puppetctl lock-history'. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-audit.')
+        self.runner = PuppetctlExecution(os.path.join(self.workdir, 'puppetctl.status'))
+        self.now = int(time.time())
+        self.runner.statefile_object.audit_log_object.append([
+            audit_record('remove', 'aaaa', _lock('user1', 'disable', self.now-3600, self.now),
+                         self.now-1800),
+            audit_record('expire', 'bbbb', _lock('user2', 'nooperate', self.now-7200,
+                                                 self.now-3600), self.now-60),
+        ])
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_lock_history(self):
+        ''' Verify the summary prints as text, or as JSON '''
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.runner.lock_history(days=1)
+        self.assertIn('2 locks ended in the last 1 days, 1 of them left to expire.',
+                      fake_out.getvalue())
+        self.assertIn('Time in disable: 30m, 0s of it', fake_out.getvalue())
+        self.assertIn('  user2: 1 locks (1 expired), 1h', fake_out.getvalue())
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.runner.lock_history(days=1, as_json=True)
+        self.assertEqual(json.loads(fake_out.getvalue())['seconds'],
+                         {'disable': 1800, 'nooperate': 3600})
+
+    def test_no_audit_log(self):
+        ''' Verify asking for history with no audit log fails '''
+        runner = PuppetctlExecution(backend='memory')
+        runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+        with self.assertRaises(SystemExit) as fail, \
+                mock.patch('sys.stdout', new=StringIO()):
+            runner.lock_history()
+        self.assertEqual(fail.exception.code, 2)
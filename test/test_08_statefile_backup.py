@@ -0,0 +1,218 @@
+'''
+    Test the state file checksum trailer, its backups, and recovery from them.
+'''
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import json
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl.stateformats import (TRAILER_SIZE, add_trailer, split_trailer, trailer_generation,
+                                    encode_state, decode_state, salvage_journal)
+
+
+class TestTrailer(unittest.TestCase):
+    ''' Class of tests about the checksum trailer. '''
+
+    def test_trailer(self):
+        ''' Verify trailers round-trip, and catch any change to what they cover '''
+        data = add_trailer(b'{"some": "locks"}\n', 42)
+        self.assertEqual(len(data), len(b'{"some": "locks"}\n') + TRAILER_SIZE)
+        self.assertEqual(split_trailer(data), (b'{"some": "locks"}\n', 42))
+        self.assertEqual(trailer_generation(data[-TRAILER_SIZE:]), 42)
+        self.assertEqual(split_trailer(b'{}\n'), (b'{}\n', None))
+        for damaged in [data.replace(b'some', b'sume'), data.replace(b'42', b'43'),
+                        data[:-9] + b'zzzzzzzz\n', data[:-1] + b'x']:
+            with self.assertRaises(ValueError):
+                split_trailer(damaged)
+
+
+class TestStatefileBackup(unittest.TestCase):
+    ''' Class of tests about backups of the state file, and recovering from them. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-backup.')
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.sf_patcher.start()
+        self.library = self._statefile(state_format='binary')
+        now = int(time.time())
+        self.locks = {
+            'whodoyou': {'message': 'hi', 'locktype': 'disable', 'time_begin': now-30*60,
+                         'time_expiry': now+30*60, 'user': 'username1'},
+        }
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        self.sf_patcher.stop()
+
+    def _statefile(self, **options):
+        ''' A statefile in the work directory '''
+        statefile = PuppetctlStatefile(os.path.join(self.workdir, 'puppetctl.status'),
+                                       **options)
+        statefile.bogus_state_file = os.path.join(self.workdir, 'bogus')
+        return statefile
+
+    def _raw(self, filename=None):
+        ''' The bytes of the state file, or another file '''
+        with open(filename or self.library.state_file, 'rb') as filepointer:
+            return filepointer.read()
+
+    def _damage(self, filename=None, data=None):
+        ''' Change a username in the state file (or another), or replace it '''
+        filename = filename or self.library.state_file
+        if data is None:
+            data = self._raw(filename).replace(b'username1', b'username9')
+        with open(filename, 'wb') as filepointer:
+            filepointer.write(data)
+
+    def test_generations_and_rotation(self):
+        ''' Verify each write has the next generation, and a backup in the next slot '''
+        for generation in range(1, 5):
+            self.library.write_state_file(self.locks)
+            self.assertEqual(split_trailer(self._raw())[1], generation)
+            backup = f'{self.library.state_file}.backup.{generation % 3}'
+            self.assertEqual(self._raw(backup), self._raw())
+        self.assertFalse(os.path.exists(f'{self.library.state_file}.backup.3'))
+        self.assertEqual(self.library.metrics['backups_written'], 4)
+        self.assertEqual(self.library._read_state_file(), self.locks)
+
+    def test_recover_flipped_bit(self):
+        ''' Verify damage that still parses is caught by the checksum, and recovered '''
+        self.library.write_state_file({})
+        self.library.write_state_file(self.locks)
+        self._damage()
+        self.assertEqual(self.library._read_state_file(), self.locks)
+        self.assertEqual(self.library.metrics['recoveries'], 1)
+        # a read leaves the damage for a write session to put right:
+        self.assertFalse(os.path.exists(self.library.bogus_state_file))
+        self.assertEqual(self.library.purge_expired_locks(), 0)
+        self.assertEqual(self.library.metrics['recoveries'], 2)
+        self.assertTrue(os.path.exists(self.library.bogus_state_file))
+        # put back in place, as the next generation:
+        self.assertEqual(split_trailer(self._raw())[1], 3)
+
+    def test_recover_skips_damaged_backup(self):
+        ''' Verify recovery uses the newest backup that's good, and reads don't need to write '''
+        self.library.write_state_file(self.locks)
+        self.library.write_state_file(dict(self.locks, other=self.locks['whodoyou']))
+        self._damage(f'{self.library.state_file}.backup.2')
+        self._damage(data=b'{"truncat')
+        with mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                               return_value=False):
+            with self.library.session(write=True) as session:
+                self.assertEqual(session.read_state_file(), self.locks)
+            self.assertEqual(self._raw(), b'{"truncat')
+        with self.library.session(write=True) as session:
+            self.assertEqual(session.read_state_file(), self.locks)
+        self.assertEqual(self.library.metrics['recoveries'], 2)
+        self.assertEqual(self.library._read_state_file(), self.locks)
+        self.assertEqual(self.library.metrics['recoveries'], 2)
+
+    def test_no_good_backup(self):
+        ''' Verify a damaged file with nothing to recover from is reset, as before '''
+        library = self._statefile(state_format='binary', state_backups=0)
+        library.write_state_file(self.locks)
+        self.assertEqual(os.listdir(self.workdir), ['puppetctl.status'])
+        self._damage()
+        self.assertEqual(library._read_state_file(), {})
+        self.assertEqual(library.metrics['recovery_failures'], 1)
+        with self.assertRaises(ValueError):
+            self._statefile(state_backups=-1)
+
+    def test_hand_written(self):
+        ''' Verify files with no trailer, from before them or from hand edits, still read '''
+        with open(self.library.state_file, 'wb') as filepointer:
+            filepointer.write(encode_state(self.locks, 'json'))
+        self.assertEqual(set(self.library._read_state_file()), set(self.locks))
+        self.assertEqual(self.library.metrics['recoveries'], 0)
+
+    def test_json_stays_json(self):
+        ''' Verify a json state file has no trailer, so edits and other tools keep working '''
+        library = self._statefile(state_format='json')
+        library.write_state_file(self.locks)
+        library.add_lock('username2', 'nooperate', int(time.time())+60*60)
+        self.assertEqual(len(json.loads(self._raw())), 2)
+        self.assertEqual(split_trailer(self._raw(f'{library.state_file}.backup.2'))[1], 2)
+        # An edit by hand sticks:
+        self._damage(data=json.dumps(self.locks).encode())
+        self.assertEqual(library._read_state_file(), self.locks)
+        library.add_lock('username3', 'nooperate', int(time.time())+60*60)
+        self.assertEqual(len(library._read_state_file()), 2)
+        self.assertEqual(library.metrics['recoveries'], 0)
+        # and generations go on from the backups:
+        self.assertEqual(split_trailer(self._raw(f'{library.state_file}.backup.0'))[1], 3)
+        # What doesn't parse is still recovered:
+        self._damage(data=b'{"truncat')
+        self.assertEqual(len(library._read_state_file()), 2)
+        self.assertIn('may be lost', library.last_recovery)
+
+    def test_journal(self):
+        ''' Verify a journal has no trailer, but its backups do, and it recovers from them '''
+        library = self._statefile(state_format='journal')
+        library.write_state_file(self.locks)
+        library.add_lock('username2', 'nooperate', int(time.time())+60*60)
+        self.assertIsNone(split_trailer(self._raw())[1])
+        self.assertEqual(split_trailer(self._raw(f'{library.state_file}.backup.1'))[1], 1)
+        library.write_state_file(self.locks)
+        self.assertEqual(split_trailer(self._raw(f'{library.state_file}.backup.2'))[1], 2)
+        self._damage(data=self._raw()[:-1] + b'\x00\n')
+        self.assertEqual(library._read_state_file(), self.locks)
+        self.assertEqual(library.metrics['recoveries'], 1)
+
+    def test_journal_salvaged(self):
+        ''' Verify a journal damaged after its appends keeps the locks added before the damage '''
+        library = self._statefile(state_format='journal')
+        library.write_state_file(self.locks)
+        now = int(time.time())
+        kept = library.add_lock('username2', 'disable', now+60*60)
+        library.add_lock('username3', 'nooperate', now+60*60)
+        library.add_lock('username4', 'nooperate', now+60*60)
+        lines = self._raw().split(b'\n')
+        # Damage the second of the three appends:
+        self._damage(data=b'\n'.join(lines[:3] + [b'{"op": "ad'] + lines[4:]))
+        with self.assertRaises(ValueError):
+            decode_state(self._raw())
+        self.assertEqual(salvage_journal(self._raw())[1], 2)
+        self.assertEqual(sorted(library._read_state_file()), sorted(['whodoyou', kept]))
+        self.assertEqual(library.metrics['recoveries'], 1)
+        self.assertEqual(library.metrics['recovery_losses'], 1)
+        self.assertIn('the 2 changes made since are lost', library.last_recovery)
+        # A write session puts it right, as a fresh snapshot:
+        with library.session(write=True) as session:
+            self.assertEqual(session.get_disable_lock_ids('username2'), [kept])
+            self.assertIsNotNone(session.recovery)
+        self.assertEqual(sorted(decode_state(self._raw())), sorted(['whodoyou', kept]))
+        library._read_state_file()
+        self.assertIsNone(library.last_recovery)
+        # Nothing to salvage without the header and snapshot:
+        for damaged in [b'PCTLJRNL 1\n{"op": "snap\n', b'PCTLJRNL 9\n']:
+            with self.assertRaises(ValueError):
+                salvage_journal(damaged)
+
+    def test_recovery_losses(self):
+        ''' Verify a recovery says whether it lost anything, and the caller logs it '''
+        self.library.write_state_file(self.locks)
+        self._damage()
+        self.assertEqual(self.library._read_state_file(), self.locks)
+        self.assertIn('no change puppetctl made is lost', self.library.last_recovery)
+        self.assertIn('outside puppetctl are discarded', self.library.last_recovery)
+        self.assertEqual(self.library.metrics['recovery_losses'], 0)
+        # A journal restored from its snapshot's backup loses its appends:
+        library = self._statefile(state_format='journal')
+        library.write_state_file(self.locks)
+        library.add_lock('username2', 'disable', int(time.time())+60*60)
+        self._damage(data=b'PCTLJRNL 1\n{"op": "snap\n')
+        runner = PuppetctlExecution(library.state_file, state_format='journal', serve_socket='')
+        runner.statefile_object.bogus_state_file = library.bogus_state_file
+        with mock.patch.object(PuppetctlExecution, 'log') as mock_log:
+            self.assertFalse(runner.is_enabled())
+        self.assertEqual(runner.statefile_object.metrics['recovery_losses'], 1)
+        mock_log.assert_called_once()
+        self.assertIn('may be lost', mock_log.call_args[0][0])
@@ -0,0 +1,208 @@
+'''
+    Test the compact binary state file format.
+'''
+
+import unittest
+import os
+import json
+import time
+from io import StringIO, BytesIO, TextIOWrapper
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl.stateformats import (BINARY_MAGIC, SUMMARY_SIZE, encode_state, decode_state,
+                                     decode_summary, humanize_lock)
+
+
+class TestStatefileBinary(unittest.TestCase):
+    ''' Class of tests about the binary state file format. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_reading_file = '/tmp/binary-reading-file.test.txt'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(self.test_reading_file, state_format='binary')
+        self.sf_patcher.start()
+        now = int(time.time())
+        self.locks = {
+            'whodoyou': {'message': 'I disabled 1h', 'locktype': 'disable',
+                         'time_begin': now-30*60, 'time_expiry': now+30*60, 'user': 'username2'},
+            'fouronefour': {'message': '', 'locktype': 'nooperate',
+                            'time_begin': now-10*60, 'time_expiry': now+50*60,
+                            'user': 'username2'},
+        }
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in [self.test_reading_file, self.library.lock_file,
+                         self.library.bogus_state_file] + \
+                [f'{self.test_reading_file}.backup.{x}' for x in range(self.library.state_backups)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def _raw(self):
+        ''' The bytes currently on disk '''
+        with open(self.test_reading_file, 'rb') as filepointer:
+            return filepointer.read()
+
+    def test_format_init(self):
+        ''' Verify the format setting is checked '''
+        self.assertEqual(PuppetctlStatefile(self.test_reading_file).state_format, 'json')
+        self.assertEqual(self.library.state_format, 'binary')
+        with self.assertRaises(ValueError):
+            PuppetctlStatefile(self.test_reading_file, state_format='yaml')
+
+    def test_roundtrip(self):
+        ''' Verify what we write in binary is what we read back '''
+        self.assertTrue(self.library.write_state_file(self.locks))
+        self.assertTrue(self._raw().startswith(BINARY_MAGIC))
+        self.assertDictEqual(self.library._read_state_file(), self.locks)
+        self.assertDictEqual(decode_state(encode_state({}, 'binary')), {})
+
+    def test_smaller_and_terse(self):
+        ''' Verify the binary format is smaller and doesn't store the human fields '''
+        binary = encode_state(self.locks, 'binary')
+        self.assertLess(len(binary), len(encode_state(self.locks, 'json')))
+        self.assertNotIn(b'_human', binary)
+        # repeated strings are only stored once:
+        self.assertEqual(binary.count(b'username2'), 1)
+
+    def test_autodetect(self):
+        ''' Verify either format is read whatever we're set to write '''
+        self.library.write_state_file(self.locks)
+        json_reader = PuppetctlStatefile(self.test_reading_file)
+        self.assertDictEqual(json_reader._read_state_file(), self.locks)
+        # and switching formats back just rewrites on the next write:
+        json_reader.write_state_file(self.locks)
+        self.assertTrue(self._raw().startswith(b'{'))
+        self.assertEqual(set(self.library._read_state_file().keys()), set(self.locks.keys()))
+
+    def test_damaged_file_recovered(self):
+        ''' Verify a truncated binary file is set aside like bad JSON is, and recovered '''
+        self.library.write_state_file(self.locks)
+        with open(self.test_reading_file, 'wb') as filepointer:
+            filepointer.write(encode_state(self.locks, 'binary')[:-3])
+        with self.library.session(write=True) as session:
+            self.assertDictEqual(session.read_state_file(), self.locks)
+        self.assertTrue(os.path.exists(self.library.bogus_state_file))
+        self.assertEqual(self.library.metrics['recoveries'], 1)
+        with self.assertRaises(ValueError):
+            decode_state(BINARY_MAGIC + b'\x00')
+
+    def test_version1_readable(self):
+        ''' Verify files from before the summary header still read '''
+        current = encode_state(self.locks, 'binary')
+        version1 = (current[:8] + b'\x00\x01' + current[10:20] +
+                    current[SUMMARY_SIZE:])
+        self.assertDictEqual(decode_state(version1), self.locks)
+        self.assertIsNone(decode_summary(version1))
+        # Version 2 had a summary, but no check on it, so it isn't answered from:
+        version2 = (current[:8] + b'\x00\x02' + current[10:SUMMARY_SIZE-4] +
+                    current[SUMMARY_SIZE:])
+        self.assertDictEqual(decode_state(version2), self.locks)
+        self.assertIsNone(decode_summary(version2))
+
+    def test_damaged_summary(self):
+        ''' Verify a damaged summary is never believed, and a load recovers the locks '''
+        self.library.write_state_file(self.locks)
+        damaged = bytearray(self._raw())
+        # No locks of either type, as far as the summary is concerned:
+        damaged[20:SUMMARY_SIZE-4] = bytes(SUMMARY_SIZE - 24)
+        with open(self.test_reading_file, 'wb') as filepointer:
+            filepointer.write(damaged)
+        self.assertIsNone(decode_summary(bytes(damaged)))
+        self.assertIsNone(self.library.quick_lock_summary())
+        # Without a trailer to catch it, decoding the whole file still does:
+        untrailed = bytearray(encode_state(self.locks, 'binary'))
+        untrailed[20:SUMMARY_SIZE-4] = bytes(SUMMARY_SIZE - 24)
+        with self.assertRaises(ValueError):
+            decode_state(bytes(untrailed))
+        runner = PuppetctlExecution(self.test_reading_file, state_format='binary')
+        self.assertFalse(runner.is_enabled())
+        self.assertFalse(runner.is_operating())
+        self.assertGreaterEqual(runner.statefile_object.metrics['recoveries'], 1)
+        self.assertEqual(runner.statefile_object.metrics['summary_reads'], 0)
+
+    def test_summary(self):
+        ''' Verify the summary header counts locks and their expiry range '''
+        now = int(time.time())
+        locks = dict(self.locks, another={
+            'message': '', 'locktype': 'disable', 'time_begin': now-90*60,
+            'time_expiry': now-30*60, 'user': 'username1'})
+        summary = decode_summary(encode_state(locks, 'binary')[:SUMMARY_SIZE])
+        self.assertEqual(summary['disable'], (2, now-30*60, now+30*60))
+        self.assertEqual(summary['nooperate'], (1, now+50*60, now+50*60))
+        self.assertEqual(decode_summary(encode_state({}, 'binary'))['disable'], (0, 0, 0))
+        self.assertIsNone(decode_summary(encode_state(locks, 'json')))
+
+    def test_quick_lock_summary(self):
+        ''' Verify the summary answers without a parse, and only for binary files '''
+        self.library.write_state_file(self.locks)
+        with mock.patch('puppetctl.statefile.decode_state') as mock_decode:
+            self.assertEqual(self.library.quick_lock_summary(),
+                             {'disable': True, 'nooperate': True})
+        mock_decode.assert_not_called()
+        self.assertEqual(self.library.metrics['summary_reads'], 1)
+        # Once the locks run out, they're reported gone, though still in the file:
+        with mock.patch('time.time', return_value=time.time() + 40*60):
+            self.assertEqual(self.library.quick_lock_summary(),
+                             {'disable': False, 'nooperate': True})
+        # Inside a session, the session knows better:
+        with self.library.session():
+            self.assertIsNone(self.library.quick_lock_summary())
+        json_library = PuppetctlStatefile(self.test_reading_file)
+        json_library.write_state_file(self.locks)
+        self.assertIsNone(json_library.quick_lock_summary())
+        os.remove(self.test_reading_file)
+        self.assertIsNone(self.library.quick_lock_summary())
+
+    def test_execution_fast_path(self):
+        ''' Verify is-enabled, is-operating and motd-status take the fast path '''
+        runner = PuppetctlExecution(self.test_reading_file, state_format='binary')
+        runner.statefile_object.write_state_file(self.locks)
+        with mock.patch.object(PuppetctlStatefile, 'session') as mock_session:
+            self.assertFalse(runner.is_enabled())
+            self.assertFalse(runner.is_operating())
+        mock_session.assert_not_called()
+        # per-user questions still need the locks:
+        self.assertTrue(runner.is_enabled('somebody1'))
+        runner.statefile_object.write_state_file({})
+        with mock.patch.object(PuppetctlStatefile, 'session') as mock_session, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out, \
+                self.assertRaises(SystemExit) as motd:
+            runner.motd_status()
+        mock_session.assert_not_called()
+        self.assertEqual(motd.exception.code, 0)
+        self.assertEqual(fake_out.getvalue(), '')
+
+    def test_humanize_lock(self):
+        ''' Verify the human fields are rendered without touching the original '''
+        lockitem = self.locks['whodoyou']
+        humanized = humanize_lock(lockitem)
+        self.assertEqual(humanized['time_expiry_human'], time.ctime(lockitem['time_expiry']))
+        self.assertNotIn('time_expiry_human', lockitem)
+
+    def test_export_state(self):
+        ''' Verify export-state prints the live locks as humanized JSON '''
+        now = int(time.time())
+        self.library.write_state_file(dict(self.locks, expired={
+            'message': '', 'locktype': 'disable', 'time_begin': now-90*60,
+            'time_expiry': now-30*60, 'user': 'username1'}))
+        runner = PuppetctlExecution(self.test_reading_file, state_format='binary')
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            runner.export_state()
+        exported = json.loads(fake_out.getvalue())
+        self.assertEqual(sorted(exported.keys()), sorted(self.locks.keys()))
+        self.assertIn('time_begin_human', exported['whodoyou'])
+        for state_format in ['binary', 'journal']:
+            fake_out = TextIOWrapper(BytesIO())
+            with mock.patch('sys.stdout', new=fake_out):
+                runner.export_state(state_format=state_format)
+            exported = fake_out.buffer.getvalue()
+            self.assertTrue(exported.startswith(encode_state({}, state_format)[:8]))
+            self.assertEqual(decode_state(exported), self.locks)
@@ -0,0 +1,173 @@
+'''
+    Test the per-lock-file directory backend.
+'''
+
+import unittest
+import os
+import time
+import shutil
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+
+
+class TestStatefileDirectory(unittest.TestCase):
+    ''' Class of tests about the directory backend. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_state_dir = '/tmp/directory-state.test.d'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(backend='directory', state_dir=self.test_state_dir)
+        self.sf_patcher.start()
+        self.now = int(time.time())
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.test_state_dir, ignore_errors=True)
+        self.sf_patcher.stop()
+
+    def _names(self, prefix):
+        ''' The entries in the state directory starting with prefix '''
+        return sorted(x for x in os.listdir(self.test_state_dir) if x.startswith(prefix))
+
+    def test_backend_init(self):
+        ''' Verify the backend setting is checked '''
+        self.assertEqual(PuppetctlStatefile().backend, 'file')
+        self.assertEqual(PuppetctlStatefile().backend_object.name, 'file')
+        self.assertEqual(self.library.backend_object.state_dir, self.test_state_dir)
+        with self.assertRaises(ValueError):
+            PuppetctlStatefile(backend='sideways')
+
+    def test_one_file_per_lock(self):
+        ''' Verify each lock is a file named for what is-enabled needs, plus a claim '''
+        lockid = self.library.add_lock('somebody1', 'disable', self.now+60*60, 'hello')
+        (lock_name,) = self._names('lock.')
+        self.assertTrue(lock_name.startswith('lock.disable.somebody1.'))
+        self.assertTrue(lock_name.endswith(f'.{self.now+60*60}.{lockid}'))
+        self.assertEqual(self._names('claim.'), ['claim.disable.somebody1'])
+        self.assertFalse(os.path.exists(self.library.lock_file))
+        self.assertEqual(self.library.get_lock(lockid).message, 'hello')
+        self.assertFalse(self.library.add_lock('somebody1', 'disable', self.now+60*60))
+        self.assertTrue(self.library.remove_lock(lockid))
+        self.assertEqual(os.listdir(self.test_state_dir), [])
+
+    def test_racing_adds(self):
+        ''' Verify two writers racing for the same user and type can't both win '''
+        other = PuppetctlStatefile(backend='directory', state_dir=self.test_state_dir)
+        with self.library.session(write=True) as session:
+            self.assertTrue(session.add_lock('somebody1', 'disable', self.now+60*60))
+            lockid = other.add_lock('somebody1', 'disable', self.now+30*60)
+            self.assertTrue(lockid)
+            self.assertFalse(session.commit())
+        self.assertEqual(list(self.library.read_state_file().keys()), [lockid])
+        # but different locks don't get in each other's way:
+        self.assertTrue(other.add_lock('somebody2', 'disable', self.now+60*60))
+        self.assertEqual(len(self._names('lock.')), 2)
+
+    def test_expired_claim(self):
+        ''' Verify an expired lock is purged, and its claim doesn't block a new one '''
+        lockid = self.library.add_lock('somebody1', 'nooperate', self.now+60)
+        with mock.patch('time.time', return_value=self.now+120):
+            # a reader who can't write leaves the files alone:
+            with mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                   return_value=False):
+                self.assertEqual(self.library.get_noop_lock_ids(), [])
+            self.assertEqual(len(self._names('lock.')), 1)
+            newid = self.library.add_lock('somebody1', 'nooperate', self.now+60*60)
+        self.assertNotEqual(lockid, newid)
+        self.assertEqual(list(self.library.read_state_file().keys()), [newid])
+        self.assertEqual(os.readlink(os.path.join(self.test_state_dir,
+                                                  'claim.nooperate.somebody1')),
+                         self._names('lock.')[0])
+
+    def test_extend_and_reset(self):
+        ''' Verify an extend moves the claim along, and a reset clears everything '''
+        lockid = self.library.add_lock('somebody1', 'disable', self.now+60)
+        self.library.apply_changes([{'op': 'extend', 'lockid': lockid,
+                                     'expiry': self.now+60*60}])
+        self.assertEqual(self.library.get_lock(lockid).time_expiry, self.now+60*60)
+        self.assertEqual(len(self._names('lock.')), 1)
+        self.assertTrue(self._names('lock.')[0].endswith(f'.{self.now+60*60}.{lockid}'))
+        self.assertEqual(os.readlink(os.path.join(self.test_state_dir,
+                                                  'claim.disable.somebody1')),
+                         self._names('lock.')[0])
+        self.library.add_lock('somebody2', 'nooperate', self.now+60*60)
+        self.assertTrue(self.library.reset_state_file())
+        self.assertEqual(os.listdir(self.test_state_dir), [])
+
+    def test_never_unlocked(self):
+        ''' Verify an extend, a forced re-disable and a reset never leave the host unlocked '''
+        lockid = self.library.add_lock('somebody1', 'disable', self.now+60)
+        real_unlink = os.unlink
+        seen = []
+
+        def _checking_unlink(path):
+            ''' Look at what a status check would see, after each lock file goes '''
+            real_unlink(path)
+            if os.path.basename(path).startswith('lock.'):
+                seen.append(self.library.backend_object.summary().get('disable', False))
+
+        with mock.patch('puppetctl.backends.os.unlink', side_effect=_checking_unlink):
+            self.library.apply_changes([{'op': 'extend', 'lockid': lockid,
+                                         'expiry': self.now+60*60}])
+            # What 'disable --force' does: the old lock out, a new one in.
+            with self.library.session(write=True) as session:
+                session.remove_lock(lockid)
+                newid = session.add_lock('somebody1', 'disable', self.now+2*60*60)
+            # A reset to other locks, as a recovery writes.
+            self.library.write_state_file({'abcd1234': {
+                'user': 'somebody2', 'locktype': 'disable', 'message': '',
+                'time_begin': self.now, 'time_expiry': self.now+60*60}})
+        self.assertEqual(seen, [True, True, True])
+        self.assertEqual(list(self.library.read_state_file().keys()), ['abcd1234'])
+        self.assertNotEqual(lockid, newid)
+        self.assertEqual(self._names('lock.'), [f'lock.disable.somebody2.{self.now}.'
+                                                f'{self.now+60*60}.abcd1234'])
+        self.assertEqual(self._names('claim.'), ['claim.disable.somebody2'])
+
+    def test_leftover_file(self):
+        ''' Verify a lock's old file, left by a writer that died, is ignored and cleaned up '''
+        lockid = self.library.add_lock('somebody1', 'disable', self.now+60)
+        (old_name,) = self._names('lock.')
+        with mock.patch.object(self.library.backend_object, '_remove'):
+            self.library.apply_changes([{'op': 'extend', 'lockid': lockid,
+                                         'expiry': self.now+60*60}])
+        self.assertEqual(len(self._names('lock.')), 2)
+        self.assertEqual(self.library.get_lock(lockid).time_expiry, self.now+60*60)
+        self.library.add_lock('somebody2', 'nooperate', self.now+60*60)
+        self.assertNotIn(old_name, self._names('lock.'))
+        self.assertTrue(self.library.remove_lock(lockid))
+        self.assertEqual(self.library.get_disable_lock_ids(), [])
+
+    def test_quick_lock_summary(self):
+        ''' Verify status checks come from the filenames alone '''
+        self.assertEqual(self.library.quick_lock_summary(),
+                         {'disable': False, 'nooperate': False})
+        self.library.add_lock('somebody1', 'disable', self.now+60)
+        with mock.patch('builtins.open') as mock_open:
+            self.assertEqual(self.library.quick_lock_summary(),
+                             {'disable': True, 'nooperate': False})
+        mock_open.assert_not_called()
+        with mock.patch('time.time', return_value=self.now+120):
+            self.assertEqual(self.library.quick_lock_summary(),
+                             {'disable': False, 'nooperate': False})
+
+    def test_execution_unchanged(self):
+        ''' Verify PuppetctlExecution works the same on a directory '''
+        runner = PuppetctlExecution(backend='directory', state_dir=self.test_state_dir)
+        runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=True), \
+                mock.patch.object(PuppetctlExecution, '_puppet_processes_running',
+                                  return_value={}), \
+                mock.patch('sys.stdout', new=StringIO()):
+            runner.nooperate(force=False, expiry=self.now+60*60, message='')
+            runner.disable(force=False, expiry=self.now+60*60, message='')
+        with mock.patch.object(PuppetctlStatefile, 'session') as mock_session:
+            self.assertFalse(runner.is_enabled())
+            self.assertTrue(runner.is_operating())
+        mock_session.assert_not_called()
+        self.assertEqual(len(self._names('lock.')), 1)
@@ -0,0 +1,144 @@
+'''
+    Test the append-only journal state file format.
+'''
+
+import unittest
+import os
+import time
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl.stateformats import (JOURNAL_MAGIC, encode_state, decode_state, iter_journal)
+
+
+class TestStatefileJournal(unittest.TestCase):
+    ''' Class of tests about the journal state file format. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_reading_file = '/tmp/journal-reading-file.test.txt'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(self.test_reading_file, state_format='journal')
+        self.sf_patcher.start()
+        self.library.reset_state_file()
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in [self.test_reading_file, self.library.lock_file]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def _raw(self):
+        ''' The bytes currently on disk '''
+        with open(self.test_reading_file, 'rb') as filepointer:
+            return filepointer.read()
+
+    def _ops(self):
+        ''' The journal records on disk, as (op, lockid) '''
+        return [(x['op'], x.get('lockid')) for x in iter_journal(self._raw())]
+
+    def test_journal_init(self):
+        ''' Verify the journal settings '''
+        self.assertEqual(self.library.journal_max_bytes,
+                         self.library.defaults.get('journal_max_bytes'))
+        self.assertEqual(PuppetctlStatefile(self.test_reading_file,
+                                            journal_max_bytes='100').journal_max_bytes, 100)
+        with self.assertRaises(ValueError):
+            PuppetctlStatefile(self.test_reading_file, journal_max_bytes=-1)
+
+    def test_changes_append(self):
+        ''' Verify adds and removes append records, and replay to the same locks '''
+        self.assertTrue(self._raw().startswith(JOURNAL_MAGIC))
+        now = int(time.time())
+        lockid1 = self.library.add_lock('somebody1', 'disable', now+60*60, 'first')
+        before = os.stat(self.test_reading_file)
+        lockid2 = self.library.add_lock('somebody2', 'nooperate', now+60*60)
+        self.library.remove_lock(lockid1)
+        after = os.stat(self.test_reading_file)
+        # appended in place, not replaced:
+        self.assertEqual(before.st_ino, after.st_ino)
+        self.assertEqual(self._ops(), [('snapshot', None), ('add', lockid1),
+                                       ('add', lockid2), ('remove', lockid1)])
+        self.assertEqual(self.library.metrics['journal_appends'], 3)
+        self.assertEqual(list(self.library._read_state_file().keys()), [lockid2])
+        self.assertEqual(self.library.get_lock_info(lockid2)[:29],
+                         'Puppet is in nooperate mode b')
+
+    def test_expiry_recorded(self):
+        ''' Verify the expiry purge is a record too '''
+        lockid = self.library.add_lock('somebody1', 'disable', int(time.time())+60)
+        with mock.patch('time.time', return_value=time.time()+120):
+            self.assertEqual(self.library.purge_expired_locks(), 1)
+        self.assertEqual(self._ops()[-1], ('expire', lockid))
+        # replaying a second expiry of the same lock, as racing readers may write, is harmless:
+        with open(self.test_reading_file, 'ab') as filepointer:
+            filepointer.write(b'{"op":"expire","lockid":"' + lockid.encode() + b'","time":0}\n')
+        self.assertEqual(self.library._read_state_file(), {})
+
+    def test_compaction(self):
+        ''' Verify the journal is compacted when it would grow too big, and on reset '''
+        self.library.journal_max_bytes = 600
+        now = int(time.time())
+        users = [f'somebody{x}' for x in range(8)]
+        for user in users:
+            lockid = self.library.add_lock(user, 'disable', now+60*60)
+        self.assertGreater(self.library.metrics['journal_compactions'], 1)
+        # the snapshot holds what the compacted records did:
+        self.assertEqual(self._ops()[0], ('snapshot', None))
+        self.assertLess(len(self._ops()), len(users) + 1)
+        self.assertEqual(sorted(x['user'] for x in self.library.read_state_file().values()),
+                         users)
+        self.library.reset_state_file()
+        self.assertEqual(self._ops(), [('snapshot', None)])
+        self.assertFalse(self.library.get_lock_info(lockid))
+
+    def test_unfinished_append(self):
+        ''' Verify a torn last record is ignored, and not appended after '''
+        lockid = self.library.add_lock('somebody1', 'disable', int(time.time())+60*60)
+        with open(self.test_reading_file, 'ab') as filepointer:
+            filepointer.write(b'{"op":"remove","lock')
+        self.assertEqual(list(self.library._read_state_file().keys()), [lockid])
+        lockid2 = self.library.add_lock('somebody2', 'disable', int(time.time())+60*60)
+        self.assertEqual(self._ops(), [('snapshot', None)])
+        self.assertEqual(sorted(self.library._read_state_file().keys()),
+                         sorted([lockid, lockid2]))
+
+    def test_damaged_journal(self):
+        ''' Verify a damaged journal fails to decode (and so is set aside like bad JSON) '''
+        good = encode_state({}, 'journal')
+        for bad in [good + b'not json\n', good + b'{"op":"explode"}\n',
+                    good + b'{"op":"add"}\n', JOURNAL_MAGIC + b' 99\n']:
+            with self.assertRaises(ValueError):
+                decode_state(bad)
+
+    def test_format_switch(self):
+        ''' Verify switching to and from the journal just rewrites on the next write '''
+        json_library = PuppetctlStatefile(self.test_reading_file)
+        lockid = json_library.add_lock('somebody1', 'disable', int(time.time())+60*60)
+        self.assertTrue(self._raw().startswith(b'{'))
+        self.library.add_lock('somebody2', 'disable', int(time.time())+60*60)
+        self.assertTrue(self._raw().startswith(JOURNAL_MAGIC))
+        self.assertEqual(self._ops()[0], ('snapshot', None))
+        json_library.remove_lock(lockid)
+        self.assertTrue(self._raw().startswith(b'{'))
+
+    def test_execution_unchanged(self):
+        ''' Verify PuppetctlExecution works the same on a journal '''
+        runner = PuppetctlExecution(self.test_reading_file, state_format='journal')
+        runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=True), \
+                mock.patch.object(PuppetctlExecution, '_puppet_processes_running',
+                                  return_value={}), \
+                mock.patch('sys.stdout', new=StringIO()):
+            runner.nooperate(force=False, expiry=int(time.time())+60*60, message='')
+            runner.disable(force=False, expiry=int(time.time())+60*60, message='')
+        self.assertFalse(runner.is_enabled())
+        self.assertTrue(runner.is_operating())
+        self.assertEqual([x[0] for x in self._ops()], ['snapshot', 'add', 'remove', 'add'])
@@ -0,0 +1,160 @@
+'''
+    Test the backend interface, and the in-memory backend.
+'''
+
+import unittest
+import os
+import threading
+import time
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import (PuppetctlStatefile, PuppetctlExecution, PuppetctlBackend,
+                       PuppetctlMemoryBackend)
+
+
+def _lock(user, locktype, time_expiry):
+    ''' Make a lock structure as the state file has it '''
+    return {'user': user, 'locktype': locktype, 'message': '',
+            'time_begin': time_expiry - 3600, 'time_expiry': time_expiry}
+
+
+class TestMemoryBackend(unittest.TestCase):
+    ''' Class of tests about the in-memory backend. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.now = int(time.time())
+        self.backend = PuppetctlMemoryBackend({'aaaa': _lock('user1', 'disable',
+                                                             self.now + 60)})
+
+    def test_interface(self):
+        ''' Verify load, commit, reset and summary '''
+        loaded = self.backend.load()
+        self.assertEqual(list(loaded.keys()), ['aaaa'])
+        # what we load is ours to change:
+        loaded['aaaa']['user'] = 'changed'
+        self.assertEqual(self.backend.load()['aaaa']['user'], 'user1')
+        self.assertEqual(self.backend.summary(), {'disable': True})
+        version = self.backend.version()
+        self.assertTrue(self.backend.commit({}, [('add', 'bbbb',
+                                                  _lock('user2', 'nooperate', self.now + 60)),
+                                                 ('remove', 'aaaa', None)]))
+        self.assertNotEqual(self.backend.version(), version)
+        self.assertEqual(list(self.backend.load().keys()), ['bbbb'])
+        self.assertEqual(self.backend.summary(), {'nooperate': True})
+        self.assertTrue(self.backend.reset())
+        self.assertEqual(self.backend.load(), {})
+
+    def test_clash(self):
+        ''' Verify an add over someone else's live lock fails, changing nothing '''
+        self.assertFalse(self.backend.commit({}, [('remove', 'cccc', None),
+                                                  ('add', 'bbbb',
+                                                   _lock('user1', 'disable', self.now + 60))]))
+        self.assertEqual(list(self.backend.load().keys()), ['aaaa'])
+        with mock.patch('time.time', return_value=self.now + 120):
+            self.assertTrue(self.backend.commit({}, [('add', 'bbbb',
+                                                      _lock('user1', 'disable',
+                                                            self.now + 600))]))
+
+    def test_watch(self):
+        ''' Verify watch wakes on a commit, and times out without one '''
+        self.assertFalse(self.backend.watch(timeout=0.01))
+        timer = threading.Timer(0.05, self.backend.reset)
+        timer.start()
+        self.assertTrue(self.backend.watch(timeout=5))
+        timer.join()
+
+    def test_interface_is_abstract(self):
+        ''' Verify the base class leaves the storage to subclasses '''
+        backend = PuppetctlBackend()
+        self.assertIsNone(backend.summary())
+        for method in [backend.load, backend.version, backend.reset]:
+            with self.assertRaises(NotImplementedError):
+                method()
+
+
+class TestMemoryStatefile(unittest.TestCase):
+    ''' Class of tests about statefiles and executions over the in-memory backend. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.backend = PuppetctlMemoryBackend()
+        self.library = PuppetctlStatefile(backend=self.backend)
+        self.now = int(time.time())
+
+    def test_statefile(self):
+        ''' Verify the statefile works the same, and needs no root, in memory '''
+        self.assertEqual(PuppetctlStatefile(backend='memory').backend, 'memory')
+        with mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                               return_value=False):
+            lockid = self.library.add_lock('somebody1', 'disable', self.now+60*60)
+        self.assertTrue(lockid)
+        # another statefile on the same backend sees it:
+        other = PuppetctlStatefile(backend=self.backend)
+        self.assertEqual(other.get_disable_lock_ids(), [lockid])
+        self.assertFalse(other.add_lock('somebody1', 'disable', self.now+60*60))
+        self.assertEqual(other.quick_lock_summary(), {'disable': True, 'nooperate': False})
+        self.assertTrue(other.reset_state_file())
+        self.assertEqual(self.library.read_state_file(), {})
+
+    def test_execution_without_files(self):
+        ''' Verify PuppetctlExecution runs on the in-memory backend with no file I/O '''
+        # No server can share our memory, and looking for one is file I/O.
+        runner = PuppetctlExecution(backend=self.backend, serve_socket='')
+        runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=True), \
+                mock.patch.object(PuppetctlExecution, '_puppet_processes_running',
+                                  return_value={}), \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out, \
+                mock.patch('builtins.open', side_effect=AssertionError), \
+                mock.patch('os.open', side_effect=AssertionError), \
+                mock.patch('os.stat', side_effect=AssertionError):
+            runner.disable(force=False, expiry=self.now+60*60, message='testing')
+            self.assertFalse(runner.is_enabled())
+            self.assertTrue(runner.is_operating())
+            runner.lock_status()
+            runner.enable()
+            self.assertTrue(runner.is_enabled())
+            runner.nooperate(force=False, expiry=self.now+60*60, message='')
+            self.assertFalse(runner.is_operating())
+        self.assertIn('testing', fake_out.getvalue())
+        self.assertEqual(len(self.backend.load()), 1)
+        self.assertFalse(os.path.exists(runner.statefile_object.lock_file))
+
+
+class TestBackendWatch(unittest.TestCase):
+    ''' Class of tests about waiting for changes to the state file. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_reading_file = '/tmp/watch-reading-file.test.txt'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(self.test_reading_file)
+        self.sf_patcher.start()
+        self.library.reset_state_file()
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in [self.test_reading_file, self.library.lock_file]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def test_wait_for_change(self):
+        ''' Verify the state file backend notices a write, by inotify or by polling '''
+        self.assertFalse(self.library.wait_for_change(timeout=0.01))
+        for watch_paths in [self.library.backend_object.watch_paths(), None]:
+            timer = threading.Timer(0.05, self.library.add_lock,
+                                    ['somebody1', 'disable', int(time.time())+60*60])
+            timer.start()
+            with mock.patch.object(self.library.backend_object, 'watch_paths',
+                                   return_value=watch_paths):
+                self.assertTrue(self.library.wait_for_change(timeout=5))
+            timer.join()
+            self.library.reset_state_file()
@@ -0,0 +1,240 @@
+'''
+    Test the SQLite backend.
+'''
+
+import unittest
+import os
+import json
+import time
+import shutil
+import sqlite3
+import multiprocessing
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+
+
+class TestStatefileSqlite(unittest.TestCase):
+    ''' Class of tests about the sqlite backend. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_state_db = '/tmp/sqlite-state.test.sqlite'
+        self.test_reading_file = '/tmp/sqlite-import-file.test.txt'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(backend='sqlite', state_db=self.test_state_db)
+        self.sf_patcher.start()
+        self.now = int(time.time())
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        self.library.backend_object.close()
+        for filename in [self.test_state_db, f'{self.test_state_db}-wal',
+                         f'{self.test_state_db}-shm', self.test_reading_file]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def _rows(self):
+        ''' The lockids in the database, expired or not '''
+        with sqlite3.connect(self.test_state_db) as connection:
+            return sorted(x for (x,) in connection.execute('SELECT lockid FROM locks'))
+
+    def test_no_database(self):
+        ''' Verify reads before any write find nothing, and don't make a database '''
+        self.assertEqual(self.library.read_state_file(), {})
+        self.assertEqual(self.library.quick_lock_summary(),
+                         {'disable': False, 'nooperate': False})
+        self.assertFalse(os.path.exists(self.test_state_db))
+
+    def test_reader_before_schema(self):
+        ''' Verify a reader that opened the database before its first write copes '''
+        sqlite3.connect(self.test_state_db).close()
+        self.assertEqual(self.library.read_state_file(), {})
+        self.assertEqual(self.library.quick_lock_summary(),
+                         {'disable': False, 'nooperate': False})
+        # and its connection makes the schema when it comes to write:
+        self.assertTrue(self.library.add_lock('somebody1', 'disable', self.now+60*60))
+        self.assertEqual(len(self._rows()), 1)
+
+    def test_add_remove(self):
+        ''' Verify locks go in and out as rows, in a WAL-mode database '''
+        lockid = self.library.add_lock('somebody1', 'disable', self.now+60*60, 'hello')
+        self.assertEqual(self._rows(), [lockid])
+        with sqlite3.connect(self.test_state_db) as connection:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+        self.assertEqual(self.library.get_lock(lockid).message, 'hello')
+        self.assertFalse(self.library.add_lock('somebody1', 'disable', self.now+60*60))
+        self.library.apply_changes([{'op': 'extend', 'lockid': lockid,
+                                     'expiry': self.now+2*60*60}])
+        self.assertEqual(self.library.get_lock(lockid).time_expiry, self.now+2*60*60)
+        self.assertTrue(self.library.remove_lock(lockid))
+        self.assertEqual(self._rows(), [])
+
+    @staticmethod
+    def _as_nobody(state_db, question):
+        '''
+            Ask question (a function of a PuppetctlExecution) in a process
+            running as nobody, and return its answer, or the name of the
+            exception it raised.
+        '''
+        ctx = multiprocessing.get_context('fork')
+        (answer_r, answer_w) = ctx.Pipe(duplex=False)
+
+        def _ask():
+            ''' Child process body '''
+            os.setgid(65534)
+            os.setuid(65534)
+            runner = PuppetctlExecution(backend='sqlite', state_db=state_db, serve_socket='')
+            try:
+                with mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                       return_value=False):
+                    answer_w.send(question(runner))
+            except Exception as err:  # pylint: disable=broad-except
+                answer_w.send(type(err).__name__)
+            os._exit(0)  # pylint: disable=protected-access
+
+        child = ctx.Process(target=_ask)
+        child.start()
+        answer = answer_r.recv()
+        child.join()
+        return answer
+
+    def test_nonroot_reads(self):
+        ''' Verify a user who can't write the database can still read it, and changes nothing '''
+        state_dir = '/tmp/sqlite-nonroot.test.d'
+        os.mkdir(state_dir, 0o755)
+        self.addCleanup(shutil.rmtree, state_dir, ignore_errors=True)
+        state_db = os.path.join(state_dir, 'state.sqlite')
+        writer = PuppetctlStatefile(backend='sqlite', state_db=state_db)
+        self.assertTrue(self._as_nobody(state_db, lambda x: x.is_enabled()))
+        lockid = writer.add_lock('somebody1', 'disable', self.now+60*60)
+        # With the writer's connection open, there's a log to read through:
+        self.assertTrue(os.path.exists(f'{state_db}-wal'))
+        self.assertFalse(self._as_nobody(state_db, lambda x: x.is_enabled()))
+        self.assertEqual(self._as_nobody(state_db,
+                                         lambda x: x.statefile_object.get_disable_lock_ids()),
+                         [lockid])
+        # Closed, there's only the database file, and nobody can't make the log beside it:
+        writer.backend_object.close()
+        self.assertEqual(os.listdir(state_dir), ['state.sqlite'])
+        self.assertFalse(self._as_nobody(state_db, lambda x: x.is_enabled()))
+        self.assertTrue(self._as_nobody(state_db, lambda x: x.is_operating()))
+        self.assertEqual(os.listdir(state_dir), ['state.sqlite'])
+        # A log whose index we can't open is still read:
+        writer.add_lock('somebody2', 'nooperate', self.now+60*60)
+        os.chmod(f'{state_db}-shm', 0o600)
+        self.assertFalse(self._as_nobody(state_db, lambda x: x.is_operating()))
+        writer.backend_object.close()
+        # and a database we can't read at all is an error, not an empty answer:
+        os.chmod(state_db, 0o600)
+        self.assertEqual(self._as_nobody(state_db, lambda x: x.is_operating()),
+                         'PermissionError')
+
+    def test_writer_timeout(self):
+        ''' Verify a writer kept out past lock_timeout times out as it would on the state file '''
+        library = PuppetctlStatefile(backend='sqlite', state_db=self.test_state_db,
+                                     lock_timeout=0.2)
+        self.addCleanup(library.backend_object.close)
+        self.assertTrue(library.add_lock('somebody1', 'disable', self.now+60*60))
+        with sqlite3.connect(self.test_state_db, isolation_level=None) as other:
+            other.execute('BEGIN IMMEDIATE')
+            with self.assertRaises(TimeoutError):
+                library.add_lock('somebody2', 'nooperate', self.now+60*60)
+            runner = PuppetctlExecution(backend='sqlite', state_db=self.test_state_db,
+                                        lock_timeout=0.2, serve_socket='')
+            runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+            with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                                   return_value=True), \
+                    mock.patch('sys.stdout', new=StringIO()) as fake_out, \
+                    self.assertRaises(SystemExit) as fail:
+                runner.disable(force=False, expiry=self.now+60*60, message='')
+            other.execute('ROLLBACK')
+        runner.statefile_object.backend_object.close()
+        self.assertEqual(fail.exception.code, 2)
+        self.assertIn('Timed out', fake_out.getvalue())
+        self.assertEqual(len(self._rows()), 1)
+
+    def test_database_mode(self):
+        ''' Verify the database is made readable by all, and left as it is after that '''
+        self.addCleanup(os.umask, os.umask(0o077))
+        self.library.add_lock('somebody1', 'disable', self.now+60*60)
+        self.assertEqual(os.stat(self.test_state_db).st_mode & 0o777, 0o644)
+        self.library.backend_object.close()
+        os.chmod(self.test_state_db, 0o640)
+        self.library.add_lock('somebody2', 'disable', self.now+60*60)
+        self.assertEqual(os.stat(self.test_state_db).st_mode & 0o777, 0o640)
+
+    def test_racing_adds(self):
+        ''' Verify a clash with someone else's add rolls back the whole commit '''
+        other = PuppetctlStatefile(backend='sqlite', state_db=self.test_state_db)
+        with self.library.session(write=True) as session:
+            session.add_lock('somebody2', 'nooperate', self.now+60*60)
+            session.add_lock('somebody1', 'disable', self.now+60*60)
+            lockid = other.add_lock('somebody1', 'disable', self.now+30*60)
+            self.assertFalse(session.commit())
+        other.backend_object.close()
+        self.assertEqual(self._rows(), [lockid])
+
+    def test_expiry_in_the_query(self):
+        ''' Verify expired rows are left out of reads, and deleted by the next write '''
+        lockid = self.library.add_lock('somebody1', 'disable', self.now+60)
+        with mock.patch('time.time', return_value=self.now+120):
+            self.assertEqual(self.library.quick_lock_summary(),
+                             {'disable': False, 'nooperate': False})
+            self.assertIsNone(self.library.get_lock(lockid))
+            self.assertEqual(self._rows(), [lockid])
+            newid = self.library.add_lock('somebody1', 'disable', self.now+60*60)
+        self.assertEqual(self._rows(), [newid])
+        self.assertTrue(self.library.reset_state_file())
+        self.assertEqual(self._rows(), [])
+
+    def test_import_state_file(self):
+        ''' Verify the importer copies live locks, and keeps what's already there '''
+        keep = self.library.add_lock('somebody1', 'disable', self.now+60*60)
+        locks = {
+            'whodoyou': {'message': 'hi', 'locktype': 'nooperate', 'time_begin': self.now,
+                         'time_expiry': self.now+60*60, 'user': 'somebody1'},
+            'clashing': {'message': '', 'locktype': 'disable', 'time_begin': self.now,
+                         'time_expiry': self.now+60*60, 'user': 'somebody1'},
+            'longgone': {'message': '', 'locktype': 'disable', 'time_begin': self.now-120,
+                         'time_expiry': self.now-60, 'user': 'somebody2'},
+        }
+        with open(self.test_reading_file, 'w', encoding='utf-8') as filepointer:
+            json.dump(locks, filepointer)
+        self.assertEqual(self.library.import_state_file(self.test_reading_file), 1)
+        self.assertEqual(self._rows(), sorted([keep, 'whodoyou']))
+        self.assertEqual(self.library.get_lock('whodoyou').message, 'hi')
+        with open(self.test_reading_file, 'w', encoding='utf-8') as filepointer:
+            json.dump({'junk': 1}, filepointer)
+        with self.assertRaises(ValueError):
+            self.library.import_state_file(self.test_reading_file)
+        with self.assertRaises(ValueError):
+            PuppetctlStatefile().import_state_file(self.test_reading_file)
+
+    def test_execution_import(self):
+        ''' Verify PuppetctlExecution imports, and answers from the database '''
+        runner = PuppetctlExecution(backend='sqlite', state_db=self.test_state_db)
+        runner.logging_tag = f'testingpuppetctl[{runner.invoking_user}]'
+        with open(self.test_reading_file, 'w', encoding='utf-8') as filepointer:
+            json.dump({'whodoyou': {'message': '', 'locktype': 'disable',
+                                    'time_begin': self.now, 'time_expiry': self.now+60*60,
+                                    'user': 'somebody1'}}, filepointer)
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=True), \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            runner.import_state(self.test_reading_file)
+            self.assertIn('Imported 1 locks', fake_out.getvalue())
+            with self.assertRaises(SystemExit) as fail:
+                runner.import_state('/tmp/no-such-file.test.txt')
+            self.assertEqual(fail.exception.code, 2)
+        with mock.patch.object(PuppetctlStatefile, 'session') as mock_session:
+            self.assertFalse(runner.is_enabled())
+            self.assertTrue(runner.is_operating())
+        mock_session.assert_not_called()
+        runner.statefile_object.backend_object.close()
@@ -0,0 +1,161 @@
+'''
+    Test watching the locks for changes.
+'''
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution, PuppetctlMemoryBackend
+from puppetctl.inotify import PuppetctlInotify
+
+
+class TestInotify(unittest.TestCase):
+    ''' Class of tests about the inotify wrapper. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-watch.')
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _touch(self, name):
+        ''' Make a file in the work directory '''
+        with open(os.path.join(self.workdir, name), 'w', encoding='utf-8') as filepointer:
+            filepointer.write('x')
+
+    def test_wait(self):
+        ''' Verify only changes to the named entries wake a wait '''
+        with PuppetctlInotify(self.workdir, ['watched']) as watcher:
+            self.assertFalse(watcher.wait(0.01))
+            self._touch('ignored')
+            self.assertFalse(watcher.wait(0.05))
+            self._touch('watched.tmp')
+            os.rename(os.path.join(self.workdir, 'watched.tmp'),
+                      os.path.join(self.workdir, 'watched'))
+            self.assertTrue(watcher.wait(5))
+        with PuppetctlInotify(self.workdir) as watcher:
+            self._touch('anything')
+            self.assertTrue(watcher.wait(5))
+
+    def test_no_directory(self):
+        ''' Verify watching nothing is an OSError, so callers can poll instead '''
+        with self.assertRaises(OSError):
+            PuppetctlInotify(os.path.join(self.workdir, 'nonexistent'))
+
+
+class TestStatefileWatch(unittest.TestCase):
+    ''' Class of tests about the lock event generator. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.backend = PuppetctlMemoryBackend()
+        self.library = PuppetctlStatefile(backend=self.backend)
+        self.now = int(time.time())
+
+    def _later(self, delay, function, *args):
+        ''' Run function in delay seconds, in another thread '''
+        timer = threading.Timer(delay, function, args)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_added_and_removed(self):
+        ''' Verify adds, removes and extends come out as events, and nothing else '''
+        old = self.library.add_lock('somebody1', 'nooperate', self.now+60*60)
+        events = self.library.watch(timeout=5)
+        self._later(0.05, self.library.add_lock, 'somebody2', 'disable', self.now+60*60, 'hi')
+        event = next(events)
+        self.assertEqual(event['event'], 'lock-added')
+        self.assertEqual((event['user'], event['message']), ('somebody2', 'hi'))
+        self.assertTrue(self.library.get_lock(event['lockid']))
+        self._later(0.05, self.library.remove_lock, old)
+        self.assertEqual((next(events)['event']), 'lock-removed')
+        self._later(0.05, self.library.apply_changes,
+                    [{'op': 'extend', 'lockid': event['lockid'], 'expiry': self.now+2*60*60}])
+        self.assertEqual([(x['event'], x['time_expiry']) for x in [next(events), next(events)]],
+                         [('lock-removed', self.now+60*60), ('lock-added', self.now+2*60*60)])
+
+    def test_expired(self):
+        ''' Verify an expiry is an event, at the time_expiry, with no write needed '''
+        lockid = self.library.add_lock('somebody1', 'disable', self.now+60*60)
+        real_time = time.time
+        offset = [0]
+        waits = []
+
+        def _sleep_through(timeout, since):
+            ''' The backend's wait, which no write ends, so it lasts the timeout '''
+            waits.append(timeout)
+            offset[0] += timeout
+            return False
+        with mock.patch('time.time', side_effect=lambda: real_time() + offset[0]), \
+                mock.patch.object(self.backend, 'watch', side_effect=_sleep_through):
+            event = next(self.library.watch())
+        self.assertEqual((event['event'], event['lockid']), ('lock-expired', lockid))
+        self.assertEqual(len(waits), 1)
+        self.assertAlmostEqual(waits[0], 60*60, delta=1)
+
+    def test_timeout(self):
+        ''' Verify the generator ends after the timeout, with no changes '''
+        start = time.monotonic()
+        self.assertEqual(list(self.library.watch(timeout=0.05)), [])
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_execution_watch(self):
+        ''' Verify PuppetctlExecution prints events as JSON lines, or as text '''
+        runner = PuppetctlExecution(backend=self.backend)
+        event = {'event': 'lock-added', 'lockid': 'aaaa', 'time': self.now, 'user': 'somebody1',
+                 'locktype': 'disable', 'message': '', 'time_begin': self.now,
+                 'time_expiry': self.now+60}
+        with mock.patch.object(PuppetctlStatefile, 'watch', return_value=iter([event])), \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            runner.watch(as_json=True)
+        self.assertEqual(json.loads(fake_out.getvalue()), event)
+        with mock.patch.object(PuppetctlStatefile, 'watch', return_value=iter([event])), \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            runner.watch()
+        self.assertIn('lock-added aaaa: Puppet has been disabled by somebody1',
+                      fake_out.getvalue())
+        with mock.patch.object(PuppetctlStatefile, 'watch', side_effect=KeyboardInterrupt), \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            runner.watch(as_json=True)
+        self.assertEqual(fake_out.getvalue(), '')
+
+
+class TestStatefileWatchFile(unittest.TestCase):
+    ''' Class of tests about watching a state file, which writes replace. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-watch.')
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.sf_patcher.start()
+        self.library = PuppetctlStatefile(os.path.join(self.workdir, 'puppetctl.status'))
+        self.library.lock_file = os.path.join(self.workdir, 'puppetctl.lock')
+        self.library.reset_state_file()
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        self.sf_patcher.stop()
+
+    def test_watch_file(self):
+        ''' Verify a change made by another statefile comes through inotify '''
+        other = PuppetctlStatefile(self.library.state_file)
+        other.lock_file = self.library.lock_file
+        events = self.library.watch(timeout=5)
+        timer = threading.Timer(0.05, other.add_lock,
+                                ['somebody1', 'disable', int(time.time())+60*60])
+        timer.start()
+        with mock.patch('time.sleep', side_effect=AssertionError):
+            event = next(events)
+        timer.join()
+        self.assertEqual((event['event'], event['user']), ('lock-added', 'somebody1'))
@@ -0,0 +1,191 @@
+'''
+    Test the indexed in-memory lock table.
+'''
+
+import unittest
+import os
+import json
+import time
+import pickle
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlLock, PuppetctlLockTable
+
+
+def _lock(user, locktype, time_expiry):
+    ''' Make a lock structure as the state file has it '''
+    return {'user': user, 'locktype': locktype, 'message': '',
+            'time_begin': time_expiry - 3600, 'time_expiry': time_expiry}
+
+
+def _record(lockid, user, locktype, time_expiry):
+    ''' Make a lock record for the table '''
+    return PuppetctlLock.from_dict(lockid, _lock(user, locktype, time_expiry))
+
+
+class TestLockTable(unittest.TestCase):
+    ''' Class of tests about the lock table by itself. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.table = PuppetctlLockTable.from_state({
+            'aaaa': _lock('user1', 'disable', 300),
+            'bbbb': _lock('user2', 'disable', 100),
+            'cccc': _lock('user1', 'nooperate', 200),
+        })
+
+    def test_indexes(self):
+        ''' Verify lookups by type and user, in expiry order '''
+        self.assertEqual(len(self.table), 3)
+        self.assertIn('aaaa', self.table)
+        self.assertEqual(self.table.ids('disable'), ['bbbb', 'aaaa'])
+        self.assertEqual(self.table.ids('disable', 'user1'), ['aaaa'])
+        self.assertEqual(self.table.ids('nooperate', 'user2'), [])
+        self.assertEqual(self.table.count('disable'), 2)
+        self.assertEqual(self.table.count('nooperate', 'user1'), 1)
+        self.assertEqual(self.table.count('nooperate', 'nobody'), 0)
+
+    def test_add_remove(self):
+        ''' Verify adds and removes keep the indexes right '''
+        self.table.add(_record('dddd', 'user2', 'nooperate', 50))
+        self.assertEqual(self.table.ids('nooperate'), ['dddd', 'cccc'])
+        with self.assertRaises(ValueError):
+            self.table.add(_record('dddd', 'user3', 'disable', 50))
+        self.assertEqual(self.table.remove('bbbb').user, 'user2')
+        self.assertEqual(self.table.ids('disable'), ['aaaa'])
+        self.assertEqual(self.table.count('disable', 'user2'), 0)
+        with self.assertRaises(KeyError):
+            self.table.remove('bbbb')
+
+    def test_next_expiry(self):
+        ''' Verify the soonest expiry, skipping removed locks '''
+        self.assertEqual(self.table.next_expiry(), (100, 'bbbb'))
+        self.assertEqual(self.table.next_expiry('nooperate'), (200, 'cccc'))
+        self.table.remove('bbbb')
+        self.assertEqual(self.table.next_expiry('disable'), (300, 'aaaa'))
+        # a reused lockid with a new expiry isn't confused with its old heap entry:
+        self.table.add(_record('bbbb', 'user2', 'disable', 400))
+        self.assertEqual(self.table.next_expiry('disable'), (300, 'aaaa'))
+        self.assertIsNone(PuppetctlLockTable().next_expiry())
+
+    def test_pop_expired(self):
+        ''' Verify expired locks come out together, and only those '''
+        self.assertEqual(sorted(self.table.pop_expired(250)), ['bbbb', 'cccc'])
+        self.assertEqual(list(self.table.locks.keys()), ['aaaa'])
+        self.assertEqual(self.table.pop_expired(250), [])
+
+    def test_many_removes(self):
+        ''' Verify the heaps stay correct through rebuilds '''
+        table = PuppetctlLockTable()
+        for num in range(100):
+            table.add(_record(f'lock{num}', f'user{num}', 'disable', 1000 + num))
+        for num in range(90):
+            table.remove(f'lock{num}')
+        self.assertEqual(table.next_expiry(), (1090, 'lock90'))
+        self.assertEqual(len(table.pop_expired(1095)), 5)
+        self.assertEqual(table.count('disable'), 5)
+
+    def test_snapshot(self):
+        ''' Verify a snapshot is read-only and doesn't see later changes '''
+        snap = self.table.snapshot()
+        self.assertIs(snap['aaaa'], self.table.get('aaaa'))
+        with self.assertRaises(TypeError):
+            snap['eeee'] = _record('eeee', 'user3', 'disable', 50)
+        self.table.remove('aaaa')
+        self.table.add(_record('eeee', 'user3', 'disable', 50))
+        self.assertEqual(sorted(snap.keys()), ['aaaa', 'bbbb', 'cccc'])
+        self.assertEqual(sorted(self.table.locks.keys()), ['bbbb', 'cccc', 'eeee'])
+
+
+class TestLockRecord(unittest.TestCase):
+    ''' Class of tests about single lock records. '''
+
+    def test_immutable(self):
+        ''' Verify a lock can't be changed in place '''
+        lock = _record('aaaa', 'user1', 'disable', 300)
+        with self.assertRaises(AttributeError):
+            lock.user = 'user2'
+        with self.assertRaises(AttributeError):
+            del lock.message
+        with self.assertRaises(AttributeError):
+            lock.extra = 'nope'
+        later = lock.replace(time_expiry=600)
+        self.assertEqual((later.lockid, later.time_expiry), ('aaaa', 600))
+        self.assertEqual(lock.time_expiry, 300)
+        # and it still pickles, to go between processes:
+        self.assertEqual(pickle.loads(pickle.dumps(lock)), lock)
+
+    def test_dict_adapters(self):
+        ''' Verify a lock still reads like the old dict '''
+        lockitem = _lock('user1', 'disable', 300)
+        lockitem['time_expiry_human'] = 'whenever'
+        lock = PuppetctlLock.from_dict('aaaa', lockitem)
+        self.assertEqual(lock['user'], 'user1')
+        with self.assertRaises(KeyError):
+            lock['time_expiry_human']  # pylint: disable=pointless-statement
+        self.assertDictEqual(lock.as_dict(), _lock('user1', 'disable', 300))
+        self.assertEqual(lock, PuppetctlLock.from_dict('aaaa', lock.as_dict()))
+        self.assertEqual(len({lock, PuppetctlLock.from_dict('aaaa', lock.as_dict())}), 1)
+        self.assertNotEqual(lock, lock.replace(message='changed'))
+
+
+class TestLockTableSession(unittest.TestCase):
+    ''' Class of tests about sessions answering from the lock table. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_reading_file = '/tmp/locktable-reading-file.test.txt'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.library = PuppetctlStatefile(self.test_reading_file)
+        self.sf_patcher.start()
+        self.now = int(time.time())
+        locks = {
+            'expired1': _lock('username1', 'nooperate', self.now - 60),
+            'whodoyou': _lock('username2', 'disable', self.now + 30*60),
+            'laterone': _lock('username3', 'disable', self.now + 90*60),
+        }
+        with open(self.test_reading_file,
+                  'w', encoding='utf-8') as filepointer:
+            json.dump(locks, filepointer)
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in [self.test_reading_file, self.library.lock_file]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def test_session_queries(self):
+        ''' Verify session lookups come from the table '''
+        with self.library.session() as session:
+            self.assertIsInstance(session.locks, PuppetctlLockTable)
+            self.assertEqual(session.expired_lock_ids, ['expired1'])
+            self.assertTrue(session.has_locks('disable'))
+            self.assertTrue(session.has_locks('disable', 'username3'))
+            self.assertFalse(session.has_locks('nooperate'))
+            self.assertEqual(session.get_disable_lock_ids(), ['whodoyou', 'laterone'])
+            self.assertEqual([x.lockid for x in session.get_locks(user='username3')],
+                             ['laterone'])
+            self.assertIsNone(session.get_lock('expired1'))
+        self.assertEqual(self.library.next_expiry(), (self.now + 30*60, 'whodoyou'))
+        self.assertIsNone(self.library.next_expiry('nooperate'))
+        self.assertEqual(self.library.get_lock('whodoyou').user, 'username2')
+        self.assertEqual([x.lockid for x in self.library.get_locks()], ['whodoyou', 'laterone'])
+        self.assertEqual(self.library.get_locks('nooperate'), [])
+
+    def test_session_changes(self):
+        ''' Verify adds and removes in a session show up in its answers '''
+        with self.library.session(write=True) as session:
+            session.remove_lock('whodoyou')
+            lockid = session.add_lock('username2', 'nooperate', self.now + 10*60)
+            self.assertEqual(session.next_expiry(), (self.now + 10*60, lockid))
+            self.assertEqual(session.get_disable_lock_ids(), ['laterone'])
+            before = session.snapshot()
+            session.remove_lock(lockid)
+            self.assertIn(lockid, before)
+            session.add_lock('username2', 'nooperate', self.now + 10*60)
+        self.assertEqual(len(self.library.read_state_file()), 2)
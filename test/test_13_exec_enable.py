@@ -8,7 +8,7 @@ import time
 from io import StringIO
 import test.context  # pylint: disable=unused-import
 import mock
-from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl import PuppetctlStatefile, PuppetctlStatefileSession, PuppetctlExecution
 
 
 class TestExecutionEnable(unittest.TestCase):
@@ -120,7 +120,7 @@ class TestExecutionEnable(unittest.TestCase):
         now = int(time.time())
         self.library.statefile_object.add_lock(self.library.invoking_user, 'disable',
                                                now+30*60, 'It is my lock')
-        with mock.patch.object(PuppetctlStatefile, 'remove_lock', return_value=False), \
+        with mock.patch.object(PuppetctlStatefileSession, 'remove_lock', return_value=False), \
                 self.assertRaises(SystemExit) as lockfail, \
                 mock.patch('sys.stdout', new=StringIO()) as fake_out:
             self.library.enable()
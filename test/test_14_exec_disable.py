@@ -8,7 +8,7 @@ import time
 from io import StringIO
 import test.context  # pylint: disable=unused-import
 import mock
-from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl import PuppetctlStatefile, PuppetctlStatefileSession, PuppetctlExecution
 
 
 class TestExecutionDisable(unittest.TestCase):
@@ -125,7 +125,7 @@ class TestExecutionDisable(unittest.TestCase):
 
     def test_disable_fail_add_lock(self):
         ''' Test that "disable" complains if it can't add a lock '''
-        with mock.patch.object(PuppetctlStatefile, 'add_lock', return_value=False), \
+        with mock.patch.object(PuppetctlStatefileSession, 'add_lock', return_value=False), \
                 self.assertRaises(SystemExit) as lockfail, \
                 mock.patch('sys.stdout', new=StringIO()) as fake_out, \
                 mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
@@ -141,7 +141,7 @@ class TestExecutionDisable(unittest.TestCase):
                                return_value=True):
             self.library.statefile_object.add_lock(self.library.invoking_user, 'disable',
                                                    now+30*60, 'It is my lock')
-        with mock.patch.object(PuppetctlStatefile, 'remove_lock', return_value=False), \
+        with mock.patch.object(PuppetctlStatefileSession, 'remove_lock', return_value=False), \
                 self.assertRaises(SystemExit) as lockfail, \
                 mock.patch('sys.stdout', new=StringIO()) as fake_out, \
                 mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
@@ -157,7 +157,7 @@ class TestExecutionDisable(unittest.TestCase):
                                return_value=True):
             self.library.statefile_object.add_lock(self.library.invoking_user, 'nooperate',
                                                    now+30*60, 'It is my lock')
-        with mock.patch.object(PuppetctlStatefile, 'remove_lock', return_value=False), \
+        with mock.patch.object(PuppetctlStatefileSession, 'remove_lock', return_value=False), \
                 self.assertRaises(SystemExit) as lockfail, \
                 mock.patch('sys.stdout', new=StringIO()) as fake_out, \
                 mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
@@ -8,7 +8,7 @@ import time
 from io import StringIO
 import test.context  # pylint: disable=unused-import
 import mock
-from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl import PuppetctlStatefile, PuppetctlStatefileSession, PuppetctlExecution
 
 
 class TestExecutionNooperate(unittest.TestCase):
@@ -127,7 +127,7 @@ class TestExecutionNooperate(unittest.TestCase):
 
     def test_noop_fail_add_lock(self):
         ''' Test that "nooperate" complains if it can't add a lock '''
-        with mock.patch.object(PuppetctlStatefile, 'add_lock', return_value=False), \
+        with mock.patch.object(PuppetctlStatefileSession, 'add_lock', return_value=False), \
                 self.assertRaises(SystemExit) as lockfail, \
                 mock.patch('sys.stdout', new=StringIO()) as fake_out, \
                 mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
@@ -143,7 +143,7 @@ class TestExecutionNooperate(unittest.TestCase):
                                return_value=True):
             self.library.statefile_object.add_lock(self.library.invoking_user, 'nooperate',
                                                    now+30*60, 'It is my lock')
-        with mock.patch.object(PuppetctlStatefile, 'remove_lock', return_value=False), \
+        with mock.patch.object(PuppetctlStatefileSession, 'remove_lock', return_value=False), \
                 self.assertRaises(SystemExit) as lockfail, \
                 mock.patch('sys.stdout', new=StringIO()) as fake_out, \
                 mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
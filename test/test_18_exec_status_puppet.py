@@ -4,7 +4,9 @@
 
 import unittest
 import os
+import json
 import time
+import shutil
 import subprocess
 import builtins
 from io import StringIO
@@ -21,28 +23,24 @@ class TestExecutionStatusPuppet(unittest.TestCase):
         self.test_statefile = '/tmp/exec-status-puppetctl-statefile-mods.test.txt'
         self.library = PuppetctlExecution(self.test_statefile)
         self.library.logging_tag = f'testingpuppetctl[{self.library.invoking_user}]'
+        self.test_lastrunfile = '/tmp/exec-status-puppet-last_run_summary.test.yaml'
+        self.test_lastrun_cache = f'{self.test_statefile}.lastrun'
 
     def tearDown(self):
         ''' Cleanup test rig '''
-        try:
-            os.remove(self.test_statefile)
-        except OSError:
-            # we likely never created the file.
-            pass
+        for filename in [self.test_statefile, self.test_lastrunfile, self.test_lastrun_cache]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
 
-    def test_parse_lastrunfile(self):
+    def _check_lastrunfiles(self, library):
         ''' Run our test files through _parse_puppet_lastrunfile '''
-        with open(os.devnull, 'w', encoding='utf-8') as devnull:
-            retcode = subprocess.call(['ruby', '--version'],
-                                      env={'PATH': self.library.puppet_bin_path},
-                                      stdout=devnull)
-            if retcode != 0:  # pragma: no cover
-                self.skipTest('Cannot test without the puppet ruby environment')
-            devnull.close()
         mydir = os.path.dirname(__file__)
 
         cleanfile = os.path.join(mydir, 'last_run_summary', 'clean_last_run_summary.yaml')
-        cleancodes = self.library._parse_puppet_lastrunfile(cleanfile)
+        cleancodes = library._parse_puppet_lastrunfile(cleanfile)
         # The values here are visually copied from the files in test/last_run_summary/*
         age = int(time.time()) - 1586995296
         nearage = [age-1, age, age+1]
@@ -51,7 +49,7 @@ class TestExecutionStatusPuppet(unittest.TestCase):
         self.assertEqual(cleancodes['config'], 'a294ac4f4fcd5264e5246df0787757a74fc3d966')
 
         onefailfile = os.path.join(mydir, 'last_run_summary', 'fail_one_last_run_summary.yaml')
-        onefailcodes = self.library._parse_puppet_lastrunfile(onefailfile)
+        onefailcodes = library._parse_puppet_lastrunfile(onefailfile)
         # The values here are visually copied from the files in test/last_run_summary/*
         age = int(time.time()) - 1587278457
         nearage = [age-1, age, age+1]
@@ -59,6 +57,87 @@ class TestExecutionStatusPuppet(unittest.TestCase):
         self.assertEqual(onefailcodes['errors'], 1)
         self.assertEqual(onefailcodes['config'], '3a3d5827a1637456d360f888462d2aa0dbd975f6')
 
+    def test_parse_lastrunfile(self):
+        ''' Run our test files through the native parser '''
+        self.assertEqual(self.library.lastrun_parser, 'native')
+        with mock.patch('subprocess.Popen') as mock_popen:
+            self._check_lastrunfiles(self.library)
+        mock_popen.assert_not_called()
+
+    def test_parse_lastrunfile_ruby(self):
+        ''' Run our test files through the ruby parser '''
+        library = PuppetctlExecution(self.test_statefile, lastrun_parser='ruby', lastrun_cache='')
+        with open(os.devnull, 'w', encoding='utf-8') as devnull:
+            retcode = subprocess.call(['ruby', '--version'],
+                                      env={'PATH': library.puppet_bin_path},
+                                      stdout=devnull)
+            if retcode != 0:  # pragma: no cover
+                self.skipTest('Cannot test without the puppet ruby environment')
+            devnull.close()
+        self._check_lastrunfiles(library)
+        with self.assertRaises(ValueError), \
+                mock.patch('sys.stderr', new=StringIO()):
+            library._parse_puppet_lastrunfile('/tmp/no-such-lastrunfile.yaml')
+
+    def test_parse_lastrunfile_nocatalog(self):
+        ''' A run that never applied a catalog counts as an error '''
+        with open(self.test_lastrunfile, 'w', encoding='utf-8') as lastrun_w:
+            lastrun_w.write('---\nversion:\n  config:\n  puppet: 7.1.0\ntime:\n'
+                            '  last_run: 1587279000\n')
+        codes = self.library._parse_puppet_lastrunfile(self.test_lastrunfile)
+        self.assertEqual((codes['errors'], codes['config']), (1, ''))
+
+    def test_lastrun_cache(self):
+        ''' Repeat reads of an unchanged lastrunfile come from the cache, or from memory '''
+        self.assertEqual(self.library.lastrun_cache, self.test_lastrun_cache)
+        mydir = os.path.dirname(__file__)
+        for name in ['fail_one', 'clean']:
+            shutil.copy(os.path.join(mydir, 'last_run_summary', f'{name}_last_run_summary.yaml'),
+                        self.test_lastrunfile)
+            with mock.patch('time.time', return_value=1587280000):
+                first = self.library._parse_puppet_lastrunfile(self.test_lastrunfile)
+            # The next status is another process:
+            with mock.patch('puppetctl.execution.read_last_run_summary') as mock_read, \
+                    mock.patch('time.time', return_value=1587280100):
+                second = PuppetctlExecution(self.test_statefile)._parse_puppet_lastrunfile(
+                    self.test_lastrunfile)
+            mock_read.assert_not_called()
+            # The age still moves on:
+            self.assertEqual(second['age'], first['age']+100)
+            self.assertEqual(second['errors'], first['errors'])
+        # A new summary isn't answered from the old one's cache:
+        self.assertEqual(second['errors'], 0)
+        with open(self.test_lastrun_cache, 'r', encoding='utf-8') as cache_r:
+            self.assertEqual(json.load(cache_r)['record']['total_time'], 29.360705031)
+        # A damaged cache is just a miss, and is replaced:
+        with open(self.test_lastrun_cache, 'w', encoding='utf-8') as cache_w:
+            cache_w.write('{"trunc')
+        library = PuppetctlExecution(self.test_statefile)
+        self.assertEqual(library._parse_puppet_lastrunfile(self.test_lastrunfile)['errors'], 0)
+        with open(self.test_lastrun_cache, 'r', encoding='utf-8') as cache_r:
+            self.assertEqual(json.load(cache_r)['record']['failed'], 0)
+        # The same runner asked again keeps it in memory:
+        with mock.patch('puppetctl.execution.read_cached_record') as mock_cached:
+            self.assertEqual(library._parse_puppet_lastrunfile(self.test_lastrunfile)['errors'],
+                             0)
+        mock_cached.assert_not_called()
+        # Being unable to keep the cache costs nothing but a parse.
+        library = PuppetctlExecution(self.test_statefile,
+                                     lastrun_cache='/tmp/no-such-dir/lastrun.cache')
+        self.assertEqual(library._parse_puppet_lastrunfile(self.test_lastrunfile)['errors'], 0)
+        # Nor is there a cache for the in-memory backend, or if it's turned off:
+        self.assertEqual(PuppetctlExecution(self.test_statefile, backend='memory').lastrun_cache,
+                         '')
+        library = PuppetctlExecution(self.test_statefile, lastrun_cache='')
+        os.remove(self.test_lastrun_cache)
+        library._parse_puppet_lastrunfile(self.test_lastrunfile)
+        self.assertFalse(os.path.exists(self.test_lastrun_cache))
+
+    def test_lastrun_parser_option(self):
+        ''' Only the parsers we have may be chosen '''
+        with self.assertRaises(ValueError):
+            PuppetctlExecution(self.test_statefile, lastrun_parser='python-yaml')
+
     def test_status_puppet(self):
         ''' Emulate testing the status of puppet '''
         with mock.patch('os.geteuid', return_value=0), \
@@ -67,6 +146,15 @@ class TestExecutionStatusPuppet(unittest.TestCase):
             self.library._status_of_puppet('/tmp/pretend-i-exist.txt')
         mock_parse.assert_called_once_with('/tmp/pretend-i-exist.txt')
 
+    def test_status_puppet_unreadable(self):
+        ''' Emulate testing the status of puppet when the file can't be read '''
+        with open(self.test_lastrunfile, 'w', encoding='utf-8') as lastrun_w:
+            lastrun_w.write('time: [1, 2]\n')
+        with mock.patch('os.geteuid', return_value=0):
+            result = self.library._status_of_puppet(self.test_lastrunfile)
+        self.assertEqual(result['errors'], 1)
+        self.assertIn(f'Cannot read "{self.test_lastrunfile}"', result['message'])
+
     def test_status_puppet_nonroot(self):
         ''' Emulate testing the status of puppet when not root '''
         with mock.patch('os.geteuid', return_value=1006), \
@@ -0,0 +1,96 @@
+'''
+    PuppetctlExecution.apply_locks test script
+'''
+
+import unittest
+import os
+import json
+import time
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+
+
+class TestExecutionApplyLocks(unittest.TestCase):
+    ''' Class of tests about executing puppetctl apply_locks commands. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_statefile = '/tmp/exec-apply_locks-statefile-mods.test.txt'
+        self.library = PuppetctlExecution(self.test_statefile)
+        self.library.logging_tag = f'testingpuppetctl[{self.library.invoking_user}]'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.sf_patcher.start()
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        for filename in [self.test_statefile, self.library.statefile_object.lock_file]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def test_apply_locks_noroot(self):
+        ''' Test that apply_locks fails when not root '''
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=False), \
+                self.assertRaises(SystemExit) as fail_apply, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.apply_locks([])
+        self.assertIn("Must be root to run 'apply-locks'", fake_out.getvalue())
+        self.assertEqual(fail_apply.exception.code, 2)
+
+    def test_apply_locks_swap(self):
+        ''' Test swapping our noop for a disable, and adding a service lock '''
+        now = int(time.time())
+        user = self.library.invoking_user
+        self.library.statefile_object.add_lock(user, 'nooperate', now+30*60)
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=True), \
+                mock.patch.object(PuppetctlExecution, '_puppet_processes_running',
+                                  return_value={}) as mock_procs, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.apply_locks([
+                {'op': 'remove', 'locktype': 'nooperate'},
+                {'op': 'add', 'locktype': 'disable', 'expiry': now+60*60},
+                {'op': 'add', 'user': 'svcdeploy', 'locktype': 'disable', 'expiry': now+60*60},
+            ])
+        added = json.loads(fake_out.getvalue())['added']
+        self.assertEqual(len(added), 2)
+        self.assertTrue(self.library.is_operating())
+        self.assertFalse(self.library.is_enabled(user))
+        self.assertFalse(self.library.is_enabled('svcdeploy'))
+        mock_procs.assert_called_once()
+
+    def test_apply_locks_bad(self):
+        ''' Test that a bad batch is refused, whole '''
+        now = int(time.time())
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=True), \
+                self.assertRaises(SystemExit) as fail_apply, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.apply_locks([
+                {'op': 'add', 'locktype': 'disable', 'expiry': now+60*60},
+                {'op': 'remove', 'locktype': 'nooperate'},
+            ])
+        self.assertIn('Unable to apply lock changes: operation 1', fake_out.getvalue())
+        self.assertEqual(fail_apply.exception.code, 2)
+        self.assertTrue(self.library.is_enabled())
+
+    def test_apply_locks_write_fails(self):
+        ''' Test that a failed write is reported '''
+        now = int(time.time())
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=True), \
+                mock.patch.object(PuppetctlStatefile, 'write_state_file', return_value=False), \
+                self.assertRaises(SystemExit) as fail_apply, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.apply_locks([
+                {'op': 'add', 'locktype': 'disable', 'expiry': now+60*60},
+            ])
+        self.assertIn('Unable to write lock changes', fake_out.getvalue())
+        self.assertEqual(fail_apply.exception.code, 2)
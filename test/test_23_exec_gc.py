@@ -0,0 +1,67 @@
+'''
+    PuppetctlExecution.gc test script
+'''
+
+import unittest
+import os
+import time
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+
+
+class TestExecutionGc(unittest.TestCase):
+    ''' Class of tests about executing puppetctl gc commands. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.test_statefile = '/tmp/exec-gc-statefile-mods.test.txt'
+        self.library = PuppetctlExecution(self.test_statefile)
+        self.library.logging_tag = f'testingpuppetctl[{self.library.invoking_user}]'
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.sf_patcher.start()
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        statefile = self.library.statefile_object
+        for filename in [self.test_statefile, statefile.lock_file,
+                         statefile.audit_log_object.audit_log] + \
+                [f'{self.test_statefile}.backup.{x}' for x in range(statefile.state_backups)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # we likely never created the file.
+                pass
+        self.sf_patcher.stop()
+
+    def test_gc_noroot(self):
+        ''' Test that gc fails when not root '''
+        with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                               return_value=False), \
+                self.assertRaises(SystemExit) as fail_gc, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.gc()
+        self.assertIn("Must be root to run 'gc'", fake_out.getvalue())
+        self.assertEqual(fail_gc.exception.code, 2)
+
+    def test_gc(self):
+        ''' Test that reads leave expired locks for gc to purge '''
+        now = int(time.time())
+        statefile = self.library.statefile_object
+        statefile.add_lock('somebody1', 'disable', now+60)
+        statefile.add_lock('somebody2', 'nooperate', now+60*60)
+        with mock.patch('time.time', return_value=now+120):
+            self.assertTrue(self.library.is_enabled())
+            self.assertEqual(len(statefile._read_state_file()), 2)
+            with mock.patch.object(PuppetctlExecution, '_allowed_to_run_command',
+                                   return_value=True), \
+                    mock.patch.object(PuppetctlExecution, 'log') as mock_log, \
+                    mock.patch('sys.stdout', new=StringIO()) as fake_out:
+                self.library.gc()
+                self.library.gc()
+        mock_log.assert_called_once_with('Purged 1 expired locks.')
+        self.assertIn('no expired locks to purge', fake_out.getvalue())
+        self.assertEqual([x['user'] for x in statefile._read_state_file().values()],
+                         ['somebody2'])
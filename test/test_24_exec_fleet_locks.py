@@ -0,0 +1,73 @@
+'''
+    PuppetctlExecution.fleet_locks test script
+'''
+
+import unittest
+import os
+import json
+import time
+import shutil
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlExecution
+
+
+class TestExecutionFleetLocks(unittest.TestCase):
+    ''' Class of tests about executing puppetctl fleet_locks commands. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-fleet.')
+        self.library = PuppetctlExecution(os.path.join(self.workdir, 'local.status'))
+        now = int(time.time())
+        for (host, locks) in [
+                ('web1', {'a1': {'user': 'alice', 'locktype': 'disable', 'message': 'db work',
+                                 'time_begin': now-7200, 'time_expiry': now+3600}}),
+                ('web2', {'b1': {'user': 'bob', 'locktype': 'someday', 'message': '',
+                                 'time_begin': now-100, 'time_expiry': now+86400*3}}),
+                ('web3', '{"truncat')]:
+            os.mkdir(os.path.join(self.workdir, host))
+            with open(os.path.join(self.workdir, host, 'puppetctl.status'), 'w',
+                      encoding='utf-8') as filepointer:
+                filepointer.write(locks if isinstance(locks, str) else json.dumps(locks))
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_fleet_locks_text(self):
+        ''' Test the summary as text, with each host's locks as they're read '''
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.fleet_locks(self.workdir, processes=1, hosts=True)
+        output = fake_out.getvalue()
+        self.assertIn('Scanned 3 hosts', output)
+        self.assertIn('1 of them unreadable', output)
+        self.assertIn('  web3: ', output)
+        self.assertIn('Hosts with disable locks: 1', output)
+        self.assertIn('Hosts with nooperate locks: 0', output)
+        self.assertIn('Locks expiring in the next 1d: 1', output)
+        # locktypes we don't know are still reported:
+        self.assertIn('web2 someday by bob since', output)
+        self.assertIn('web1 disable by alice since', output)
+        self.assertIn(': db work', output)
+        self.assertIn('  bob: 1 someday', output)
+
+    def test_fleet_locks_json(self):
+        ''' Test the summary as JSON, after a line per host with locks '''
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.fleet_locks(self.workdir, as_json=True, processes=2, hosts=True)
+        (first, second, rest) = fake_out.getvalue().split('\n', 2)
+        self.assertEqual(sorted(json.loads(x)['host'] for x in [first, second]),
+                         ['web1', 'web2'])
+        result = json.loads(rest)
+        self.assertEqual((result['hosts'], result['unreadable'], result['locks']), (3, 1, 2))
+
+    def test_fleet_locks_bad_directory(self):
+        ''' Test that a directory we can't scan is an error '''
+        with self.assertRaises(SystemExit) as fail_scan, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.fleet_locks(os.path.join(self.workdir, 'nothere'))
+        self.assertIn('Unable to scan', fake_out.getvalue())
+        self.assertEqual(fail_scan.exception.code, 2)
@@ -0,0 +1,67 @@
+'''
+    PuppetctlExecution.fleet_runs test script
+'''
+
+import unittest
+import os
+import json
+import time
+import shutil
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlExecution
+
+
+class TestExecutionFleetRuns(unittest.TestCase):
+    ''' Class of tests about executing puppetctl fleet_runs commands. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-fleet.')
+        self.library = PuppetctlExecution(os.path.join(self.workdir, 'local.status'))
+        summary_dir = os.path.join(os.path.dirname(__file__), 'last_run_summary')
+        for (host, filename) in [('web1', 'clean_last_run_summary.yaml'),
+                                 ('web2', 'fail_one_last_run_summary.yaml')]:
+            os.mkdir(os.path.join(self.workdir, host))
+            shutil.copyfile(os.path.join(summary_dir, filename),
+                            os.path.join(self.workdir, host, 'last_run_summary.yaml'))
+        # web1 last ran 284704s before then, web2 1543s.
+        self.now = 1587280000
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_fleet_runs_text(self):
+        ''' Test the summary as text '''
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out, \
+                mock.patch('time.time', return_value=self.now):
+            self.library.fleet_runs(self.workdir, processes=1, top=1)
+        output = fake_out.getvalue()
+        self.assertIn('Read 2 run summaries', output)
+        self.assertIn('0 of them unreadable', output)
+        self.assertIn('Time since last run: p50 3d 7h 5m 4s', output)
+        self.assertIn("Hosts that haven't run in 2h: 1\n  web1: 3d 7h 5m 4s ago", output)
+        self.assertIn('Hosts with failed resources: 1\n  web2: 1 failed', output)
+        self.assertIn('Slowest runs:\n  web2: 42.0s', output)
+        self.assertIn('(p90):\n  config_retrieval: 17.5s', output)
+        self.assertIn('Config versions: 2, with 1 hosts not on the most common one.', output)
+
+    def test_fleet_runs_json(self):
+        ''' Test the summary as JSON '''
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out, \
+                mock.patch('time.time', return_value=self.now):
+            self.library.fleet_runs(self.workdir, as_json=True, processes=2, stale=10**6)
+        result = json.loads(fake_out.getvalue())
+        self.assertEqual((result['hosts'], result['stragglers'], result['failing']), (2, 0, 1))
+        self.assertEqual(result['time'], self.now)
+
+    def test_fleet_runs_bad_directory(self):
+        ''' Test that a directory we can't scan is an error '''
+        with self.assertRaises(SystemExit) as fail_scan, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.fleet_runs(os.path.join(self.workdir, 'nothere'))
+        self.assertIn('Unable to scan', fake_out.getvalue())
+        self.assertEqual(fail_scan.exception.code, 2)
@@ -0,0 +1,82 @@
+'''
+    PuppetctlExecution.serve test script, and the status commands asking a server
+'''
+
+import unittest
+import os
+import signal
+import shutil
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlExecution
+
+
+class TestExecutionServe(unittest.TestCase):
+    ''' Class of tests about executing puppetctl serve commands. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-serve.')
+        self.socket_path = os.path.join(self.workdir, 'puppetctl.sock')
+        self.library = PuppetctlExecution(os.path.join(self.workdir, 'puppetctl.status'),
+                                          serve_socket=self.socket_path)
+        self.library.logging_tag = f'testingpuppetctl[{self.library.invoking_user}]'
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_serve(self):
+        ''' Test that serve listens on serve_socket, and cleans up after '''
+        before = signal.getsignal(signal.SIGTERM)
+        with mock.patch.object(PuppetctlExecution, 'log') as mock_log:
+            self.library.serve(timeout=0.1)
+        self.assertEqual(mock_log.call_args_list[0],
+                         mock.call(f'Serving status queries on {self.socket_path}.'))
+        self.assertIn('after 0 queries', mock_log.call_args_list[1][0][0])
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertIs(signal.getsignal(signal.SIGTERM), before)
+        # The server answers from the files, not from itself:
+        self.assertEqual(self.library.serve_socket, '')
+
+    def test_serve_interrupted(self):
+        ''' Test that an interrupt stops serve quietly '''
+        with mock.patch('puppetctl.server.PuppetctlServer.serve',
+                        side_effect=KeyboardInterrupt), \
+                mock.patch.object(PuppetctlExecution, 'log'):
+            self.library.serve()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_serve_fails(self):
+        ''' Test that serve exits if it can't listen '''
+        with mock.patch.object(PuppetctlExecution, 'log'), \
+                self.assertRaises(SystemExit) as fail_serve, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.serve(socket_path=os.path.join(self.workdir, 'nodir', 'sock'))
+        self.assertIn('Cannot serve on', fake_out.getvalue())
+        self.assertEqual(fail_serve.exception.code, 2)
+
+    def test_status_from_server(self):
+        ''' Test that status prints what a server says, if there is one '''
+        reply = {'puppet': {'errors': 2, 'message': 'Puppet last ran 1m ago with 2 errors'},
+                 'puppetctl': {'message': 'Puppet is enabled and in operating mode.',
+                               'color': None, 'disable': 0, 'nooperate': 0}}
+        with mock.patch.object(PuppetctlExecution, '_ask_server', return_value=reply), \
+                mock.patch.object(PuppetctlExecution, '_status_of_puppet') as mock_puppet, \
+                self.assertRaises(SystemExit) as status_run, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.library.status()
+        mock_puppet.assert_not_called()
+        self.assertEqual(status_run.exception.code, 1)
+        self.assertIn('with 2 errors', fake_out.getvalue())
+        self.assertIn('operating mode', fake_out.getvalue())
+
+    def test_no_server(self):
+        ''' Test that an empty serve_socket never asks a server '''
+        self.library.serve_socket = ''
+        with mock.patch('puppetctl.server.query_server') as mock_query:
+            self.assertTrue(self.library.is_enabled())
+            self.assertEqual(self.library._status_of_puppetctl()['disable'], 0)
+        mock_query.assert_not_called()
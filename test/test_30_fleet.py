@@ -0,0 +1,215 @@
+'''
+    Test the fleet scans: state files and run summaries from many hosts, read in a pool.
+'''
+
+import unittest
+import os
+import json
+import math
+import time
+import shutil
+import tempfile
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl.stateformats import encode_state
+from puppetctl.fleet import (DEFAULT_RUNS_PATTERN, PuppetctlFleetSummary, PuppetctlFleetRuns,
+                             find_state_files, host_name, read_host, read_run, scan_fleet)
+from puppetctl import fleet
+
+
+class TestFleet(unittest.TestCase):
+    ''' Class of tests about scanning a tree of state files. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-fleet.')
+        self.now = int(time.time())
+        self.hosts = {
+            'web1': {'a1': {'user': 'alice', 'locktype': 'disable', 'message': 'db work',
+                            'time_begin': self.now-7200, 'time_expiry': self.now+3600}},
+            'web2': {'b1': {'user': 'bob', 'locktype': 'nooperate', 'message': '',
+                            'time_begin': self.now-100, 'time_expiry': self.now+3*86400},
+                     'b2': {'user': 'bob', 'locktype': 'disable', 'message': '',
+                            'time_begin': self.now-1000, 'time_expiry': self.now-10}},
+            'web3': {},
+        }
+        for (host, locks) in self.hosts.items():
+            self._write(os.path.join(host, 'var', 'lib', 'puppetctl.status'),
+                        encode_state(locks, 'binary' if host == 'web2' else 'json'))
+        self._write(os.path.join('web4', 'puppetctl.status'), b'{"truncat')
+        # not state files:
+        self._write(os.path.join('web1', 'var', 'lib', 'puppetctl.status.backup.0'), b'{}')
+        self._write('README', b'hello')
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _write(self, relpath, data):
+        ''' Write a file in the tree '''
+        path = os.path.join(self.workdir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as filepointer:
+            filepointer.write(data)
+
+    def test_find(self):
+        ''' Verify we find the state files, and name their hosts '''
+        paths = sorted(find_state_files(self.workdir))
+        self.assertEqual([host_name(self.workdir, x) for x in paths],
+                         ['web1', 'web2', 'web3', 'web4'])
+        self.assertEqual(host_name(self.workdir, os.path.join(self.workdir, 'web9.status')),
+                         'web9.status')
+        self.assertEqual(list(find_state_files(os.path.join(self.workdir, 'nothere'))), [])
+
+    def test_read_host(self):
+        ''' Verify a host's unexpired locks are read, and a damaged file is left alone '''
+        (host, error, locks) = read_host(
+            self.workdir, os.path.join(self.workdir, 'web2', 'var', 'lib', 'puppetctl.status'),
+            self.now)
+        self.assertEqual((host, error, [x.lockid for x in locks]), ('web2', None, ['b1']))
+        damaged = os.path.join(self.workdir, 'web4', 'puppetctl.status')
+        (host, error, locks) = read_host(self.workdir, damaged, self.now)
+        self.assertEqual((host, locks), ('web4', []))
+        self.assertTrue(error)
+        with open(damaged, 'rb') as filepointer:
+            self.assertEqual(filepointer.read(), b'{"truncat')
+        self._write('web5/puppetctl.status', json.dumps({'x': {'user': 'nobody'}}).encode())
+        self.assertTrue(read_host(self.workdir, os.path.join(self.workdir, 'web5',
+                                                             'puppetctl.status'), self.now)[1])
+
+    def test_summary(self):
+        ''' Verify the summary, in one process and in a pool alike '''
+        for processes in [1, 2]:
+            summary = PuppetctlFleetSummary(self.now, soon=86400, top=1)
+            for result in scan_fleet(self.workdir, processes, now=self.now):
+                summary.add(*result)
+            result = summary.as_dict()
+            self.assertEqual((result['hosts'], result['unreadable'], result['locks']), (4, 1, 2))
+            self.assertEqual(result['unreadable_hosts'][0]['host'], 'web4')
+            self.assertEqual(result['hosts_by_locktype'], {'disable': 1, 'nooperate': 1})
+            self.assertEqual(result['users'], {'alice': {'disable': 1}, 'bob': {'nooperate': 1}})
+            self.assertEqual(result['expiring_soon'], 1)
+            self.assertEqual([x['lockid'] for x in result['soonest']], ['a1'])
+            # only the top 1 is kept:
+            self.assertEqual([(x['host'], x['lockid']) for x in result['oldest']],
+                             [('web1', 'a1')])
+        with self.assertRaises(ValueError):
+            list(scan_fleet(os.path.join(self.workdir, 'README')))
+        with self.assertRaises(ValueError):
+            list(scan_fleet(self.workdir, processes=0))
+
+    def test_summary_bounded(self):
+        ''' Verify the summary keeps only the top locks, oldest and soonest first '''
+        summary = PuppetctlFleetSummary(self.now, soon=1000, top=3)
+        for num in range(20):
+            (_host, _error, locks) = read_host(self.workdir, os.path.join(
+                self.workdir, 'web1', 'var', 'lib', 'puppetctl.status'), self.now)
+            lock = locks[0].replace(lockid=f'l{num}', time_begin=self.now-num,
+                                    time_expiry=self.now+num*100)
+            summary.add(f'host{num}', None, [lock])
+        result = summary.as_dict()
+        self.assertEqual(result['expiring_soon'], 11)
+        self.assertEqual([x['lockid'] for x in result['soonest']], ['l0', 'l1', 'l2'])
+        self.assertEqual([x['lockid'] for x in result['oldest']], ['l19', 'l18', 'l17'])
+        self.assertEqual(result['users'], {'alice': {'disable': 20}})
+
+
+class TestFleetRuns(unittest.TestCase):
+    ''' Class of tests about summarizing a tree of run summaries. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-fleet.')
+        self.now = 1587280000
+        summary_dir = os.path.join(os.path.dirname(__file__), 'last_run_summary')
+        with open(os.path.join(summary_dir, 'clean_last_run_summary.yaml'), 'r',
+                  encoding='utf-8') as filepointer:
+            clean = filepointer.read()
+        with open(os.path.join(summary_dir, 'fail_one_last_run_summary.yaml'), 'r',
+                  encoding='utf-8') as filepointer:
+            fail_one = filepointer.read()
+        # clean last ran 284704s before now, fail_one 1543s.
+        self.files = {'web1': clean, 'web2': fail_one, 'web3': fail_one,
+                      'web4': clean.replace('total: 29.360705031', 'total: 100.5'),
+                      # a run that never got a catalog:
+                      'web5': '---\nversion:\n  config:\n  puppet: 7.1.0\ntime:\n'
+                              '  last_run: 1587279000\n',
+                      'web6': 'not: [a, summary]\n'}
+        for (host, text) in self.files.items():
+            os.mkdir(os.path.join(self.workdir, host))
+            with open(os.path.join(self.workdir, host, DEFAULT_RUNS_PATTERN), 'w',
+                      encoding='utf-8') as filepointer:
+                filepointer.write(text)
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _summary(self, processes=1):
+        ''' The runs summary of the tree '''
+        runs = PuppetctlFleetRuns(self.now, stale=2*60*60, top=2)
+        for result in scan_fleet(self.workdir, processes, DEFAULT_RUNS_PATTERN, self.now,
+                                 reader=read_run):
+            runs.add(*result)
+        return runs
+
+    def test_read_run(self):
+        ''' Verify a run summary's figures, and that a bad one is reported '''
+        (host, error, record) = read_run(self.workdir, os.path.join(
+            self.workdir, 'web2', DEFAULT_RUNS_PATTERN), self.now)
+        self.assertEqual((host, error, record['age'], record['failed']), ('web2', None, 1543, 1))
+        (host, error, record) = read_run(self.workdir, os.path.join(
+            self.workdir, 'web6', DEFAULT_RUNS_PATTERN), self.now)
+        self.assertEqual((host, record), ('web6', None))
+        self.assertIn('unsupported', error)
+
+    def test_columns(self):
+        ''' Verify the columns line up, with NaN for what a host didn't say '''
+        runs = self._summary()
+        self.assertEqual(len(runs.hosts), 5)
+        row = runs.hosts.index('web5')
+        self.assertTrue(math.isnan(runs.failed[row]))
+        self.assertTrue(math.isnan(runs.times['augeas'][row]))
+        # 'alternatives' is only in the clean summary:
+        self.assertEqual(len([x for x in runs.times['alternatives'] if not math.isnan(x)]), 2)
+        for column in runs.times.values():
+            self.assertEqual(len(column), 5)
+
+    def test_summary(self):
+        ''' Verify the summary, in pure Python '''
+        with mock.patch.object(fleet, 'numpy', None):
+            result = self._summary(processes=2).as_dict()
+        self.assertFalse(result['numpy'])
+        self.assertEqual((result['hosts'], result['unreadable']), (5, 1))
+        self.assertEqual(result['unreadable_hosts'][0]['host'], 'web6')
+        self.assertEqual(result['age'], {'p50': 1543.0, 'p90': 284704.0, 'p99': 284704.0,
+                                         'max': 284704.0})
+        self.assertEqual(result['total_time']['max'], 100.5)
+        self.assertEqual(result['failed']['p50'], 1.0)
+        self.assertEqual(result['stragglers'], 2)
+        self.assertEqual(sorted(x['host'] for x in result['straggler_hosts']), ['web1', 'web4'])
+        self.assertEqual(result['failing'], 2)
+        self.assertEqual(result['slowest_hosts'][0], {'host': 'web4', 'value': 100.5})
+        self.assertEqual(result['versions'], 3)
+        self.assertEqual(result['version_hosts'], {
+            'a294ac4f4fcd5264e5246df0787757a74fc3d966': 2,
+            '3a3d5827a1637456d360f888462d2aa0dbd975f6': 2})
+        self.assertEqual(result['skewed'], 3)
+        self.assertEqual(result['times']['augeas']['max'], 3.016953824)
+
+    @unittest.skipIf(fleet.numpy is None, 'NumPy is not installed')
+    def test_numpy_agrees(self):
+        ''' Verify NumPy works out the same summary as pure Python does '''
+        runs = self._summary()
+        result = runs.as_dict()
+        with mock.patch.object(fleet, 'numpy', None):
+            pure = runs.as_dict()
+        self.assertTrue(result.pop('numpy'))
+        self.assertFalse(pure.pop('numpy'))
+        self.assertEqual(result, pure)
+
+    def test_empty(self):
+        ''' Verify a tree with no summaries has nothing to say, without failing '''
+        result = PuppetctlFleetRuns(self.now).as_dict()
+        self.assertEqual((result['hosts'], result['versions'], result['skewed']), (0, 0, 0))
+        self.assertIsNone(result['age']['p50'])
@@ -0,0 +1,97 @@
+'''
+    Test the native last_run_summary.yaml reader.
+'''
+
+import unittest
+import os
+import math
+import json
+import tempfile
+import shutil
+import test.context  # pylint: disable=unused-import
+from puppetctl.lastrun import (parse_last_run_summary, read_last_run_summary, last_run_record,
+                               summary_cache_key, read_cached_record, write_cached_record)
+
+
+class TestLastRun(unittest.TestCase):
+    ''' Class of tests about reading puppet's run summaries. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.summary_dir = os.path.join(os.path.dirname(__file__), 'last_run_summary')
+
+    def test_read_fixtures(self):
+        ''' Verify the summaries puppet wrote read as puppet's own ruby reads them '''
+        # The values here are visually copied from the files in test/last_run_summary/*
+        for (filename, last_run, failed, config, total_time) in [
+                ('clean_last_run_summary.yaml', 1586995296, 0,
+                 'a294ac4f4fcd5264e5246df0787757a74fc3d966', 29.360705031),
+                ('fail_one_last_run_summary.yaml', 1587278457, 1,
+                 '3a3d5827a1637456d360f888462d2aa0dbd975f6', 42.012328918)]:
+            summary = read_last_run_summary(os.path.join(self.summary_dir, filename))
+            self.assertEqual(summary['version']['puppet'], '6.14.0')
+            record = last_run_record(summary)
+            self.assertEqual((record['last_run'], record['failed'], record['config'],
+                              record['total_time']), (last_run, failed, config, total_time))
+            self.assertEqual(record['times']['config_retrieval'],
+                             summary['time']['config_retrieval'])
+            self.assertNotIn('last_run', record['times'])
+
+    def test_scalars(self):
+        ''' Verify the scalars YAML may write are read as YAML would '''
+        summary = parse_last_run_summary(
+            "---\n# a comment\nversion:\n  config: '1586995296'\n  puppet: 7.1.0\n"
+            'time:\n  last_run: 15 # when\n  small: .5e3\n  neg: -2\n  big: .inf\n'
+            "  none: ~\n  empty:\n  yes: true\n  quoted: \"a \\\"b\\\"\"\n  single: 'it''s'\n"
+            '  url: http://x#y\n\nflag: false\n...\nignored: [1]\n')
+        self.assertEqual(summary, {
+            'version': {'config': '1586995296', 'puppet': '7.1.0'},
+            'time': {'last_run': 15, 'small': 500.0, 'neg': -2, 'big': math.inf, 'none': None,
+                     'empty': None, 'yes': True, 'quoted': 'a "b"', 'single': "it's",
+                     'url': 'http://x#y'},
+            'flag': False})
+
+    def test_unsupported(self):
+        ''' Verify YAML outside the shape puppet writes is an error, not a guess '''
+        for text in ['a:\n  b:\n    c: 1\n', 'a: [1]\n', 'a: &anchor 1\n', 'a\n',
+                     'x:\n  - 1\n', 'x:\n\t y: 1\n', "a: 'open\n", 'a: "open\n', '  a: 1\n',
+                     'a:b\n']:
+            with self.assertRaises(ValueError, msg=text):
+                parse_last_run_summary(text)
+
+    def test_record(self):
+        ''' Verify a run that never got a catalog still has a record, and junk doesn't '''
+        record = last_run_record({'version': {'config': None, 'puppet': '7.1.0'},
+                                  'time': {'last_run': 1586995296}})
+        self.assertEqual(record, {'last_run': 1586995296, 'failed': None, 'total_time': None,
+                                  'config': None, 'times': {}})
+        for summary in [{}, {'time': {'total': 1.0}}, {'time': 'soon'},
+                        {'time': {'last_run': 'never'}}]:
+            with self.assertRaises(ValueError):
+                last_run_record(summary)
+
+    def test_cache(self):
+        ''' Verify a cached record is only found under the key it was cached for '''
+        workdir = tempfile.mkdtemp(prefix='puppetctl-lastrun.')
+        try:
+            cache_file = os.path.join(workdir, 'lastrun.cache')
+            summary_file = os.path.join(self.summary_dir, 'clean_last_run_summary.yaml')
+            key = summary_cache_key(os.stat(summary_file))
+            self.assertIsNone(read_cached_record(cache_file, key))
+            record = last_run_record(read_last_run_summary(summary_file))
+            write_cached_record(cache_file, key, record)
+            self.assertEqual(read_cached_record(cache_file, key), record)
+            self.assertIsNone(read_cached_record(cache_file, key[:-1] + [key[-1]+1]))
+            # nothing is left behind but the cache itself:
+            self.assertEqual(os.listdir(workdir), ['lastrun.cache'])
+            # a cache from another version, or of something else, is a miss:
+            for cached in [{'version': 0, 'key': key, 'record': record},
+                           {'version': 1, 'key': key, 'record': {'last_run': 'soon'}},
+                           ['not', 'a', 'cache']]:
+                with open(cache_file, 'w', encoding='utf-8') as cache_w:
+                    json.dump(cached, cache_w)
+                self.assertIsNone(read_cached_record(cache_file, key))
+            with self.assertRaises(OSError):
+                write_cached_record(os.path.join(workdir, 'nodir', 'cache'), key, record)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
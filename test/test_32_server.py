@@ -0,0 +1,228 @@
+'''
+    Test the status query server and its client.
+'''
+
+import unittest
+import os
+import json
+import fcntl
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import test.context  # pylint: disable=unused-import
+import mock
+from puppetctl import PuppetctlStatefile, PuppetctlExecution
+from puppetctl.server import (CLIENT_DEADLINE, QUERY_TIMEOUT, MAX_REQUEST, PuppetctlServer,
+                              query_server, state_identity)
+
+
+class TestServer(unittest.TestCase):
+    ''' Class of tests about answering status queries over a socket. '''
+
+    def setUp(self):
+        ''' Preparing test rig '''
+        self.workdir = tempfile.mkdtemp(prefix='puppetctl-server.')
+        self.state_file = os.path.join(self.workdir, 'puppetctl.status')
+        self.socket_path = os.path.join(self.workdir, 'puppetctl.sock')
+        self.lastrunfile = os.path.join(os.path.dirname(__file__), 'last_run_summary',
+                                        'fail_one_last_run_summary.yaml')
+        self.sf_patcher = mock.patch.object(PuppetctlStatefile, '_allowed_to_write_statefile',
+                                            return_value=True)
+        self.sf_patcher.start()
+        self.runner = PuppetctlExecution(self.state_file, lastrunfile=self.lastrunfile,
+                                         serve_socket='')
+        self.server = PuppetctlServer(self.runner, self.socket_path)
+        # Someone else changing the locks.  (A statefile isn't for sharing between threads.)
+        self.writer = PuppetctlStatefile(self.state_file)
+        self.thread = None
+
+    def tearDown(self):
+        ''' Cleanup test rig '''
+        if self.thread is not None:
+            self.server.stop()
+            self.thread.join()
+        self.server.close()
+        self.sf_patcher.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _start(self):
+        ''' Serve in a thread '''
+        self.server.open()
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def _client(self):
+        ''' A runner that asks the server first '''
+        return PuppetctlExecution(self.state_file, lastrunfile=self.lastrunfile,
+                                  serve_socket=self.socket_path)
+
+    def test_answers(self):
+        ''' Verify the answers follow the locks, reading them only when they change '''
+        now = int(time.time())
+        self.assertEqual(self.server.answer('is-enabled'),
+                         {'enabled': True, 'state': self.server.identity})
+        self.assertTrue(self.server.answer('is-operating\n')['operating'])
+        self.writer.add_lock('somebody1', 'disable', now+2)
+        self.writer.add_lock('somebody2', 'nooperate', now+3600)
+        self.assertFalse(self.server.answer('is-enabled')['enabled'])
+        reply = self.server.answer('lock-status')
+        self.assertEqual((reply['disable'], reply['nooperate'], reply['color']), (1, 1, '1;31'))
+        self.assertIn('disabled by somebody1', reply['message'])
+        self.assertEqual(reply['message'].count('\n'), 1)
+        reads = self.server.metrics['lock_reads']
+        # An expiry isn't a write, but is seen all the same:
+        with mock.patch('time.time', return_value=now+10):
+            self.assertTrue(self.server.answer('is-enabled')['enabled'])
+            self.assertEqual(self.server.answer('lock-status')['color'], '0;36')
+        self.assertEqual(self.server.metrics['lock_reads'], reads)
+        self.assertIn('unknown request', self.server.answer('is-on-fire')['error'])
+
+    def test_writer_holds_lock(self):
+        ''' Verify a writer holding the state file lock doesn't hold up the server '''
+        self.writer.add_lock('somebody1', 'disable', int(time.time())+60)
+        self.runner.statefile_object.lock_timeout = 5
+        with open(self.writer.lock_file, 'r', encoding='utf-8') as other:
+            fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+            start = time.monotonic()
+            self.assertFalse(self.server.answer('is-enabled')['enabled'])
+            self.assertLess(time.monotonic() - start, 1)
+
+    def test_answers_without_inotify(self):
+        ''' Verify changes are noticed by the backend version, where there's no inotify '''
+        with mock.patch('puppetctl.inotify.PuppetctlInotify', side_effect=OSError):
+            self.assertTrue(self.server.answer('is-enabled')['enabled'])
+            self.server.answer('is-enabled')
+            self.assertEqual(self.server.metrics['lock_reads'], 1)
+            self.writer.add_lock('somebody1', 'disable', int(time.time())+60)
+            self.assertFalse(self.server.answer('is-enabled')['enabled'])
+        self.assertEqual(self.server.metrics['lock_reads'], 2)
+
+    def test_status_root_only(self):
+        ''' Verify only root is told about the last run '''
+        # A failure is an error reply, and the locks are read again next time:
+        with mock.patch.object(PuppetctlStatefile, 'read_state_file', side_effect=OSError('x')):
+            self.assertIn('OSError', self.server.answer('lock-status')['error'])
+        self.assertEqual(self.server.answer('lock-status')['disable'], 0)
+        reply = self.server.answer('status', uid=0)
+        self.assertEqual(reply['puppet']['errors'], 1)
+        self.assertIn('3a3d5827a1637456d360f888462d2aa0dbd975f6', reply['puppet']['message'])
+        self.assertEqual(reply['puppetctl']['disable'], 0)
+        reply = self.server.answer('status', uid=1006)
+        self.assertIn('without being root', reply['puppet']['message'])
+
+    def test_over_socket(self):
+        ''' Verify a client gets its answers from a running server '''
+        self._start()
+        os.chmod(self.socket_path, 0o666)
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o666)
+        client = self._client()
+        self.writer.add_lock('somebody1', 'nooperate', int(time.time())+60)
+        with mock.patch.object(client.statefile_object, 'session') as mock_session:
+            self.assertTrue(client.is_enabled())
+            self.assertFalse(client.is_operating())
+            self.assertEqual(client._status_of_puppetctl()['nooperate'], 1)
+        mock_session.assert_not_called()
+        self.assertEqual(self.server.metrics['queries'], 3)
+        # Several requests on one connection:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.socket_path)
+            connection.sendall(b'ping\nis-enabled\n')
+            with connection.makefile('rb') as replies:
+                self.assertEqual(json.loads(replies.readline()), {'state': self.server.identity})
+                self.assertTrue(json.loads(replies.readline())['enabled'])
+        # A second server on the same socket is refused:
+        with self.assertRaises(OSError):
+            PuppetctlServer(self.runner, self.socket_path).open()
+
+    def test_idle_clients(self):
+        ''' Verify a client that says nothing holds nobody up, and is dropped in time '''
+        self._start()
+        client = self._client()
+        with mock.patch('puppetctl.server.MAX_CLIENTS', 3):
+            idlers = []
+            for _num in range(5):
+                idler = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                idler.connect(self.socket_path)
+                self.addCleanup(idler.close)
+                idlers.append(idler)
+            start = time.monotonic()
+            with mock.patch.object(client.statefile_object, 'session') as mock_session:
+                self.assertTrue(client.is_enabled())
+            mock_session.assert_not_called()
+            self.assertLess(time.monotonic() - start, QUERY_TIMEOUT)
+            # Past the deadline, or to make room, every idler was let go:
+            for idler in idlers:
+                idler.settimeout(CLIENT_DEADLINE * 2)
+                self.assertEqual(idler.recv(1), b'')
+        self.assertEqual(self.server.metrics['clients_dropped'], 5)
+        # A request line longer than we'll read is dropped too:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.socket_path)
+            connection.settimeout(CLIENT_DEADLINE)
+            connection.sendall(b'x' * MAX_REQUEST * 2)
+            self.assertEqual(connection.recv(1), b'')
+        self.assertEqual(self.server.metrics['clients_dropped'], 6)
+
+    def test_slow_server(self):
+        ''' Verify a client gives up quickly on a server that doesn't answer '''
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as deaf:
+            deaf.bind(self.socket_path)
+            deaf.listen(1)
+            start = time.monotonic()
+            self.assertIsNone(query_server(self.socket_path, 'ping', self.server.identity))
+            self.assertLess(time.monotonic() - start, QUERY_TIMEOUT * 2)
+
+    def test_client_fallback(self):
+        ''' Verify a client reads the files itself when there's no server to believe '''
+        client = self._client()
+        self.assertIsNone(query_server(self.socket_path, 'ping', state_identity(client)))
+        # With no socket, there's nothing to ask:
+        with mock.patch('puppetctl.server.query_server') as mock_query:
+            self.assertTrue(client.is_enabled())
+        mock_query.assert_not_called()
+        # and once a socket has no server behind it, we don't keep asking:
+        client = self._client()
+        with open(self.socket_path, 'w', encoding='utf-8'):
+            pass
+        self.assertIsNone(query_server(self.socket_path, 'ping', state_identity(client)))
+        with mock.patch('puppetctl.server.query_server', return_value=None) as mock_query:
+            self.assertTrue(client.is_enabled())
+            self.assertTrue(client.is_operating())
+        mock_query.assert_called_once()
+        os.remove(self.socket_path)
+        self._start()
+        # A server about other locks isn't believed:
+        other = PuppetctlExecution(os.path.join(self.workdir, 'other.status'),
+                                   lastrunfile=self.lastrunfile, serve_socket=self.socket_path)
+        self.assertIsNone(query_server(self.socket_path, 'ping', state_identity(other)))
+        # Nor one run by someone else:
+        with mock.patch('puppetctl.server.peer_uid', return_value=1006), \
+                mock.patch('os.geteuid', return_value=1007):
+            self.assertIsNone(query_server(self.socket_path, 'ping', state_identity(client)))
+        self.assertIsNotNone(query_server(self.socket_path, 'ping', state_identity(client)))
+
+    def test_stale_socket(self):
+        ''' Verify a socket left behind by a server that's gone is replaced '''
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as leftover:
+            leftover.bind(self.socket_path)
+        self._start()
+        self.assertIsNotNone(query_server(self.socket_path, 'ping', self.server.identity))
+        self.server.stop()
+        self.thread.join()
+        self.thread = None
+        self.server.close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_socket_activation(self):
+        ''' Verify the socket systemd hands us is the one served on '''
+        with mock.patch.dict(os.environ, {'LISTEN_PID': str(os.getpid()), 'LISTEN_FDS': '1'}), \
+                mock.patch('socket.socket') as mock_socket:
+            self.server.open()
+        mock_socket.assert_called_once_with(fileno=3)
+        self.server.listener = None
+        with mock.patch.dict(os.environ, {'LISTEN_PID': '1', 'LISTEN_FDS': '1'}):
+            self.assertIsNone(self.server._inherited_socket())
+        with mock.patch.dict(os.environ, {'LISTEN_PID': 'nope'}):
+            self.assertIsNone(self.server._inherited_socket())
@@ -97,8 +97,12 @@ class TestCLIHandler(unittest.TestCase):
         config.add_section('puppet')
         config.set('puppet', 'puppet_bin_path', '/opt/somepath')
         config.set('puppet', 'lastrunfile', '/opt/puppetlabs.yaml')
+        config.set('puppet', 'lastrun_parser', 'ruby')
+        config.set('puppet', 'lastrun_cache', '/tmp/lastrun.cache')
         config.add_section('puppetctl')
         config.set('puppetctl', 'state_file', '/home/status')
+        config.set('puppetctl', 'durability', 'file')
+        config.set('puppetctl', 'serve_socket', '/tmp/puppetctl.sock')
         with open('/tmp/test_cli_config_nonconf_good.conf',
                   'w', encoding='utf-8') as configfile:
             config.write(configfile)
@@ -111,7 +115,11 @@ class TestCLIHandler(unittest.TestCase):
         self.assertIsInstance(self.library.runner, PuppetctlExecution)
         self.assertEqual(self.library.runner.puppet_bin_path, '/opt/somepath:/bin:/usr/bin')
         self.assertEqual(self.library.runner.lastrunfile, '/opt/puppetlabs.yaml')
+        self.assertEqual(self.library.runner.lastrun_parser, 'ruby')
+        self.assertEqual(self.library.runner.lastrun_cache, '/tmp/lastrun.cache')
         self.assertEqual(self.library.runner.statefile_object.state_file, '/home/status')
+        self.assertEqual(self.library.runner.statefile_object.durability, 'file')
+        self.assertEqual(self.library.runner.serve_socket, '/tmp/puppetctl.sock')
 
     def test_cli_simple_command_good(self):
         ''' Check main for good task name.  This is not exhaustive. '''
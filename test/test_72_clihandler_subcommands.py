@@ -3,6 +3,7 @@
 '''
 
 import unittest
+import json
 import time
 from io import StringIO
 import test.context  # pylint: disable=unused-import
@@ -219,6 +220,149 @@ class TestCLIHandler(unittest.TestCase):
             self.library.subcommand_motd_status('puppetctl', 'motd-status', ['--anyargs'])
         mock_status.assert_called_once_with()
 
+    def test_sc_import_state(self):
+        ''' Check subcommand_import_state '''
+        for (args, source) in [([], '/var/lib/puppetctl.status'),
+                               (['/tmp/old.status'], '/tmp/old.status')]:
+            with mock.patch.object(PuppetctlExecution, 'import_state') as mock_import:
+                self.library.subcommand_import_state('puppetctl', 'import-state', args)
+            mock_import.assert_called_once_with(source)
+        with self.assertRaises(SystemExit) as exit_bad, \
+                mock.patch('sys.stderr', new=StringIO()):
+            self.library.subcommand_import_state('puppetctl', 'import-state', ['a', 'b'])
+        self.assertEqual(exit_bad.exception.code, 2)
+
+    def test_sc_gc(self):
+        ''' Check subcommand_gc '''
+        with mock.patch.object(PuppetctlExecution, 'gc') as mock_gc:
+            self.library.subcommand_gc('puppetctl', 'gc', [])
+        mock_gc.assert_called_once_with()
+        with self.assertRaises(SystemExit) as exit_bad, \
+                mock.patch('sys.stderr', new=StringIO()):
+            self.library.subcommand_gc('puppetctl', 'gc', ['--all'])
+        self.assertEqual(exit_bad.exception.code, 2)
+
+    def test_sc_fleet_locks(self):
+        ''' Check subcommand_fleet_locks '''
+        for (args, kwargs) in [
+                (['/srv/fleet'], {'as_json': False, 'processes': None,
+                                  'pattern': 'puppetctl.status', 'soon': 86400, 'top': 10,
+                                  'hosts': False}),
+                (['/srv/fleet', '--json', '--processes', '8', '--pattern', '*.status',
+                  '--soon', '2', '--top', '5', '--hosts'],
+                 {'as_json': True, 'processes': 8, 'pattern': '*.status', 'soon': 7200,
+                  'top': 5, 'hosts': True})]:
+            with mock.patch.object(PuppetctlExecution, 'fleet_locks') as mock_fleet:
+                self.library.subcommand_fleet_locks('puppetctl', 'fleet-locks', args)
+            mock_fleet.assert_called_once_with('/srv/fleet', **kwargs)
+        for args in [[], ['/srv/fleet', '--processes', '0'], ['/srv/fleet', '--top', '-1']]:
+            with self.assertRaises(SystemExit) as exit_bad, \
+                    mock.patch('sys.stderr', new=StringIO()):
+                self.library.subcommand_fleet_locks('puppetctl', 'fleet-locks', args)
+            self.assertEqual(exit_bad.exception.code, 2)
+
+    def test_sc_fleet_runs(self):
+        ''' Check subcommand_fleet_runs '''
+        for (args, kwargs) in [
+                (['/srv/runs'], {'as_json': False, 'processes': None,
+                                 'pattern': 'last_run_summary.yaml', 'stale': 7200, 'top': 10}),
+                (['/srv/runs', '--json', '--processes', '8', '--pattern', '*.yaml',
+                  '--stale', '0.5', '--top', '5'],
+                 {'as_json': True, 'processes': 8, 'pattern': '*.yaml', 'stale': 1800,
+                  'top': 5})]:
+            with mock.patch.object(PuppetctlExecution, 'fleet_runs') as mock_fleet:
+                self.library.subcommand_fleet_runs('puppetctl', 'fleet-runs', args)
+            mock_fleet.assert_called_once_with('/srv/runs', **kwargs)
+        for args in [[], ['/srv/runs', '--processes', '0'], ['/srv/runs', '--top', '-1']]:
+            with self.assertRaises(SystemExit) as exit_bad, \
+                    mock.patch('sys.stderr', new=StringIO()):
+                self.library.subcommand_fleet_runs('puppetctl', 'fleet-runs', args)
+            self.assertEqual(exit_bad.exception.code, 2)
+
+    def test_sc_export_state(self):
+        ''' Check subcommand_export_state '''
+        for (args, state_format) in [([], 'json'), (['--json'], 'json'),
+                                     (['--format', 'binary'], 'binary'),
+                                     (['--format', 'journal'], 'journal'),
+                                     (['--format', 'binary', '--json'], 'json')]:
+            with mock.patch.object(PuppetctlExecution, 'export_state') as mock_export:
+                self.library.subcommand_export_state('puppetctl', 'export-state', args)
+            mock_export.assert_called_once_with(state_format=state_format)
+        # help is allowed:
+        with self.assertRaises(SystemExit) as exit_help, \
+                mock.patch('sys.stdout', new=StringIO()):
+            self.library.subcommand_export_state('puppetctl', 'export-state', ['--help'])
+        self.assertEqual(exit_help.exception.code, 0)
+        # other formats are not:
+        with self.assertRaises(SystemExit) as exit_bad, \
+                mock.patch('sys.stderr', new=StringIO()):
+            self.library.subcommand_export_state('puppetctl', 'export-state', ['--yaml'])
+        self.assertEqual(exit_bad.exception.code, 2)
+        with self.assertRaises(SystemExit) as exit_bad, \
+                mock.patch('sys.stderr', new=StringIO()):
+            self.library.subcommand_export_state('puppetctl', 'export-state',
+                                                 ['--format', 'yaml'])
+        self.assertEqual(exit_bad.exception.code, 2)
+
+    def test_sc_watch(self):
+        ''' Check subcommand_watch '''
+        for (args, as_json, timeout) in [([], False, None), (['--json'], True, None),
+                                         (['--json', '--timeout', '2.5'], True, 2.5)]:
+            with mock.patch.object(PuppetctlExecution, 'watch') as mock_watch:
+                self.library.subcommand_watch('puppetctl', 'watch', args)
+            mock_watch.assert_called_once_with(as_json=as_json, timeout=timeout)
+        with self.assertRaises(SystemExit) as exit_bad, \
+                mock.patch('sys.stderr', new=StringIO()):
+            self.library.subcommand_watch('puppetctl', 'watch', ['--timeout', 'soon'])
+        self.assertEqual(exit_bad.exception.code, 2)
+
+    def test_sc_serve(self):
+        ''' Check subcommand_serve '''
+        for (args, socket_path, timeout) in [([], None, None),
+                                             (['--socket', '/tmp/p.sock', '--timeout', '1'],
+                                              '/tmp/p.sock', 1.0)]:
+            with mock.patch.object(PuppetctlExecution, 'serve') as mock_serve:
+                self.library.subcommand_serve('puppetctl', 'serve', args)
+            mock_serve.assert_called_once_with(socket_path=socket_path, timeout=timeout)
+        with self.assertRaises(SystemExit) as exit_bad, \
+                mock.patch('sys.stderr', new=StringIO()):
+            self.library.subcommand_serve('puppetctl', 'serve', ['--port', '80'])
+        self.assertEqual(exit_bad.exception.code, 2)
+
+    def test_sc_lock_history(self):
+        ''' Check subcommand_lock_history '''
+        for (args, days, as_json) in [([], 30, False), (['--days', '7', '--json'], 7, True)]:
+            with mock.patch.object(PuppetctlExecution, 'lock_history') as mock_history:
+                self.library.subcommand_lock_history('puppetctl', 'lock-history', args)
+            mock_history.assert_called_once_with(days=days, as_json=as_json)
+        for args in [['--days', '0'], ['--days', 'many']]:
+            with self.assertRaises(SystemExit) as exit_bad, \
+                    mock.patch('sys.stderr', new=StringIO()):
+                self.library.subcommand_lock_history('puppetctl', 'lock-history', args)
+            self.assertEqual(exit_bad.exception.code, 2)
+
+    def test_sc_apply_locks(self):
+        ''' Check subcommand_apply_locks '''
+        operations = [{'op': 'remove', 'locktype': 'nooperate'}]
+        with mock.patch.object(PuppetctlExecution, 'apply_locks') as mock_apply, \
+                mock.patch('sys.stdin', new=StringIO(json.dumps(operations))):
+            self.library.subcommand_apply_locks('puppetctl', 'apply-locks', [])
+        mock_apply.assert_called_once_with(operations)
+        # help is allowed:
+        with self.assertRaises(SystemExit) as exit_help, \
+                mock.patch('sys.stdout', new=StringIO()):
+            self.library.subcommand_apply_locks('puppetctl', 'apply-locks', ['--help'])
+        self.assertEqual(exit_help.exception.code, 0)
+        # garbage is not:
+        with self.assertRaises(SystemExit) as exit_bad, \
+                mock.patch.object(PuppetctlExecution, 'apply_locks') as mock_apply, \
+                mock.patch('sys.stdin', new=StringIO('[{"op": ')), \
+                mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            self.library.subcommand_apply_locks('puppetctl', 'apply-locks', [])
+        self.assertEqual(exit_bad.exception.code, 2)
+        self.assertIn('not valid JSON', fake_err.getvalue())
+        mock_apply.assert_not_called()
+
     def test_sc_break_all_locks(self):
         ''' Check subcommand_break_all_locks '''
         # No arguments = insufficient force
@@ -3,11 +3,18 @@
 '''
 
 import unittest
+import os
+import sys
+import subprocess
 import test.context  # pylint: disable=unused-import
 import mock
 import puppetctl.command_line
 from puppetctl import PuppetctlCLIHandler
 
+# What the status commands shouldn't have to start up.
+UNNEEDED_MODULES = ['puppetctl.audit', 'puppetctl.fleet', 'puppetctl.server',
+                    'puppetctl.inotify', 'sqlite3', 'socket', 'ctypes', 'concurrent.futures']
+
 
 class TestCommandLine(unittest.TestCase):
     ''' Class of tests about invoking the whole script. '''
@@ -18,3 +25,18 @@ class TestCommandLine(unittest.TestCase):
         with mock.patch.object(PuppetctlCLIHandler, 'main') as mock_main:
             puppetctl.command_line.main()
         mock_main.assert_called_once()
+
+    def test_lean_imports(self):
+        ''' Test that a status check imports only what it needs '''
+        state_file = '/tmp/lean-imports.test.txt'
+        self.addCleanup(lambda: os.path.exists(state_file) and os.remove(state_file))
+        script = ('import sys\n'
+                  'from puppetctl import PuppetctlExecution\n'
+                  f'runner = PuppetctlExecution({state_file!r}, '
+                  "serve_socket='/tmp/no-such-socket.test')\n"
+                  'runner.is_enabled()\n'
+                  f'print(sorted(x for x in {UNNEEDED_MODULES!r} if x in sys.modules))\n')
+        output = subprocess.run([sys.executable, '-B', '-c', script], check=True,
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.stdout.strip(), '[]')
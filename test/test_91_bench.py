@@ -0,0 +1,55 @@
+'''
+    Test that the statefile benchmarks run.
+'''
+
+import unittest
+from io import StringIO
+import json
+import time
+import test.context  # pylint: disable=unused-import
+import mock
+from bench.bench_statefile import (OPERATIONS, VICTIM_LOCKID, BenchStatefile, seed_state,
+                                   run_benchmarks, compare_results, main)
+
+
+class TestBenchStatefile(unittest.TestCase):
+    ''' Class of tests about the statefile benchmarks. '''
+
+    def test_seed_state(self):
+        ''' Verify the seeded locks are as many and as expired as asked '''
+        seed = seed_state(10, 0.5, 1000)
+        self.assertEqual(len(seed), 10)
+        self.assertEqual(len([x for x in seed.values() if x['time_expiry'] < 1000]), 5)
+        self.assertGreater(seed[VICTIM_LOCKID]['time_expiry'], 1000)
+        # the lock to remove stays live, whatever the fraction:
+        self.assertGreater(seed_state(2, 1.0, 1000)[VICTIM_LOCKID]['time_expiry'], 1000)
+        self.assertEqual(seed_state(0, 0.5, 1000), {})
+
+    def test_seed_purges(self):
+        ''' Verify a seeded state keeps its expired locks until a purge clears them '''
+        statefile = BenchStatefile(backend='memory')
+        seed = seed_state(10, 0.5, int(time.time()))
+        statefile.write_state_file(seed)
+        self.assertEqual(len(statefile.read_state_file()), 5)
+        self.assertEqual(statefile.purge_expired_locks(), 5)
+        self.assertEqual(statefile.purge_expired_locks(), 0)
+
+    def test_run_and_compare(self):
+        ''' Verify a small run covers every operation, and comparisons catch slowdowns '''
+        results = run_benchmarks([0, 3], [0.5], repeat=1, backend='memory')
+        self.assertEqual(results['meta']['backend'], 'memory')
+        self.assertEqual(sorted(x['operation'] for x in results['results'] if x['locks'] == 3),
+                         sorted(OPERATIONS))
+        self.assertNotIn('remove_lock',
+                         [x['operation'] for x in results['results'] if x['locks'] == 0])
+        self.assertEqual(compare_results(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower['results'][0]['seconds']['median'] *= 2
+        self.assertEqual(len(compare_results(results, slower)), 1)
+
+    def test_main(self):
+        ''' Verify the command line prints JSON '''
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.assertEqual(main(['--locks', '1', '--expired', '0', '--repeat', '1',
+                                   '--backend', 'memory']), 0)
+        self.assertEqual(len(json.loads(fake_out.getvalue())['results']), len(OPERATIONS))
@@ -0,0 +1,46 @@
+'''
+    Test that the lastrunfile parser benchmarks run.
+'''
+
+import unittest
+from io import StringIO
+import json
+import test.context  # pylint: disable=unused-import
+import mock
+from bench import bench_lastrun
+from bench.bench_lastrun import run_benchmarks, main
+
+
+class TestBenchLastrun(unittest.TestCase):
+    ''' Class of tests about the lastrunfile parser benchmarks. '''
+
+    def test_run_without_ruby(self):
+        ''' Verify the native parser and cache are timed, and ruby left out when it's missing '''
+        with mock.patch.object(bench_lastrun, 'ruby_available', return_value=False):
+            results = run_benchmarks(repeat=2)
+        self.assertEqual(results['meta']['lastrunfile'], 'sample')
+        self.assertFalse(results['meta']['ruby_available'])
+        self.assertEqual([x['parser'] for x in results['results']], ['native', 'cached'])
+        self.assertEqual(results['results'][0]['repeat'], 2)
+        self.assertIsNone(results['speedup'])
+        self.assertGreater(results['cached_speedup'], 0)
+        self.assertIsNone(results['parsers_agree'])
+
+    def test_main(self):
+        ''' Verify the command line prints JSON, and fails if the parsers disagree '''
+        # native, ruby, then the cache warming up and being timed:
+        agree = [{'age': 1, 'errors': 0, 'config': 'abc'}] * 4
+        disagree = agree[:1] + [{'age': 1, 'errors': 3, 'config': 'abc'}] + agree[2:]
+        with mock.patch.object(bench_lastrun, 'ruby_available', return_value=True), \
+                mock.patch('puppetctl.PuppetctlExecution._parse_puppet_lastrunfile',
+                           side_effect=agree), \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.assertEqual(main(['--repeat', '1']), 0)
+        results = json.loads(fake_out.getvalue())
+        self.assertEqual([x['parser'] for x in results['results']], ['native', 'ruby', 'cached'])
+        self.assertTrue(results['parsers_agree'])
+        with mock.patch.object(bench_lastrun, 'ruby_available', return_value=True), \
+                mock.patch('puppetctl.PuppetctlExecution._parse_puppet_lastrunfile',
+                           side_effect=disagree), \
+                mock.patch('sys.stdout', new=StringIO()):
+            self.assertEqual(main(['--repeat', '1']), 1)
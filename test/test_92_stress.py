@@ -0,0 +1,30 @@
+'''
+    Test that the lock stress harness runs.
+'''
+
+import unittest
+from io import StringIO
+import json
+import test.context  # pylint: disable=unused-import
+import mock
+from bench.stress_locks import OPERATIONS, run_stress, main
+
+
+class TestStressLocks(unittest.TestCase):
+    ''' Class of tests about the lock stress harness. '''
+
+    def test_run_stress(self):
+        ''' Verify a small run does every operation without violations '''
+        report = run_stress(processes=2, ops=20, seed=1)
+        self.assertEqual(report['meta']['backend'], 'file')
+        self.assertEqual(report['latency']['all']['count'], 40)
+        self.assertEqual(sorted(x for x in report['latency'] if x != 'all'), sorted(OPERATIONS))
+        self.assertEqual(set(report['violations'].values()), {0})
+        with self.assertRaises(ValueError):
+            run_stress(processes=2, ops=1, backend='memory')
+
+    def test_main(self):
+        ''' Verify the command line prints JSON, and exits 0 without violations '''
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.assertEqual(main(['--processes', '2', '--ops', '5', '--backend', 'sqlite']), 0)
+        self.assertEqual(json.loads(fake_out.getvalue())['meta']['backend'], 'sqlite')